@@ -1,9 +1,27 @@
 # Standard library imports
+import abc
 import asyncio
+import base64
+import collections
+import contextlib
+import concurrent.futures
+import datetime
+import hashlib
+import heapq
+import inspect
+import io
+import itertools
 import json
 import logging
 import os
+import pathlib
+import re
 import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
 from typing import Any, Callable, Union
 
 # Third-party imports
@@ -11,6 +29,12 @@ import discord
 from discord import app_commands # Added
 from discord.ext import commands
 from dotenv import load_dotenv
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+import httplib2
+from mutagen.flac import Picture
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.oggopus import OggOpus
 from PIL import Image
 import pytubefix
 from pytubefix.exceptions import RegexMatchError
@@ -18,9 +42,25 @@ from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
 import redis
 import requests
+from requests.adapters import HTTPAdapter
 import subprocess
+from urllib3.util.retry import Retry
 
 load_dotenv()
+
+
+def get_env_number(name: str, default, cast=int):
+    """Reads a numeric setting from the environment, falling back to default if it is missing or invalid."""
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        logging.warning(f"{name} is invalid; defaulting to {default}")
+        return default
+
+
 # Ensure global path variables are absolute
 download_music_folder = os.path.abspath(os.getenv("DOWNLOAD_MUSIC_FOLDER", ""))
 music_conversion_folder = os.path.abspath(os.getenv("MUSIC_CONVERSION_FOLDER", ""))
@@ -29,11 +69,106 @@ video_conversion_folder = os.path.abspath(os.getenv("VIDEO_CONVERSION_FOLDER", "
 plex_video_folder = os.path.abspath(os.getenv("PLEX_VIDEO_FOLDER", ""))
 plex_music_folder = os.path.abspath(os.getenv("PLEX_MUSIC_FOLDER", ""))
 temp_spotify_folder = os.path.abspath(os.getenv("TEMP_SPOTIFY_FOLDER", ""))
+# SQLite database recording every file we have already produced, so nothing is downloaded twice.
+media_index_path = os.path.abspath(os.getenv("MEDIA_INDEX_PATH", "media_index.sqlite3"))
+# SQLite database of queued download jobs and their playlist items, so unfinished work resumes after a restart.
+job_queue_path = os.path.abspath(os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3"))
+# Directory the local upload backend copies files too large for Discord into (e.g. an NFS mount or the root of an HTTP share).
+local_upload_folder = os.path.abspath(os.getenv("LOCAL_UPLOAD_FOLDER", "uploads"))
 
 # These are IDs or other settings, not local file paths, so abspath is not needed.
+# Where files too large for Discord go: "drive" (Google Drive), "local" (LOCAL_UPLOAD_FOLDER) or "memory" (kept in memory, for tests and benchmarks).
+upload_backend = os.getenv("UPLOAD_BACKEND", "drive").lower()
+# URL LOCAL_UPLOAD_FOLDER is served at, used for the links to local uploads; file:// links are used without one.
+local_upload_url = os.getenv("LOCAL_UPLOAD_URL", "")
 google_drive_music_upload = os.getenv("GOOGLE_DRIVE_MUSIC_UPLOAD")
 google_drive_video_upload = os.getenv("GOOGLE_DRIVE_VIDEO_UPLOAD")
-resolutions = [137, 22, 18]
+# The local index of the Drive upload folders catches up with the Drive changes feed at most once every this many seconds.
+drive_index_refresh = get_env_number("DRIVE_INDEX_REFRESH", 60.0, float)
+# Drive uploads run on this many worker threads and are sent in resumable chunks of this many bytes (a multiple of 256 KiB).
+upload_workers = get_env_number("UPLOAD_WORKERS", 2)
+drive_chunk_size = get_env_number("DRIVE_CHUNK_SIZE", 8 * 1024 * 1024)
+# A failed chunk is retried this many times before the upload is given up.
+drive_upload_retries = get_env_number("DRIVE_UPLOAD_RETRIES", 5)
+# Byte budgets for the Drive upload folders (0 = no limit). The least recently shared files are trashed to make room for new uploads.
+drive_music_budget = get_env_number("DRIVE_MUSIC_BUDGET", 0)
+drive_video_budget = get_env_number("DRIVE_VIDEO_BUDGET", 0)
+# Preferred video formats, best first: itags (137 = 1080p H.264, 22 = 720p, 18 = 360p) or qualities such as "720p".
+resolutions = [int(value) if value.isdigit() else value for value in os.getenv("VIDEO_FORMATS", "137,22,18").replace(" ", "").split(",") if value]
+# Prefix for the per-job scratch folders created under the download folders.
+job_folder_prefix = "job_"
+
+# Number of queued download jobs run at the same time.
+job_workers = get_env_number("JOB_WORKERS", 2)
+# A job that was still running this many times when the bot stopped (e.g. because it crashes the bot) is failed instead of resumed.
+job_max_attempts = get_env_number("JOB_MAX_ATTEMPTS", 3)
+# Playlist jobs keep one progress embed, edited at most once every this many seconds to stay clear of Discord's rate limits.
+# Set PLAYLIST_ITEM_MESSAGES to also post a message for every item by default.
+progress_update_interval = get_env_number("PROGRESS_UPDATE_INTERVAL", 5.0, float)
+playlist_item_messages = os.getenv("PLAYLIST_ITEM_MESSAGES", "false").lower() in ("1", "true", "yes")
+# Largest upload in bytes Discord accepts in one message outside a guild (guilds report their own limit); bigger files go to Google Drive.
+discord_upload_limit = get_env_number("DISCORD_UPLOAD_LIMIT", 8000000)
+# Songs for Discord are encoded at the bitrate that fits the upload limit, but never below this many kbps (they go to Google Drive instead).
+min_target_bitrate = get_env_number("MIN_TARGET_BITRATE", 64)
+# Playlist files sent to Discord are packed up to 10 per message; a partly filled message is sent after this many seconds.
+attachment_batch_delay = get_env_number("ATTACHMENT_BATCH_DELAY", 10.0, float)
+# Playlist executor settings: how many items run at once and how often a failed item is retried.
+playlist_workers = get_env_number("PLAYLIST_WORKERS", 4)
+playlist_retries = get_env_number("PLAYLIST_RETRIES", 2)
+playlist_retry_delay = get_env_number("PLAYLIST_RETRY_DELAY", 2.0, float)
+# Pipeline settings: PLAYLIST_WORKERS sizes the download stage, these size the later stages and the queues between them.
+convert_workers = get_env_number("CONVERT_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+# Process-wide cap on ffmpeg processes across every command (half the cores by default, leaving room for Lavalink),
+# and the -threads each of them gets. With STREAM_AUDIO, an encode holds its slot while ffmpeg is still fetching the stream,
+# so slots can sit idle on a slow network; raise TRANSCODE_SLOTS for that rather than leaving streamed encodes uncapped.
+transcode_slots = get_env_number("TRANSCODE_SLOTS", max(1, (os.cpu_count() or 2) // 2))
+transcode_threads = get_env_number("TRANSCODE_THREADS", max(1, (os.cpu_count() or 2) // transcode_slots))
+deliver_workers = get_env_number("DELIVER_WORKERS", 2)
+pipeline_queue_size = get_env_number("PIPELINE_QUEUE_SIZE", 4)
+# When enabled, audio is never staged on disk: ffmpeg reads the stream URL and encodes while bytes arrive.
+stream_audio = os.getenv("STREAM_AUDIO", "false").lower() in ("1", "true", "yes")
+# Default for the Plex commands: keep YouTube's Opus/AAC audio (remuxed with stream copy) instead of transcoding to MP3.
+plex_audio_passthrough = os.getenv("PLEX_AUDIO_PASSTHROUGH", "false").lower() in ("1", "true", "yes")
+# Cover art settings: square covers suit music libraries, and covers are scaled down to at most this many pixels per side.
+square_cover_art = os.getenv("SQUARE_COVER_ART", "false").lower() in ("1", "true", "yes")
+cover_max_size = get_env_number("COVER_MAX_SIZE", 1280)
+# Cover art is cached on disk between jobs; the least recently used covers are evicted past this many bytes (0 disables the cache).
+cover_cache_folder = os.path.abspath(os.getenv("COVER_CACHE_FOLDER", "cover_cache"))
+cover_cache_max_bytes = get_env_number("COVER_CACHE_MAX_BYTES", 100 * 1024 * 1024)
+# YouTube metadata (titles, stream manifests, playlist listings) is cached in memory for this many seconds (0 disables the cache).
+# Stream URLs expire after a few hours, so keep this well below that.
+metadata_cache_ttl = get_env_number("METADATA_CACHE_TTL", 1800.0, float)
+metadata_cache_size = get_env_number("METADATA_CACHE_SIZE", 512)
+# Stream downloads are split into segments of this many bytes, fetched with Range requests over several parallel connections
+# and checkpointed, so an interrupted download (or a bot restart) resumes from the partial file kept here instead of starting over.
+partial_download_folder = os.path.abspath(os.getenv("PARTIAL_DOWNLOAD_FOLDER", "partial_downloads"))
+range_chunk_size = get_env_number("RANGE_CHUNK_SIZE", 10 * 1024 * 1024)
+download_connections = get_env_number("DOWNLOAD_CONNECTIONS", 4)
+download_retries = get_env_number("DOWNLOAD_RETRIES", 5)
+# Partial downloads untouched for this many seconds belong to downloads that failed for good and are deleted.
+partial_download_max_age = get_env_number("PARTIAL_DOWNLOAD_MAX_AGE", 24 * 60 * 60.0, float)
+# Video downloads never pick a stream taller than this many pixels, or a video + audio pair estimated at more than this many bytes (0 = no limit).
+max_video_resolution = get_env_number("MAX_VIDEO_RESOLUTION", 1080)
+max_video_size = get_env_number("MAX_VIDEO_SIZE", 0)
+# Connect/read timeout in seconds for plain HTTP requests made by the bot.
+http_timeout = get_env_number("HTTP_TIMEOUT", 15.0, float)
+# Connections kept alive by the shared HTTP session. By default there is room for every range connection that can be open at once
+# (DOWNLOAD_CONNECTIONS for each of a video's two streams, in every playlist worker of every job worker), plus one cover or page
+# request per playlist worker; connections beyond this are closed after use instead of reused.
+http_pool_size = get_env_number("HTTP_POOL_SIZE", (download_connections * 2 + 1) * playlist_workers * job_workers)
+
+
+def create_http_session(pool_size: int = http_pool_size) -> requests.Session:
+    """Returns a keep-alive session with a connection pool and retries on transient errors, shared by every job."""
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET", "HEAD"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+http_session = create_http_session()
 
 
 class IncorrectArgumentType(commands.CommandError):
@@ -56,6 +191,22 @@ class NoVideoStream(commands.CommandError):
     pass
 
 
+class FFmpegError(commands.CommandError):
+    pass
+
+
+class InvalidSetting(ValueError):
+    """Raised when a setting from the environment has a value the bot can't use."""
+
+
+class RangeRequestRejected(requests.HTTPError):
+    """Raised when a server refuses byte-range requests for a stream, so it has to be downloaded another way."""
+
+
+class DownloadCancelled(Exception):
+    """Raised when a download is stopped through its cancel event; the partial file is kept for resuming."""
+
+
 class Song:
     def __init__(self):
         self.title = ""
@@ -63,6 +214,13 @@ class Song:
         self.artist = ""
         self.path = ""
         self.youtube_name = ""
+        self.duration = 0
+        # Codec of the downloaded audio stream (e.g. "opus", "mp4a.40.2"), used by passthrough mode.
+        self.audio_codec = ""
+        # Set instead of path in streaming mode: ffmpeg reads the audio straight from this URL.
+        self.stream_url = ""
+        # Bitrate in kbps of the last mp3 encode; below 320 when it was sized to fit an upload limit.
+        self.bitrate = None
 
 
 class Video:
@@ -72,6 +230,143 @@ class Video:
         self.video_path = ""
         self.path = ""
         self.youtube_name = ""
+        self.duration = 0
+
+
+class PlaylistItem:
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.result = None
+        self.error = None
+        self.stage = ""
+        self.attempts = 0
+        # Free-form per-item state shared between stages (scratch folder, downloaded media, ...).
+        self.context = {}
+
+
+class PipelineStage:
+    def __init__(self, name: str, handler: Callable, workers: int = 1):
+        """A single pipeline stage. handler(item) is awaited by `workers` concurrent workers and its return value becomes item.result."""
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+
+
+class PlaylistExecutor:
+    # Errors that come out the same on every attempt (a bad URL, a video without a usable stream, a removed or private video),
+    # so the item fails straight away instead of being retried.
+    permanent_errors = (InvalidURL, NoVideoStream, IncorrectArgumentType, MissingArgument, RegexMatchError,
+                        pytubefix.exceptions.VideoUnavailable)
+
+    def __init__(self, workers: int = playlist_workers, retries: int = playlist_retries, retry_delay: float = playlist_retry_delay,
+                 queue_size: int = pipeline_queue_size):
+        """Runs playlist items through one or more stages joined by bounded queues, with per-item retries."""
+        self.workers = max(1, workers)
+        self.retries = max(0, retries)
+        self.retry_delay = retry_delay
+        self.queue_size = max(1, queue_size)
+
+    async def run(self, urls, stages, on_result: Callable = None, cleanup: Callable = None) -> list:
+        """
+        Runs every url (from a list or an async iterator) through stages (a list of PipelineStage, or a single handler run by `workers` workers).
+        Each stage has its own workers and hands items to the next stage through a bounded queue, so item N+1
+        can download while item N converts and item N-1 is delivered.
+        cleanup(item) is awaited as soon as an item leaves the pipeline; on_result(item) is awaited once per item
+        in playlist order. An item that fails a stage skips the remaining stages. Returns the PlaylistItems in order.
+        """
+        if callable(stages):
+            stages = [PipelineStage("process", stages, self.workers)]
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in stages]
+        # Items are queued here in playlist order as they are fed so results can be reported in that order.
+        ordered = asyncio.Queue()
+        finished = {}
+        items = []
+        loop = asyncio.get_running_loop()
+
+        async def clean(item: PlaylistItem):
+            if cleanup is not None:
+                try:
+                    await cleanup(item)
+                except Exception as e:
+                    logging.error(f"Cleanup of playlist item {item.url} failed: {e}")
+
+        async def finish(item: PlaylistItem):
+            await clean(item)
+            finished[item.index].set_result(item)
+
+        async def work(stage_index: int):
+            stage = stages[stage_index]
+            queue = queues[stage_index]
+            while True:
+                item = await queue.get()
+                try:
+                    if await self._run_stage(item, stage) and stage_index + 1 < len(stages):
+                        await queues[stage_index + 1].put(item)
+                    else:
+                        await finish(item)
+                finally:
+                    queue.task_done()
+
+        async def add(url):
+            item = PlaylistItem(len(items), url)
+            finished[item.index] = loop.create_future()
+            items.append(item)
+            ordered.put_nowait(item)
+            # Blocks while the first stage is saturated, which keeps memory and scratch space bounded.
+            await queues[0].put(item)
+
+        async def feed():
+            try:
+                # urls may be a lazy async generator, in which case items start while later pages are still loading.
+                if hasattr(urls, "__aiter__"):
+                    async for url in urls:
+                        await add(url)
+                else:
+                    for url in urls:
+                        await add(url)
+            finally:
+                ordered.put_nowait(None)
+
+        workers = [asyncio.create_task(work(stage_index)) for stage_index, stage in enumerate(stages) for _ in range(stage.workers)]
+        feeder = asyncio.create_task(feed())
+        try:
+            while (item := await ordered.get()) is not None:
+                await finished[item.index]
+                if on_result is not None:
+                    await on_result(item)
+            # Surface errors raised while enumerating the urls.
+            await feeder
+        finally:
+            feeder.cancel()
+            for worker in workers:
+                worker.cancel()
+            # When the run is cancelled (e.g. by cog_unload) or on_result fails, items are still in the pipeline;
+            # once the workers have stopped, their scratch folders are cleaned up like any finished item's.
+            await asyncio.gather(feeder, *workers, return_exceptions=True)
+            # A future cancelled along with the run belongs to an item that never finished either.
+            for item in items:
+                if not finished[item.index].done() or finished[item.index].cancelled():
+                    await clean(item)
+        return items
+
+    async def _run_stage(self, item: PlaylistItem, stage: PipelineStage) -> bool:
+        """Runs one stage for an item, retrying it up to `retries` times. Returns False if the stage kept failing."""
+        item.stage = stage.name
+        for attempt in range(1, self.retries + 2):
+            item.attempts = attempt
+            try:
+                item.result = await stage.handler(item)
+                item.error = None
+                return True
+            except Exception as e:
+                item.error = e
+                logging.warning(f"Playlist item {item.url} failed in stage '{stage.name}' on attempt {attempt}: {e}")
+                if isinstance(e, self.permanent_errors):
+                    return False
+                if attempt <= self.retries:
+                    await asyncio.sleep(self.retry_delay * attempt)
+        return False
 
 
 class RedisPublisher:
@@ -133,68 +428,470 @@ class RedisSubscriber:
             self.redis_client.close()
 
 
-class Uploader:
-    def __init__(self):
+class DriveIndex:
+    def __init__(self, drive, folder_ids: list, refresh_interval: float = drive_index_refresh):
+        """
+        Local index of the files (title, id, size, md5) in the Drive upload folders. It is built with one listing per folder,
+        then kept current from the Drive changes feed and after each upload, so existence checks are dictionary lookups.
+        """
+        self.drive = drive
+        self.folder_ids = [folder_id for folder_id in folder_ids if folder_id]
+        self.refresh_interval = refresh_interval
+        self.files = {} # folder id -> {title: record}
+        self.locations = {} # file id -> (folder id, title)
+        self.shared = {} # file id -> when the file was last uploaded or handed out, in epoch seconds
+        self.page_token = None # Where the changes feed continues from; None until the folders are listed
+        self.last_refresh = 0.0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def record(file):
+        """Returns the fields we keep for a Drive file resource."""
+        return {"title": file["title"], "id": file["id"], "size": int(file.get("fileSize") or 0), "md5": file.get("md5Checksum")}
+
+    @staticmethod
+    def modified_time(file):
+        """Returns a Drive file's modifiedDate in epoch seconds, or now if it has none."""
+        value = file.get("modifiedDate")
+        if not value:
+            return time.time()
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+    def load(self):
+        """Lists every tracked folder once and remembers where the changes feed starts."""
+        # Taken before listing, so changes made while we list are replayed rather than missed.
+        page_token = self.drive.auth.service.changes().getStartPageToken().execute()["startPageToken"]
+        with self.lock:
+            self.files = {folder_id: {} for folder_id in self.folder_ids}
+            self.locations = {}
+            self.shared = {}
+            for folder_id in self.folder_ids:
+                for file in self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(folder_id)}).GetList():
+                    self.add(folder_id, file)
+            self.page_token = page_token
+            self.last_refresh = time.monotonic()
+
+    def refresh(self, force: bool = False):
+        """Applies changes from the Drive changes feed, at most once every refresh_interval seconds unless forced."""
+        with self.lock:
+            if self.page_token is None:
+                self.load()
+                return
+            if not force and time.monotonic() - self.last_refresh < self.refresh_interval:
+                return
+            page_token = self.page_token
+            while page_token:
+                response = self.drive.auth.service.changes().list(pageToken=page_token, includeDeleted=True, maxResults=1000).execute()
+                for change in response.get("items", []):
+                    self.apply_change(change)
+                if "newStartPageToken" in response:
+                    self.page_token = response["newStartPageToken"]
+                page_token = response.get("nextPageToken")
+            self.last_refresh = time.monotonic()
+
+    def apply_change(self, change: dict):
+        """Updates the index from one changes feed entry: files can be added, renamed, moved, trashed or deleted."""
+        with self.lock:
+            self.forget(change["fileId"])
+            file = change.get("file")
+            if change.get("deleted") or file is None or file.get("labels", {}).get("trashed"):
+                return
+            for parent in file.get("parents", []):
+                if parent["id"] in self.files:
+                    self.add(parent["id"], file)
+
+    def add(self, folder_id: str, file):
+        """Records a file in a tracked folder, e.g. right after uploading it."""
+        record = self.record(file)
+        with self.lock:
+            self.files.setdefault(folder_id, {})[record["title"]] = record
+            self.locations[record["id"]] = (folder_id, record["title"])
+            # Sharing a file bumps its modifiedDate on Drive (see Uploader.touch), so the order survives a reload.
+            self.shared[record["id"]] = self.modified_time(file)
+        return record
+
+    def forget(self, file_id: str):
+        """Drops a file from the index."""
+        with self.lock:
+            folder_id, title = self.locations.pop(file_id, (None, None))
+            self.shared.pop(file_id, None)
+            folder = self.files.get(folder_id, {})
+            # Drive allows duplicate titles, so only drop the entry if it is this file.
+            if title in folder and folder[title]["id"] == file_id:
+                del folder[title]
+
+    def lookup(self, folder_id: str, title: str):
+        """Returns the record of the file called title in the folder, or None."""
+        self.refresh()
+        with self.lock:
+            return self.files.get(folder_id, {}).get(title)
+
+    def list(self, folder_id: str):
+        """Returns the records of every file in the folder."""
+        self.refresh()
+        with self.lock:
+            return list(self.files.get(folder_id, {}).values())
+
+    def touch(self, file_id: str, when: float = None):
+        """Records that a file was just shared."""
+        with self.lock:
+            if file_id in self.locations:
+                self.shared[file_id] = time.time() if when is None else when
+
+    def least_recently_shared(self, folder_id: str):
+        """Returns the records of the files in the folder, least recently shared first."""
+        records = self.list(folder_id)
+        with self.lock:
+            return sorted(records, key=lambda record: self.shared.get(record["id"], 0.0))
+
+    def find_checksum(self, folder_id: str, md5: str):
+        """Returns the record of a file in the folder with this MD5 checksum, whatever its title, or None."""
+        for record in self.list(folder_id):
+            if record["md5"] == md5:
+                return record
+        return None
+
+
+class DriveQuota:
+    def __init__(self, index: DriveIndex, trash: Callable, budgets: dict):
+        """
+        Keeps each Drive upload folder under its byte budget ({folder id: bytes}, 0 for no limit) by trashing the
+        least recently shared files before an upload that would not fit. trash(file_id) moves one file to the Drive trash.
+        """
+        self.index = index
+        self.trash = trash
+        self.budgets = budgets
+        self.reserved = collections.Counter() # folder id -> bytes of uploads still running
+        self.lock = threading.Lock()
+
+    def used(self, folder_id: str):
+        """Returns the bytes in the folder, counting uploads to it that are still running."""
+        return sum(record["size"] for record in self.index.list(folder_id)) + self.reserved[folder_id]
+
+    def make_room(self, folder_id: str, size: int):
+        """Trashes the least recently shared files in the folder until size more bytes fit in its budget. Returns the trashed records."""
+        budget = self.budgets.get(folder_id)
+        if not budget:
+            return []
+        if size > budget:
+            # Trashing everything would not make it fit, so leave the folder alone.
+            logging.warning(f"A {size} byte upload is larger than the {budget} byte budget of Drive folder {folder_id}")
+            return []
+        excess = self.used(folder_id) + size - budget
+        trashed = []
+        for record in self.index.least_recently_shared(folder_id):
+            if excess <= 0:
+                break
+            self.trash(record["id"])
+            self.index.forget(record["id"])
+            excess -= record["size"]
+            trashed.append(record)
+        return trashed
+
+    @contextlib.contextmanager
+    def reserve(self, folder_id: str, size: int):
+        """Makes room for an upload of size bytes and counts it against the folder until the upload is done."""
+        # Held while trashing, so parallel uploads can't both count on the same free space.
+        with self.lock:
+            for record in self.make_room(folder_id, size):
+                logging.info(f"Trashed {record['title']} from Google Drive to stay within the folder budget")
+            self.reserved[folder_id] += size
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.reserved[folder_id] -= size
+
+
+class UploadBackend(abc.ABC):
+    # Shown to users, e.g. "Uploaded song.mp3 to Google Drive".
+    name = "storage"
+
+    def __init__(self, music_destination, video_destination):
+        """
+        Where files too large for Discord are sent. Subclasses implement upload_file, lookup and link, and setup if they need it.
+        Destinations are whatever the backend stores files under: Drive folder IDs, directories, ...
+        """
         self.last_video_upload = ""
         self.last_music_upload = ""
+        self.music_destination = music_destination
+        self.video_destination = video_destination
+
+    def setup(self):
+        """Connects to the storage. Called once when the cog loads."""
+
+    @abc.abstractmethod
+    def upload_file(self, file_path, destination, on_progress: Callable = None):
+        """Stores a file under destination, calling on_progress(fraction) as it goes. Returns its record: title, id, size and md5."""
+
+    @abc.abstractmethod
+    def lookup(self, destination, file_name):
+        """Returns the record of the file called file_name under destination, or None."""
+
+    @abc.abstractmethod
+    def link(self, record):
+        """Returns a link users can open the stored file with."""
+
+    def check_if_file_exists_in_music_drive(self, file_name):
+        return self.lookup(self.music_destination, file_name) is not None
+
+    def check_if_file_exists_in_video_drive(self, file_name):
+        return self.lookup(self.video_destination, file_name) is not None
+
+    def upload_video(self, video_path, on_progress: Callable = None):
+        """Uploads a video. Expects an absolute path to the video file."""
+        record = self.upload_file(video_path, self.video_destination, on_progress)
+        self.last_video_upload = os.path.basename(video_path) # Store filename
+        return record
+
+    def upload_music(self, music_path, on_progress: Callable = None):
+        """Uploads music. Expects an absolute path to the music file."""
+        record = self.upload_file(music_path, self.music_destination, on_progress)
+        self.last_music_upload = os.path.basename(music_path) # Store filename
+        return record
+
+
+class Uploader(UploadBackend):
+    name = "Google Drive"
+    # Drive answers these with "try again later"; anything else (e.g. 403 for a full Drive) won't go away by retrying.
+    retry_statuses = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, chunk_size: int = drive_chunk_size, retries: int = drive_upload_retries):
+        super().__init__(google_drive_music_upload, google_drive_video_upload)
         self.gauth = GoogleAuth()
+        self.chunk_size = chunk_size
+        self.retries = retries
+        # httplib2 connections are not thread safe, so every upload thread gets its own authorised one.
+        self.local = threading.local()
 
     def setup(self):
         self.gauth.LocalWebserverAuth()
         self.drive = GoogleDrive(self.gauth)
+        # Existence checks and listings are answered from this index instead of listing the folders every time.
+        self.index = DriveIndex(self.drive, [google_drive_music_upload, google_drive_video_upload])
+        # Uploads that would take a folder over its budget first trash the least recently shared files there.
+        self.quota = DriveQuota(self.index, self.trash_file, {google_drive_music_upload: drive_music_budget,
+                                                             google_drive_video_upload: drive_video_budget})
 
     def check_drive_size(self, drive_type: str = "music"):
-        if drive_type == "music":
-            file_list = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(google_drive_music_upload)}).GetList()
-        else:
-            file_list = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(google_drive_video_upload)}).GetList()
+        folder_id = google_drive_music_upload if drive_type == "music" else google_drive_video_upload
+        file_list = self.index.list(folder_id)
         for file in file_list:
             logging.debug('title: %s, id: %s' % (file['title'], file['id']))
+        logging.debug('total size: %s, budget: %s' % (self.quota.used(folder_id), self.quota.budgets.get(folder_id) or "unlimited"))
 
-    def check_if_file_exists_in_music_drive(self, file_name):
-        file_list = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(google_drive_music_upload)}).GetList()
-        for file in file_list:
-            if file['title'] == file_name:
-                return True
-        return False
-
-    def check_if_file_exists_in_video_drive(self, file_name):
-        file_list = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(google_drive_video_upload)}).GetList()
-        for file in file_list:
-            if file['title'] == file_name:
-                return True
-        return False
+    def lookup(self, destination, file_name):
+        return self.index.lookup(destination, file_name)
 
     def list_video_drive(self):
-        file_list = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(google_drive_video_upload)}).GetList()
+        file_list = self.index.list(google_drive_video_upload)
         logging.debug("Files in video drive:")
         for file in file_list:
-            logging.debug('title: %s, id: %s, size: %s' % (file['title'], file['id'], file['fileSize']))
+            logging.debug('title: %s, id: %s, size: %s' % (file['title'], file['id'], file['size']))
 
     def list_music_drive(self):
-        file_list = self.drive.ListFile({'q': "'{}' in parents and trashed=false".format(google_drive_music_upload)}).GetList()
+        file_list = self.index.list(google_drive_music_upload)
         print("Files in music drive:")
         for file in file_list:
-            logging.debug('title: %s, id: %s, size: %s' % (file['title'], file['id'], file['fileSize']))
-
-    def upload_video(self, video_path):
-        """Uploads a video to Google Drive. Expects an absolute path to the video file."""
-        # The video_path parameter is now expected to be an absolute path to the file.
-        # The GoogleDriveFile title should probably be just the filename, not the whole path.
-        file_title = os.path.basename(video_path)
-        file1 = self.drive.CreateFile({'title': file_title, 'parents': [{'id': google_drive_video_upload}]})
-        file1.SetContentFile(video_path) # video_path is already absolute
-        file1.Upload() # Upload file.
-        self.last_video_upload = file_title # Store filename
-        
-    def upload_music(self, music_path):
-        """Uploads music to Google Drive. Expects an absolute path to the music file."""
-        # The music_path parameter is now expected to be an absolute path to the file.
-        file_title = os.path.basename(music_path)
-        file1 = self.drive.CreateFile({'title': file_title, 'parents': [{'id': google_drive_music_upload}]})
-        file1.SetContentFile(music_path) # music_path is already absolute
-        file1.Upload() # Upload file.
-        self.last_music_upload = file_title # Store filename
+            logging.debug('title: %s, id: %s, size: %s' % (file['title'], file['id'], file['size']))
+
+    def http(self):
+        """Returns the calling thread's authorised HTTP connection."""
+        http = getattr(self.local, "http", None)
+        if http is None:
+            http = self.local.http = self.gauth.Get_Http_Object()
+        return http
+
+    def trash_file(self, file_id):
+        """Moves a Drive file to the trash."""
+        self.drive.auth.service.files().trash(fileId=file_id).execute(http=self.http())
+
+    def touch(self, record):
+        """Marks a Drive file as shared just now. Its modifiedDate on Drive is bumped too, so the order survives a restart."""
+        now = time.time()
+        self.index.touch(record["id"], now)
+        modified = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).isoformat()
+        try:
+            self.drive.auth.service.files().patch(fileId=record["id"], body={"modifiedDate": modified}, setModifiedDate=True).execute(http=self.http())
+        except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+            # Only the eviction order after a restart is affected.
+            logging.warning(f"Could not update the modified date of {record['title']} on Google Drive: {e}")
+
+    @staticmethod
+    def link(record):
+        """Returns the link to view a Drive file from its index record."""
+        return f"https://drive.google.com/file/d/{record['id']}/view"
+
+    def upload_file(self, file_path, folder_id, on_progress: Callable = None):
+        """
+        Uploads a file to a Drive folder as a resumable upload sent in chunks. A failed chunk is retried with backoff,
+        continuing from the last byte Drive confirmed. on_progress(fraction) is called after every chunk.
+        If the folder already holds a file with the same bytes (under any name), nothing is uploaded.
+        Files are trashed first if needed to keep the folder within its budget. Returns the index record of the Drive file.
+        """
+        existing = self.index.find_checksum(folder_id, file_md5(file_path)) # Drive keeps the same MD5 for every file
+        if existing is not None:
+            logging.info(f"{file_path} is already on Google Drive as {existing['title']}, not uploading it again")
+            self.touch(existing)
+            if on_progress is not None:
+                on_progress(1.0)
+            return existing
+
+        with self.quota.reserve(folder_id, os.path.getsize(file_path)):
+            response = self.send_file(file_path, folder_id, on_progress)
+            return self.index.add(folder_id, response) # The response carries the id, size and md5
+
+    def send_file(self, file_path, folder_id, on_progress: Callable = None):
+        """Sends a file to a Drive folder in resumable chunks (see upload_file) and returns the Drive file resource."""
+        media = MediaFileUpload(file_path, chunksize=self.chunk_size, resumable=True)
+        # The GoogleDriveFile title should be just the filename, not the whole path.
+        request = self.drive.auth.service.files().insert(body={'title': os.path.basename(file_path), 'parents': [{'id': folder_id}]},
+                                                          media_body=media)
+        response = None
+        failures = 0
+        try:
+            while response is None:
+                try:
+                    status, response = request.next_chunk(http=self.http())
+                except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+                    if isinstance(e, HttpError) and e.resp.status not in self.retry_statuses:
+                        raise
+                    failures += 1
+                    if failures > self.retries:
+                        raise
+                    logging.warning(f"Upload of {file_path} failed ({e}), retrying chunk ({failures}/{self.retries})")
+                    time.sleep(min(2 ** failures, 30))
+                    continue
+                failures = 0
+                if status is not None and on_progress is not None:
+                    on_progress(status.progress())
+        finally:
+            media.stream().close()
+        if on_progress is not None:
+            on_progress(1.0)
+        return response
+
+
+class LocalUploader(UploadBackend):
+    name = "the file share"
+
+    def __init__(self, folder: str = local_upload_folder, base_url: str = local_upload_url):
+        """
+        Copies files into music/ and video/ under folder, e.g. an NFS mount or a directory served over HTTP at base_url.
+        folder is an absolute path.
+        """
+        super().__init__(os.path.join(folder, "music"), os.path.join(folder, "video"))
+        self.folder = folder
+        self.base_url = base_url
+
+    def setup(self):
+        os.makedirs(self.music_destination, exist_ok=True)
+        os.makedirs(self.video_destination, exist_ok=True)
+
+    def record(self, path):
+        """Returns the record of a stored file. The checksum is skipped; nothing here deduplicates on it."""
+        return {"title": os.path.basename(path), "id": path, "size": os.path.getsize(path), "md5": None}
+
+    def upload_file(self, file_path, destination, on_progress: Callable = None):
+        os.makedirs(destination, exist_ok=True)
+        target = os.path.join(destination, os.path.basename(file_path))
+        # Copied under a temporary name and renamed, so the share never serves a half-copied file.
+        temp_path = target + ".part"
+        if on_progress is None:
+            shutil.copyfile(file_path, temp_path) # Uses the kernel's copy fast path where there is one
+        else:
+            size = os.path.getsize(file_path)
+            copied = 0
+            with open(file_path, "rb") as source, open(temp_path, "wb") as handler:
+                for block in iter(lambda: source.read(1024 * 1024), b""):
+                    handler.write(block)
+                    copied += len(block)
+                    on_progress(copied / size)
+            on_progress(1.0)
+        os.replace(temp_path, target)
+        return self.record(target)
+
+    def lookup(self, destination, file_name):
+        path = os.path.join(destination, file_name)
+        return self.record(path) if os.path.isfile(path) else None
+
+    def link(self, record):
+        if not self.base_url:
+            return pathlib.Path(record["id"]).as_uri()
+        relative = os.path.relpath(record["id"], self.folder).replace(os.sep, "/")
+        return self.base_url.rstrip("/") + "/" + urllib.parse.quote(relative)
+
+
+class MemoryUploader(UploadBackend):
+    name = "memory"
+
+    def __init__(self):
+        """Keeps uploaded files in memory. Stands in for real storage in tests and when benchmarking the upload stage offline."""
+        super().__init__("music", "video")
+        self.files = {} # (destination, title) -> bytes
+        self.lock = threading.Lock()
+
+    def upload_file(self, file_path, destination, on_progress: Callable = None):
+        with open(file_path, "rb") as handler:
+            data = handler.read()
+        title = os.path.basename(file_path)
+        with self.lock:
+            self.files[(destination, title)] = data
+        if on_progress is not None:
+            on_progress(1.0)
+        return {"title": title, "id": f"{destination}/{title}", "size": len(data), "md5": hashlib.md5(data).hexdigest()}
+
+    def lookup(self, destination, file_name):
+        with self.lock:
+            data = self.files.get((destination, file_name))
+        if data is None:
+            return None
+        return {"title": file_name, "id": f"{destination}/{file_name}", "size": len(data), "md5": hashlib.md5(data).hexdigest()}
+
+    def link(self, record):
+        return f"memory://{record['id']}"
+
+
+# UPLOAD_BACKEND values and the backends they pick.
+upload_backends = {"drive": Uploader, "local": LocalUploader, "memory": MemoryUploader}
+
+
+def create_uploader(name: str = upload_backend):
+    """Returns a new upload backend called name. Raises InvalidSetting for unknown names."""
+    # No fallback to Drive: a typo would otherwise start its interactive login on a bot meant to run without one.
+    if name not in upload_backends:
+        raise InvalidSetting(f"UPLOAD_BACKEND must be one of {', '.join(upload_backends)}, not {name!r}")
+    return upload_backends[name]()
+
+
+class UploadService:
+    def __init__(self, uploader: UploadBackend, workers: int = upload_workers):
+        """Runs uploads of an upload backend on a bounded pool of worker threads, so they never block the event loop."""
+        self.uploader = uploader
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+
+    async def run(self, upload: Callable, path, on_progress: Callable = None):
+        """
+        Runs upload(path, on_progress) on the pool and returns the stored file's record.
+        on_progress is called on the event loop rather than the upload thread.
+        """
+        loop = asyncio.get_running_loop()
+        report = None
+        if on_progress is not None:
+            report = lambda fraction: loop.call_soon_threadsafe(on_progress, fraction)
+        return await loop.run_in_executor(self.pool, upload, path, report)
+
+    async def upload_music(self, music_path, on_progress: Callable = None):
+        """Uploads music. Expects an absolute path."""
+        return await self.run(self.uploader.upload_music, music_path, on_progress)
+
+    async def upload_video(self, video_path, on_progress: Callable = None):
+        """Uploads a video. Expects an absolute path."""
+        return await self.run(self.uploader.upload_video, video_path, on_progress)
+
+    def close(self):
+        """Stops the worker threads once their current uploads finish."""
+        self.pool.shutdown(wait=False)
         
 
 class LocalPathCheck:
@@ -228,6 +925,23 @@ class LocalPathCheck:
             if os.path.isfile(file_path):
                 os.remove(file_path)
 
+    # This function creates a scratch directory for a single download job so concurrent jobs never share files.
+    def create_job_folder(self, base_folder):
+        """Creates a unique per-job scratch directory under base_folder and returns its absolute path. Expects an absolute path."""
+        # base_folder is already absolute
+        self.path_exists(base_folder)
+        job_folder = tempfile.mkdtemp(prefix=job_folder_prefix, dir=base_folder)
+        logging.debug("Created job folder: " + job_folder)
+        return job_folder
+
+    # This function removes a job scratch directory and everything inside it.
+    def remove_job_folder(self, job_folder):
+        """Removes a per-job scratch directory created by create_job_folder. Expects an absolute path."""
+        # job_folder is already absolute
+        if job_folder and os.path.isdir(job_folder):
+            logging.debug("Removing job folder: " + job_folder)
+            shutil.rmtree(job_folder, ignore_errors=True)
+
     # This function checks the size of the directory and all files under it.
     # If the size of it is greater than one gigabyte, it will return true. else false.
     def check_cache(self, dir_path):
@@ -242,17 +956,26 @@ class LocalPathCheck:
         return size > 1000000000
 
     def clear_all_temp_caches(self):
-        """Clears all caches of temporary files. Assumes global folder paths are absolute."""
+        """Clears all caches of temporary files, including leftover job folders. Assumes global folder paths are absolute."""
         # Assumes download_music_folder and download_video_folder are absolute paths
         for file_name in os.listdir(download_music_folder):
             file_path = os.path.join(download_music_folder, file_name)
             if os.path.isfile(file_path):
                 os.remove(file_path)
+            elif file_name.startswith(job_folder_prefix):
+                self.remove_job_folder(file_path)
         
         for file_name in os.listdir(download_video_folder):
             file_path = os.path.join(download_video_folder, file_name)
             if os.path.isfile(file_path):
                 os.remove(file_path)
+            elif file_name.startswith(job_folder_prefix):
+                self.remove_job_folder(file_path)
+
+        # Partial downloads are only kept to resume failed jobs, so clearing the caches gives up on them too.
+        if os.path.isdir(partial_download_folder):
+            for file_name in os.listdir(partial_download_folder):
+                os.remove(os.path.join(partial_download_folder, file_name))
 
     def clear_all_converted_caches(self):
         """Clears all caches of converted files. Assumes global folder paths are absolute."""
@@ -277,12 +1000,12 @@ class LocalPathCheck:
         # media_path is already absolute. plex_music_folder must also be absolute.
         shutil.move(media_path, plex_music_folder)
 
-    def check_size_for_discord(self, media_path):
-        """Checks the size of the media file. If its larger than 8mb, it will return false else true. Expects an absolute media_path."""
+    def check_size_for_discord(self, media_path, limit: int = None):
+        """Checks the size of the media file. If its larger than the Discord upload limit, it will return true else false. Expects an absolute media_path."""
         # media_path is already absolute
         size = os.path.getsize(media_path)
-        # If size is greater than 8mbs, return true. else false.
-        return size > 8000000 # 8MB
+        # If size is greater than the upload limit (the guild's, or 8MB by default), return true. else false.
+        return size > (limit or discord_upload_limit)
     
     def clear_temp_spotify(self, folder_path):
         """Clears the specified folder of files. Assumes folder_path is absolute."""
@@ -301,51 +1024,483 @@ class LocalPathCheck:
         return None # Return None if no file is found
         
 
-class Converter:
+def file_md5(file_path, chunk_size: int = 1024 * 1024):
+    """Returns the hex MD5 of a file, read in chunks so large videos are never loaded into memory at once."""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as handler:
+        for chunk in iter(lambda: handler.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class MediaIndex:
+    spotify_pattern = re.compile(r"open\.spotify\.com/(?:intl-[a-z]+/)?track/([A-Za-z0-9]+)")
+
+    def __init__(self, db_path: str = media_index_path):
+        """Persistent index of downloaded media keyed by YouTube video ID / Spotify track ID. db_path is an absolute path."""
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        # Commands look things up from the event loop and record from worker threads, so one shared connection is guarded by a lock.
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                "media_key TEXT NOT NULL, kind TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "md5 TEXT NOT NULL, title TEXT, added_at REAL NOT NULL, PRIMARY KEY (media_key, kind, path))"
+            )
+
+    @classmethod
+    def media_key(cls, url):
+        """Returns a stable key for a YouTube or Spotify URL without touching the network, or None if it is not recognised."""
+        if not url:
+            return None
+        spotify_match = cls.spotify_pattern.search(url)
+        if spotify_match:
+            return "spotify:" + spotify_match.group(1)
+        try:
+            return "youtube:" + pytubefix.extract.video_id(url)
+        except RegexMatchError:
+            return None
+
+    def lookup(self, media_key, kind: str, folder: str = None):
+        """
+        Returns the record (dict) of an already downloaded file, preferring one inside folder.
+        Records whose file was deleted or changed size are dropped. Returns None if nothing usable is indexed.
+        """
+        if media_key is None:
+            return None
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT media_key, kind, path, size, md5, title, added_at FROM media WHERE media_key = ? AND kind = ?",
+                (media_key, kind)).fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(("media_key", "kind", "path", "size", "md5", "title", "added_at"), row))
+            if os.path.isfile(record["path"]) and os.path.getsize(record["path"]) == record["size"]:
+                records.append(record)
+            else:
+                self.remove(record["path"])
+        if not records:
+            return None
+        if folder is not None:
+            for record in records:
+                if os.path.dirname(record["path"]) == os.path.abspath(folder):
+                    return record
+        return records[0]
+
+    def add(self, media_key, kind: str, path: str, title: str = None):
+        """Records a finished file, hashing it for later integrity and duplicate checks. path is an absolute path."""
+        if media_key is None or not path or not os.path.isfile(path):
+            return None
+        record = {
+            "media_key": media_key,
+            "kind": kind,
+            "path": path,
+            "size": os.path.getsize(path),
+            "md5": file_md5(path),
+            "title": title or os.path.basename(path),
+            "added_at": time.time(),
+        }
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO media (media_key, kind, path, size, md5, title, added_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                tuple(record.values()))
+        return record
+
+    def remove(self, path: str):
+        """Forgets every record pointing at path."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM media WHERE path = ?", (path,))
+
+    def close(self):
+        """Close the SQLite connection."""
+        self.connection.close()
+
+
+class JobQueue:
+    # Job priorities, lowest first: single songs and videos someone is waiting on go ahead of queued playlist imports.
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, db_path: str = job_queue_path, max_attempts: int = job_max_attempts):
+        """Persistent queue of download jobs and the outcome of each of their playlist items. db_path is an absolute path."""
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Jobs are queued from the event loop and updated from worker threads, so one shared connection is guarded by a lock.
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, params TEXT NOT NULL, channel_id INTEGER, "
+                "status TEXT NOT NULL, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+                "priority INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            # Queues created before jobs had a priority and an attempt count get the columns added.
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+            for column in ("priority", "attempts"):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS job_items ("
+                "job_id INTEGER NOT NULL, item_index INTEGER NOT NULL, url TEXT NOT NULL, status TEXT NOT NULL, "
+                "result TEXT, error TEXT, PRIMARY KEY (job_id, item_index))"
+            )
+
+    def enqueue(self, kind: str, params: dict, channel_id: int = None, priority: int = INTERACTIVE):
+        """Adds a queued job and returns its ID. params must be JSON serialisable."""
+        now = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (kind, params, channel_id, status, created_at, updated_at, priority) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (kind, json.dumps(params), channel_id, now, now, priority))
+        return cursor.lastrowid
+
+    def claim(self):
+        """Marks the most urgent (then oldest) queued job as running and returns it as a dict, or None if nothing is queued."""
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT id, kind, params, channel_id FROM jobs WHERE status = 'queued' ORDER BY priority, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                                    (time.time(), row[0]))
+        return {"id": row[0], "kind": row[1], "params": json.loads(row[2]), "channel_id": row[3]}
+
+    def requeue_unfinished(self):
+        """
+        Queues jobs left running by a crash or restart again. Returns how many there were.
+        Jobs that have already been started max_attempts times are failed instead, so a job that crashes the bot isn't retried forever.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            abandoned = self.connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE status = 'running' AND attempts >= ?",
+                (f"Gave up after {self.max_attempts} attempts", now, self.max_attempts)).rowcount
+            cursor = self.connection.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'", (now,))
+        if abandoned:
+            logging.warning(f"Gave up on {abandoned} download job(s) that were interrupted {self.max_attempts} times.")
+        return cursor.rowcount
+
+    def finish(self, job_id: int, error: str = None):
+        """Marks a job as done, or as failed with error."""
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                                    ("failed" if error else "done", error, time.time(), job_id))
+
+    def record_item(self, job_id: int, index: int, url: str, status: str, result: str = None, error: str = None):
+        """Records the outcome ('done' or 'failed') of one playlist item of a job."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO job_items (job_id, item_index, url, status, result, error) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, index, url, status, result, error))
+
+    def finished_items(self, job_id: int):
+        """Returns {item index: (url, result)} for the items of a job that already finished successfully."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT item_index, url, result FROM job_items WHERE job_id = ? AND status = 'done'", (job_id,)).fetchall()
+        return {index: (url, result) for index, url, result in rows}
+
+    def close(self):
+        """Close the SQLite connection."""
+        self.connection.close()
+
+
+class FFmpegProgress:
     def __init__(self):
+        self.out_time = 0.0 # Seconds of output written so far
+        self.speed = 0.0 # Encode speed as a multiple of real time
+        self.percent = None # Percent done, only known when the input duration is known
+        self.done = False
+
+
+class FFmpegRunner:
+    def __init__(self, binary: str = "ffmpeg"):
+        """Runs ffmpeg as an asyncio subprocess, so encodes don't hold an executor thread while they run."""
+        self.binary = binary
+
+    async def run(self, args: list, duration: float = None, on_progress: Callable = None, input_bytes: bytes = None) -> FFmpegProgress:
+        """
+        Runs ffmpeg with args and parses its -progress output as it goes.
+        on_progress(progress) is called (and awaited if it is a coroutine function) on every progress update.
+        input_bytes, if given, is written to ffmpeg's stdin so args can read it from pipe:0.
+        Raises FFmpegError if ffmpeg exits with a non-zero code.
+        """
+        command = [self.binary, "-hide_banner", "-nostats", "-progress", "pipe:1", *args]
+        stdin = asyncio.subprocess.PIPE if input_bytes is not None else asyncio.subprocess.DEVNULL
+        process = await asyncio.create_subprocess_exec(*command, stdin=stdin,
+                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        # stderr must be drained alongside stdout or ffmpeg blocks once the pipe buffer fills.
+        stderr_tail = collections.deque(maxlen=20)
+        stderr_task = asyncio.create_task(self._read_stderr(process.stderr, stderr_tail))
+        # Kept so the task can't be garbage collected mid-write, and awaited so its errors aren't lost.
+        stdin_task = asyncio.create_task(self._write_stdin(process.stdin, input_bytes)) if input_bytes is not None else None
+        progress = FFmpegProgress()
+        try:
+            async for raw_line in process.stdout:
+                key, _, value = raw_line.decode(errors="replace").strip().partition("=")
+                if key in ("out_time_us", "out_time_ms"):
+                    # Both keys are reported in microseconds by ffmpeg; "N/A" is sent before the first frame.
+                    try:
+                        progress.out_time = max(0, int(value)) / 1000000
+                    except ValueError:
+                        continue
+                    if duration:
+                        progress.percent = min(100.0, progress.out_time / duration * 100)
+                elif key == "speed":
+                    try:
+                        progress.speed = float(value.rstrip("x"))
+                    except ValueError:
+                        pass
+                elif key == "progress":
+                    progress.done = value == "end"
+                    if on_progress is not None:
+                        result = on_progress(progress)
+                        if inspect.isawaitable(result):
+                            await result
+            if stdin_task is not None:
+                await stdin_task
+            await stderr_task
+            return_code = await process.wait()
+        except BaseException:
+            # A cancelled job, or an error from on_progress, must not leave an orphaned ffmpeg process behind.
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            for task in (stdin_task, stderr_task):
+                if task is not None:
+                    task.cancel()
+            await asyncio.gather(*(task for task in (stdin_task, stderr_task) if task is not None), return_exceptions=True)
+            raise
+        if return_code != 0:
+            raise FFmpegError(f"ffmpeg exited with code {return_code}: {' '.join(stderr_tail)}")
+        if duration:
+            progress.percent = 100.0
+        return progress
+
+    async def _write_stdin(self, stream, data: bytes):
+        """Feeds data to ffmpeg's stdin and closes it so ffmpeg sees the end of the input."""
+        try:
+            stream.write(data)
+            await stream.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited before reading everything; its exit code reports the real error.
+            pass
+        finally:
+            stream.close()
+
+    async def _read_stderr(self, stream, tail: collections.deque):
+        """Keeps the last few stderr lines for error messages."""
+        async for raw_line in stream:
+            line = raw_line.decode(errors="replace").strip()
+            if line:
+                tail.append(line)
+
+
+class TranscodeScheduler:
+    # Lower runs first: single interactive requests jump ahead of queued bulk playlist imports.
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, slots: int = transcode_slots, threads: int = transcode_threads):
+        """Limits how many ffmpeg processes run at once across the whole bot and hands free slots out by priority."""
+        self.slots = slots
+        self.threads = threads
+        self.active = 0
+        self.waiting = [] # Heap of (priority, arrival, future)
+        self.arrivals = itertools.count()
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        """Waits for a free slot; waiters of the same priority are served in arrival order."""
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed to us just as we were cancelled, so pass it on.
+                self.release()
+            raise
+
+    def release(self):
+        """Hands the slot to the most urgent waiter, or frees it."""
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done(): # Skip waiters that were cancelled
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE):
+        """Holds a slot for the body of the with block and yields the ffmpeg -threads to use."""
+        await self.acquire(priority)
+        try:
+            yield self.threads
+        finally:
+            self.release()
+
+
+# Shared by every Converter so the cap holds across commands and concurrent users.
+transcode_scheduler = TranscodeScheduler()
+
+
+class Converter:
+    # Constant bitrates LAME can encode at; it rounds anything else, possibly upwards.
+    mp3_bitrates = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+
+    def __init__(self, square_covers: bool = square_cover_art, scheduler: TranscodeScheduler = None):
         self.last_converted = ""
+        self.ffmpeg = FFmpegRunner()
+        self.square_covers = square_covers
+        self.scheduler = scheduler or transcode_scheduler
+
+    async def run_ffmpeg(self, args: list, duration: float = None, on_progress: Callable = None, input_bytes: bytes = None,
+                         priority: int = TranscodeScheduler.INTERACTIVE):
+        """
+        Runs ffmpeg once the scheduler has a slot free, with -threads sized to the slot. The last arg must be the output path.
+        Streamed inputs (STREAM_AUDIO) are fetched inside the slot too, since ffmpeg downloads and encodes in one process.
+        """
+        async with self.scheduler.slot(priority) as threads:
+            args = [*args[:-1], "-threads", str(threads), args[-1]]
+            return await self.ffmpeg.run(args, duration, on_progress, input_bytes)
+
+    def bitrate_for_size(self, duration: float, max_bytes: int, reserved_bytes: int = 0):
+        """
+        Returns the highest mp3 bitrate (kbps, at most 320) at which duration seconds of audio plus reserved_bytes of tags fit in max_bytes.
+        Returns 320 if there is no limit or duration, or if fitting would need less than min_target_bitrate.
+        """
+        if not max_bytes or not duration:
+            return 320
+        # 2% margin for frame headers and rounding.
+        budget_kbps = (max_bytes - reserved_bytes - 16 * 1024) * 8 * 0.98 / duration / 1000
+        fitting = [bitrate for bitrate in self.mp3_bitrates if bitrate <= budget_kbps and bitrate >= min_target_bitrate]
+        return fitting[-1] if fitting else 320
 
     # This function converts any media file to an mp3.
-    def convert_to_mp3(self, song: Song, output_folder): # Removed relative, default path
-        """Converts a song from .webm to mp3. output_folder is an absolute path."""
+    async def convert_to_mp3(self, song: Song, output_folder, on_progress: Callable = None, priority: int = TranscodeScheduler.INTERACTIVE,
+                             max_bytes: int = None): # Removed relative, default path
+        """
+        Converts a song from .webm to mp3. output_folder is an absolute path. on_progress receives FFmpegProgress updates.
+        priority is a TranscodeScheduler priority; bulk imports pass BULK.
+        max_bytes encodes once at the bitrate that keeps the file under that size (e.g. the Discord upload limit); song.bitrate records what was used.
+        """
         # Error checking in case downloader runs into an error.
         if not isinstance(song, Song):
             raise IncorrectArgumentType
 
         # Error checking in case the path doesnt exist inside the dictionary
-        if not song.path: # song.path should be absolute if set by downloader
+        if not song.path and not song.stream_url: # song.path should be absolute if set by downloader
             raise MissingArgument
 
-        video_file = song.path # Assumed absolute
-        mp3_name = song.youtube_name.replace("|","-").replace("\""," ").replace(":", " ").replace("/","") + ".mp3"
+        input_args = self.audio_input_args(song)
+
+        # The cover is cropped in memory and handed to ffmpeg through stdin, so nothing is written to disk for it.
+        cover = None
+        if song.thumbnail: # song.thumbnail path should be absolute
+            cover = await asyncio.to_thread(self.crop_thumbnail, song.thumbnail, None, self.square_covers)
+
+        song.bitrate = self.bitrate_for_size(song.duration, max_bytes, len(cover or b""))
+        bitrate = f"{song.bitrate}k"
+
+        # Reduced-bitrate copies get their own name so they never overwrite the full quality file of the same song.
+        mp3_name = self.output_name(song) + (".mp3" if song.bitrate == 320 else f" ({bitrate}).mp3")
 
         # output_folder is now an absolute path
         path = os.path.join(output_folder, mp3_name)
-            
-        # Assuming download_music_folder is an absolute path global variable
-        # The first argument to crop_thumbnail (song.thumbnail) is a path, should be absolute
-        # The second argument (output_folder for crop_thumbnail) also needs to be absolute.
-        # If cropped thumbnail is temporary, its output folder should be handled carefully.
-        # For now, let's assume download_music_folder is the place for temporary cropped images.
-        if song.thumbnail: # song.thumbnail path should be absolute
-            song.thumbnail = self.crop_thumbnail(song.thumbnail, download_music_folder) # download_music_folder must be absolute
 
         # Check if extras was ticked by checking if dictionary key was set.
+        stdin_cover = None
         if song.artist is not None:
-            if song.thumbnail: # song.thumbnail is now an absolute path
-                subprocess.call(["ffmpeg", "-y", "-i", video_file,"-i", song.thumbnail, "-metadata", "artist=" + song.artist.strip(), "-metadata", "title=" + song.title.strip(), 
-                                 "-map", "0:a", "-map", "1:0", "-c:1", "copy", "-b:a", "320k", "-ar", "48000", "-y", "-id3v2_version", "3", path])
+            if cover:
+                stdin_cover = cover
+                args = ["-y", *input_args, "-f", "jpeg_pipe", "-i", "pipe:0", "-metadata", "artist=" + song.artist.strip(), "-metadata", "title=" + song.title.strip(), 
+                        "-map", "0:a", "-map", "1:0", "-c:1", "copy", "-b:a", bitrate, "-ar", "48000", "-y", "-id3v2_version", "3", path]
             else:
-                subprocess.call(["ffmpeg", "-y", "-i", video_file, "-metadata", "artist=" + song.artist.strip(), "-metadata", "title=" + song.title.strip(), 
-                                 "-b:a", "320k", "-ar", "48000", "-y", path])
+                args = ["-y", *input_args, "-metadata", "artist=" + song.artist.strip(), "-metadata", "title=" + song.title.strip(), 
+                        "-b:a", bitrate, "-ar", "48000", "-y", path]
         else:
-            subprocess.call(["ffmpeg", "-y", "-i", video_file, "-metadata", "title=" + song.title.strip(), 
-                                 "-b:a", "320k", "-ar", "48000", "-y", path])
+            args = ["-y", *input_args, "-metadata", "title=" + song.title.strip(), 
+                    "-b:a", bitrate, "-ar", "48000", "-y", path]
+        await self.run_ffmpeg(args, song.duration, on_progress, stdin_cover, priority)
         self.last_converted = mp3_name # This should be just the name, not the full path.
         return path # Returns absolute path
 
-    def combine_video_and_audio(self, video: Video, output_folder): # Removed relative, default path
-        """Combines a video and audio file into a mp4. output_folder is an absolute path."""
+    # This function copies the source audio into a proper container without re-encoding it.
+    async def remux_audio(self, song: Song, output_folder, on_progress: Callable = None, priority: int = TranscodeScheduler.INTERACTIVE):
+        """
+        Remuxes a song's Opus/AAC audio into .opus/.m4a with stream copy, then writes tags and cover art.
+        Falls back to convert_to_mp3 for any other codec. output_folder is an absolute path.
+        """
+        if not isinstance(song, Song):
+            raise IncorrectArgumentType
+
+        if not song.path and not song.stream_url:
+            raise MissingArgument
+
+        codec = song.audio_codec.lower()
+        if codec.startswith("opus"):
+            extension = ".opus" # Ogg container, which Plex plays natively
+        elif codec.startswith("mp4a"):
+            extension = ".m4a"
+        else:
+            logging.info(f"No passthrough container for codec '{song.audio_codec}', converting to mp3 instead.")
+            return await self.convert_to_mp3(song, output_folder, on_progress, priority)
+
+        file_name = self.output_name(song) + extension
+        path = os.path.join(output_folder, file_name)
+        # -vn drops any embedded video track; the audio packets are copied untouched, so no transcoding happens.
+        await self.run_ffmpeg(["-y", *self.audio_input_args(song), "-map", "0:a:0", "-vn", "-c:a", "copy", path], song.duration, on_progress, priority=priority)
+
+        cover = None
+        if song.thumbnail:
+            cover = await asyncio.to_thread(self.crop_thumbnail, song.thumbnail, None, self.square_covers)
+        await asyncio.to_thread(self.tag_audio_file, path, song, cover)
+
+        self.last_converted = file_name
+        return path # Returns absolute path
+
+    def tag_audio_file(self, path, song: Song, cover: bytes = None):
+        """Writes title, artist and JPEG cover art into an .opus or .m4a file. path is an absolute path."""
+        if path.endswith(".m4a"):
+            audio = MP4(path)
+            audio["\xa9nam"] = [song.title.strip()]
+            if song.artist:
+                audio["\xa9ART"] = [song.artist.strip()]
+            if cover:
+                audio["covr"] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+        else:
+            audio = OggOpus(path)
+            audio["title"] = [song.title.strip()]
+            if song.artist:
+                audio["artist"] = [song.artist.strip()]
+            if cover:
+                # Ogg has no attached-picture stream; covers are stored as a base64 FLAC picture block.
+                picture = Picture()
+                picture.type = 3 # Front cover
+                picture.mime = "image/jpeg"
+                picture.data = cover
+                audio["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
+        audio.save()
+
+    def output_name(self, song: Song):
+        """Returns the song's YouTube title with characters that are invalid in file names removed."""
+        return song.youtube_name.replace("|","-").replace("\""," ").replace(":", " ").replace("/","")
+
+    def audio_input_args(self, song: Song):
+        """Returns the ffmpeg input arguments for a song: its local file, or its stream URL in streaming mode."""
+        if song.path:
+            return ["-i", song.path] # Assumed absolute
+        # Reading the URL directly lets encoding start while bytes are still arriving, with no staging file.
+        # The reconnect flags resume the HTTP read if YouTube drops the connection mid-stream.
+        return ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5", "-i", song.stream_url]
+
+    async def combine_video_and_audio(self, video: Video, output_folder, on_progress: Callable = None, priority: int = TranscodeScheduler.INTERACTIVE): # Removed relative, default path
+        """Combines a video and audio file into a mp4. output_folder is an absolute path. on_progress receives FFmpegProgress updates."""
         # if not isinstance(video, Video):
         #     raise IncorrectArgumentType
 
@@ -359,57 +1514,456 @@ class Converter:
         output_file_path = os.path.join(output_folder, video.title + ".mp4")
 
         # Combine audio and video.
-        subprocess.call(["ffmpeg", "-y", "-i", video.video_path, "-i", video.audio_path, "-c:v", "copy", output_file_path])
+        await self.run_ffmpeg(["-y", "-i", video.video_path, "-i", video.audio_path, "-c:v", "copy", output_file_path], video.duration, on_progress, priority=priority)
 
         self.last_converted = video.title + ".mp4" # This should be just the name.
         video.path = output_file_path # video.path is now absolute
         return video.path # Returns absolute path
 
-    def crop_thumbnail(self, thumbnail_path, output_folder): # Removed relative, default path
-        """Crops the thumbnail from the YouTube video. thumbnail_path and output_folder are absolute paths."""
-        img = Image.open(thumbnail_path) # thumbnail_path is absolute
-        
-        width, height = img.width, img.height
-        
-        # print(width, height) # Consider removing debug prints
-        
-        ratio = width / height
-        
-        # print(ratio) # Consider removing debug prints
-        
-        # output_folder is now an absolute path
+    def crop_thumbnail(self, thumbnail_path, output_folder=None, square: bool = False, max_size: int = cover_max_size):
+        """
+        Crops the thumbnail from the YouTube video to 16:9 (or a centred square), scales it down to max_size and
+        encodes it as JPEG, all in process with Pillow. thumbnail_path is absolute.
+        Returns the JPEG bytes, or writes new_cover.jpeg into output_folder (absolute) and returns its path if one is given.
+        """
+        with Image.open(thumbnail_path) as img: # thumbnail_path is absolute
+            img = img.convert("RGB")
+            width, height = img.width, img.height
+
+            if square:
+                # Centre a square on the image, which is what music players expect for album art.
+                side = min(width, height)
+                box = ((width - side) // 2, (height - side) // 2, (width - side) // 2 + side, (height - side) // 2 + side)
+            elif width / height > 16 / 9:
+                # Too wide, trim the sides
+                new_width = int(height * 16 / 9)
+                diff = (width - new_width) // 2
+                box = (diff, 0, diff + new_width, height)
+            else:
+                # Too tall (e.g. letterboxed 4:3 thumbnails), trim the top and bottom
+                new_height = int(width * 9 / 16)
+                diff = (height - new_height) // 2
+                box = (0, diff, width, diff + new_height)
+
+            cropped = img.crop(box)
+            if max_size:
+                cropped.thumbnail((max_size, max_size), Image.LANCZOS)
+
+            buffer = io.BytesIO()
+            cropped.save(buffer, format="JPEG", quality=90)
+
+        if output_folder is None:
+            return buffer.getvalue()
+
+        # output_folder is an absolute path
         output_thumbnail_path = os.path.join(output_folder, "new_cover.jpeg")
+        with open(output_thumbnail_path, 'wb') as handler:
+            handler.write(buffer.getvalue())
+        return output_thumbnail_path # Returns absolute path
+
+class CoverCache:
+    def __init__(self, folder: str = cover_cache_folder, max_bytes: int = cover_cache_max_bytes, session: requests.Session = None):
+        """Size-bounded on-disk LRU cache of thumbnails keyed by video ID (or URL). folder is an absolute path."""
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.session = session or http_session
+        self.lock = threading.Lock()
 
-        if ratio > 1:
-            # width is bigger
-            unit = width / 16
-            new_height = 9 * unit
-            diff = (height - new_height) / 2
-            crop_call = "crop={}:{}:0:{}".format(int(width), int(new_height), int(diff))
-            subprocess.call(["ffmpeg", "-y", "-i", thumbnail_path, "-vf", crop_call, "-c:a", "copy", output_thumbnail_path])
+    def cache_path(self, thumb_url, video_id=None):
+        """Returns where the cover for this video/URL lives in the cache."""
+        key = video_id or hashlib.sha1(thumb_url.encode()).hexdigest()
+        return os.path.join(self.folder, key + ".jpeg")
+
+    def get(self, thumb_url, video_id=None, copy_to: str = None):
+        """
+        Returns the path of the cached cover, fetching it over the shared session on a miss.
+        With copy_to (e.g. a file in a job folder) the cover is copied there and that path is returned instead,
+        so evicting it from the cache later can't pull it out from under the job.
+        """
+        path = self.cache_path(thumb_url, video_id)
+        # evict() holds the lock too, so a cover can't be removed between finding and copying it.
+        with self.lock:
+            if os.path.isfile(path):
+                # Touch the file so its mtime records the last use for LRU eviction.
+                os.utime(path)
+                return self.copy(path, copy_to)
+
+        response = self.session.get(thumb_url, timeout=http_timeout)
+        response.raise_for_status()
+        os.makedirs(self.folder, exist_ok=True)
+        # Write to a temporary name first so a concurrent job never reads a half-written cover.
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as handler:
+            handler.write(response.content)
+        with self.lock:
+            os.replace(temp_path, path)
+            result = self.copy(path, copy_to)
+        self.evict(keep=path)
+        return result
+
+    def copy(self, path, copy_to: str = None):
+        """Copies a cached cover to copy_to and returns that path, or returns the cached path without copy_to."""
+        if copy_to is None:
+            return path
+        shutil.copyfile(path, copy_to)
+        return copy_to
+
+    def evict(self, keep: str = None):
+        """Removes the least recently used covers until the cache is within max_bytes."""
+        with self.lock:
+            entries = []
+            for file_name in os.listdir(self.folder):
+                file_path = os.path.join(self.folder, file_name)
+                if file_name.endswith(".jpeg") and os.path.isfile(file_path):
+                    stat = os.stat(file_path)
+                    entries.append((stat.st_mtime, stat.st_size, file_path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, file_path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if file_path == keep:
+                    continue
+                try:
+                    os.remove(file_path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+class ResumableDownloader:
+    # Downloads sharing a partial file (the same stream fetched by two jobs, or twice in one playlist) take turns on it.
+    # Shared by every instance, since they all use the same folder: (folder, key) -> {"lock", "users", "output"}.
+    claims = {}
+    claims_lock = threading.Lock()
+
+    def __init__(self, folder: str = partial_download_folder, chunk_size: int = range_chunk_size, retries: int = download_retries,
+                 connections: int = download_connections, session: requests.Session = None, max_age: float = partial_download_max_age):
+        """Downloads files with HTTP Range requests into .part files checkpointed by a .json sidecar. folder is an absolute path."""
+        self.folder = folder
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.retries = retries
+        # Segments are fetched over this many parallel connections, since YouTube throttles each connection separately.
+        self.connections = connections
+        self.session = session or http_session
+
+    def part_paths(self, key):
+        """Returns the partial file and progress sidecar paths for a download key."""
+        base = os.path.join(self.folder, key)
+        return base + ".part", base + ".part.json"
+
+    def load_checkpoint(self, sidecar_path, size):
+        """Returns {segment index: bytes written} for the partial file, or None if it can't be trusted."""
+        try:
+            with open(sidecar_path) as handler:
+                checkpoint = json.load(handler)
+        except (OSError, ValueError):
+            return None
+        # A different size means the partial file belongs to a different version of the stream,
+        # and a different segment size means the recorded segments no longer line up.
+        if checkpoint.get("size") != size or checkpoint.get("chunk_size") != self.chunk_size:
+            return None
+        return {int(index): written for index, written in checkpoint.get("segments", {}).items()}
+
+    def save_checkpoint(self, sidecar_path, size, segments):
+        """Writes the sidecar atomically so a crash never leaves a half-written checkpoint."""
+        temp_path = sidecar_path + ".tmp"
+        with open(temp_path, "w") as handler:
+            json.dump({"size": size, "chunk_size": self.chunk_size, "segments": segments}, handler)
+        os.replace(temp_path, sidecar_path)
+
+    def preallocate(self, handler, size):
+        """Reserves the full file size up front so a full disk fails now rather than 90% of the way in."""
+        try:
+            os.posix_fallocate(handler.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # Not every platform/filesystem supports fallocate; a sparse file still lets segments be written in place.
+            handler.truncate(size)
+
+    @contextlib.contextmanager
+    def claim(self, key):
+        """Holds the partial file of key exclusively; other downloads of the same key wait. Yields the key's shared record."""
+        with self.claims_lock:
+            claim = self.claims.setdefault((self.folder, key), {"lock": threading.Lock(), "users": 0, "output": None})
+            claim["users"] += 1
+        try:
+            with claim["lock"]:
+                yield claim
+        finally:
+            with self.claims_lock:
+                claim["users"] -= 1
+                if not claim["users"]:
+                    del self.claims[(self.folder, key)]
+
+    def prune(self):
+        """Deletes partial files (and their sidecars) no download has touched for max_age seconds. Returns how many were deleted."""
+        if not self.max_age or not os.path.isdir(self.folder):
+            return 0
+        with self.claims_lock:
+            claimed = {key for folder, key in self.claims if folder == self.folder}
+        removed = 0
+        cutoff = time.time() - self.max_age
+        for file_name in os.listdir(self.folder):
+            key = file_name.split(".part", 1)[0]
+            path = os.path.join(self.folder, file_name)
+            if key in claimed or ".part" not in file_name:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                # Removed or finished by a download meanwhile.
+                continue
+        return removed
+
+    def download(self, url, output_path, size: int, key: str, connections: int = None, cancel: threading.Event = None):
+        """
+        Downloads url to output_path in segments over parallel connections, resuming an earlier partial download with the same key.
+        A download of a key that is already being downloaded waits for it, then copies its file if it is still there.
+        Setting cancel stops the download at the next chunk with DownloadCancelled.
+        """
+        with self.claim(key) as claim:
+            finished = claim["output"]
+            if finished and finished != output_path and os.path.isfile(finished) and os.path.getsize(finished) == size:
+                shutil.copyfile(finished, output_path)
+                return output_path
+            self.download_claimed(url, output_path, size, key, connections, cancel)
+            claim["output"] = output_path
+            return output_path
+
+    def download_claimed(self, url, output_path, size: int, key: str, connections: int = None, cancel: threading.Event = None):
+        """Does the work of download() while the key is claimed."""
+        os.makedirs(self.folder, exist_ok=True)
+        part_path, sidecar_path = self.part_paths(key)
+        segments = self.load_checkpoint(sidecar_path, size) if os.path.isfile(part_path) else None
+        if segments is None:
+            segments = {}
+            with open(part_path, "wb") as handler:
+                self.preallocate(handler, size)
+            self.save_checkpoint(sidecar_path, size, segments)
+
+        pending = [index for index in range(-(-size // self.chunk_size)) if segments.get(index, 0) < self.segment_length(index, size)]
+        lock = threading.Lock()
+        # The connections stop when any of them fails, or when the caller cancels the download.
+        failed = cancel or threading.Event()
+
+        def fetch(index):
+            # Each connection has its own file handle and writes its segment in place.
+            try:
+                with open(part_path, "r+b") as handler:
+                    self.fetch_segment(url, handler, index, size, segments, lock, failed, sidecar_path)
+            except BaseException:
+                # The other connections checkpoint what they have and stop.
+                failed.set()
+                raise
+
+        connections = min(connections or self.connections, len(pending))
+        if connections <= 1:
+            for index in pending:
+                fetch(index)
         else:
-            # width is smaller
-            unit = height / 9
-            new_width = 16 * unit
-            diff = (width - new_width) / 2
-            crop_call = "crop={}:{}:{}:0".format(int(new_width), int(height), int(diff))
-            subprocess.call(["ffmpeg", "-y", "-i", thumbnail_path, "-vf", crop_call, "-c:a", "copy", output_thumbnail_path])
+            with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+                # list() re-raises the error of a segment that ran out of retries.
+                list(pool.map(fetch, pending))
+        if failed.is_set():
+            raise DownloadCancelled(key)
+
+        # The job folder may be on another filesystem, so move rather than rename.
+        shutil.move(part_path, output_path)
+        os.remove(sidecar_path)
+
+    def segment_length(self, index, size):
+        """Returns the number of bytes in segment index."""
+        return min(self.chunk_size, size - index * self.chunk_size)
+
+    def fetch_segment(self, url, handler, index, size, segments, lock, failed, sidecar_path):
+        """Downloads one segment, resuming it from its checkpoint and retrying dropped connections."""
+        start = index * self.chunk_size
+        length = self.segment_length(index, size)
+        written = segments.get(index, 0)
+        failures = 0
+        while written < length and not failed.is_set():
+            try:
+                with self.session.get(url, headers={"Range": f"bytes={start + written}-{start + length - 1}"}, stream=True, timeout=http_timeout) as response:
+                    # OTF streams answer range requests with 404/416; retrying won't change that.
+                    if response.status_code in (404, 416):
+                        raise RangeRequestRejected(f"{response.status_code} for a range request", response=response)
+                    response.raise_for_status()
+                    # A server that ignores the Range header sends the whole file, so skip ahead to this segment.
+                    skip = start + written if response.status_code != 206 else 0
+                    handler.seek(start + written)
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk = chunk[dropped:]
+                            skip -= dropped
+                        chunk = chunk[:length - written]
+                        handler.write(chunk)
+                        written += len(chunk)
+                        if written >= length or failed.is_set():
+                            break
+            except RangeRequestRejected:
+                raise
+            except requests.RequestException:
+                failures += 1
+                self.checkpoint(handler, sidecar_path, size, segments, lock, index, written)
+                if failures > self.retries:
+                    raise
+                time.sleep(min(2 ** failures, 30))
+                continue
+            failures = 0
+        self.checkpoint(handler, sidecar_path, size, segments, lock, index, written)
+
+    def checkpoint(self, handler, sidecar_path, size, segments, lock, index, written):
+        """Flushes a segment's bytes to disk before recording them, so the sidecar never claims data that was lost."""
+        handler.flush()
+        os.fsync(handler.fileno())
+        with lock:
+            segments[index] = written
+            self.save_checkpoint(sidecar_path, size, segments)
+
+
+class StreamSelector:
+    def __init__(self, preferences: list = None, max_resolution: int = max_video_resolution, max_size: int = max_video_size):
+        """Picks which video and audio streams to download. preferences lists itags or qualities ("720p"), best first."""
+        self.preferences = resolutions if preferences is None else preferences
+        self.max_resolution = max_resolution
+        self.max_size = max_size
+
+    def rank(self, stream):
+        """Sort key: preferred formats in preference order first, then the rest by resolution, frame rate, mp4 and bitrate."""
+        position = len(self.preferences)
+        for index, preference in enumerate(self.preferences):
+            if preference in (stream.itag, stream.resolution):
+                position = index
+                break
+        # mp4 (H.264) plays directly on more Plex clients than webm.
+        return (position, -(stream.height or 0), -(stream.fps or 0), stream.subtype != "mp4", -(stream.bitrate or 0))
+
+    def estimated_size(self, video_stream, audio_stream):
+        """Returns the expected download size in bytes; the streams' sizes come from the manifest, so nothing is fetched."""
+        return video_stream.filesize + audio_stream.filesize
+
+    def select(self, streams):
+        """Returns (video_stream, audio_stream), the best pair within the limits; video_stream is None if nothing fits."""
+        audio_streams = [stream for stream in streams if stream.includes_audio_track and not stream.includes_video_track]
+        audio_stream = max(audio_streams, key=lambda stream: stream.bitrate or 0, default=None)
+        if audio_stream is None:
+            return None, None
+
+        # Both DASH (video only) and progressive streams are candidates; combine_video_and_audio adds the best audio either way.
+        video_streams = [stream for stream in streams if stream.includes_video_track]
+        if self.max_resolution > 0:
+            video_streams = [stream for stream in video_streams if (stream.height or 0) <= self.max_resolution]
+        for video_stream in sorted(video_streams, key=self.rank):
+            if self.max_size <= 0 or self.estimated_size(video_stream, audio_stream) <= self.max_size:
+                return video_stream, audio_stream
+        return None, audio_stream
+
+
+class MetadataCache:
+    def __init__(self, ttl: float = metadata_cache_ttl, max_entries: int = metadata_cache_size):
+        """In-memory cache with a TTL and least-recently-used eviction past max_entries."""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict() # key -> (expires_at, value), oldest use first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entries past max_entries."""
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-        return output_thumbnail_path # Returns absolute path
+    def invalidate(self, key):
+        """Drops a cached value, e.g. after its stream URLs stopped working."""
+        with self.lock:
+            self.entries.pop(key, None)
 
-class Downloader:
+
+class PlaylistListing:
     def __init__(self):
+        """The urls of a playlist seen so far; complete once every page has been read."""
+        self.urls = []
+        self.complete = False
+
+
+class Downloader:
+    def __init__(self, stream: bool = stream_audio, cover_cache: CoverCache = None, metadata_cache: MetadataCache = None):
         self.last_downloaded = "" # This should store just filename, not path
+        # In streaming mode download_audio only resolves the stream URL and ffmpeg fetches the audio itself.
+        self.stream = stream
+        if cover_cache is None and cover_cache_max_bytes > 0:
+            cover_cache = CoverCache()
+        self.cover_cache = cover_cache
+        # Retries and repeated requests reuse the watch page, stream manifest and playlist pages already fetched.
+        self.metadata_cache = metadata_cache or MetadataCache()
+        self.resumable = ResumableDownloader()
+        self.stream_selector = StreamSelector()
+
+    def get_video(self, videoURL):
+        """Returns the (possibly cached) pytubefix.YouTube for a URL, keyed by video ID."""
+        key = "video:" + pytubefix.extract.video_id(videoURL) # Raises RegexMatchError for invalid URLs
+        video = self.metadata_cache.get(key)
+        if video is None:
+            # pytubefix fetches and keeps the title, thumbnail and stream manifest on first use,
+            # so caching the object caches all of them.
+            video = pytubefix.YouTube(videoURL)
+            self.metadata_cache.put(key, video)
+        return video
 
-    def download_cover(self, thumb_url, download_folder): # Removed relative, default path
+    def download_stream(self, video, stream, download_folder, filename, cancel: threading.Event = None):
+        """
+        Downloads a stream, dropping the cached metadata if it fails so a retry fetches fresh stream URLs.
+        Setting cancel stops a range download early (see ResumableDownloader.download).
+        """
+        try:
+            # OTF and SABR streams can't be fetched with range requests; pytubefix downloads them its own way.
+            if stream.is_otf or getattr(stream, "is_sabr", False):
+                stream.download(output_path=download_folder, filename=filename)
+                return
+            # Keyed by video and format, so a retry or a later request for the same stream resumes the partial file.
+            key = f"{video.video_id}_{stream.itag}"
+            try:
+                self.resumable.download(stream.url, os.path.join(download_folder, filename), stream.filesize, key, cancel=cancel)
+            except RangeRequestRejected:
+                stream.download(output_path=download_folder, filename=filename)
+        except Exception:
+            self.metadata_cache.invalidate("video:" + video.video_id)
+            raise
+
+    def download_cover(self, thumb_url, download_folder, video_id=None): # Removed relative, default path
         """Downloads a thumbnail for the song from the YouTube thumbnail. download_folder is an absolute path."""
+        # Repeated and batched downloads reuse the cached cover instead of fetching it again.
+        # The job gets its own copy, since the cached file can be evicted while the job still needs it.
+        if self.cover_cache is not None:
+            return self.cover_cache.get(thumb_url, video_id, copy_to=os.path.join(download_folder, "cover.jpeg"))
         # download_folder is now an absolute path
         output_path = os.path.join(download_folder, "cover.jpeg")
-        # Use requests to download the image.
-        img_data = requests.get(thumb_url).content
+        # Use the shared keep-alive session to download the image.
+        response = http_session.get(thumb_url, timeout=http_timeout)
+        response.raise_for_status()
         # Download it to a specific folder with a specific name.
         with open(output_path, 'wb') as handler:
-            handler.write(img_data)
+            handler.write(response.content)
         # Return download location.
         return output_path # Returns absolute path
 
@@ -417,17 +1971,23 @@ class Downloader:
         """Downloads the audio from the YouTube video. download_folder is an absolute path."""
         song = Song()
         try:
-            video = pytubefix.YouTube(videoURL)
+            video = self.get_video(videoURL)
         except pytubefix.exceptions.RegexMatchError:
             raise InvalidURL
         # 251 is the iTag for the highest quality audio.
         audio_stream = video.streams.get_audio_only()
+        song.audio_codec = audio_stream.audio_codec or ""
 
-        # download_folder is now an absolute path
-        song.path = os.path.join(download_folder, "audio.mp3")
-        audio_stream.download(output_path=download_folder, filename="audio.mp3")
+        if self.stream:
+            # Nothing is written to disk; the converter reads the audio straight from the stream URL.
+            song.stream_url = audio_stream.url
+        else:
+            # download_folder is now an absolute path
+            song.path = os.path.join(download_folder, "audio.mp3")
+            self.download_stream(video, audio_stream, download_folder, "audio.mp3")
 
         song.youtube_name = video.title # This is the video title, not filename
+        song.duration = video.length # Seconds, used for conversion progress
 
         # Add extra information to dictionary to be assigned by converter.
         if extra:
@@ -444,8 +2004,9 @@ class Downloader:
                 song.title = video.title
             try:
                 # download_folder must be absolute for download_cover
-                song.thumbnail = self.download_cover(video.thumbnail_url, download_folder)
-            except RegexMatchError or KeyError: # Fixed KeyError syntax
+                song.thumbnail = self.download_cover(video.thumbnail_url, download_folder, video.video_id)
+            except (RegexMatchError, KeyError, requests.RequestException):
+                # A missing cover shouldn't fail the whole download.
                 song.thumbnail = None
         return song
 
@@ -453,26 +2014,36 @@ class Downloader:
         """Downloads the video from the YouTube. download_folder is an absolute path."""
         mp4 = Video() # Instantiate class
         try:
-            video = pytubefix.YouTube(videoURL)
+            video = self.get_video(videoURL)
         except RegexMatchError:
             raise InvalidURL
         
-        # Download video.
-        video_stream = video.streams.get_highest_resolution()
+        # Pick the best DASH or progressive video within the resolution/size limits, plus the best audio.
+        video_stream, audio_stream = self.stream_selector.select(video.streams)
 
         if video_stream is None:
             raise NoVideoStream
 
-        audio_stream = video.streams.get_audio_only()
-
         mp4.youtube_name = video.title # This is the video title
+        mp4.duration = video.length # Seconds, used for conversion progress
 
         # download_folder is now an absolute path
         mp4.video_path = os.path.join(download_folder, "video.mp4")
         mp4.audio_path = os.path.join(download_folder, "audio.webm")
 
-        audio_stream.download(output_path=download_folder, filename="audio.webm")
-        video_stream.download(output_path=download_folder, filename="video.mp4")
+        # The two streams are independent, so fetch them at the same time; the job then takes as long as the slower one.
+        cancel = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            downloads = [
+                pool.submit(self.download_stream, video, audio_stream, download_folder, "audio.webm", cancel),
+                pool.submit(self.download_stream, video, video_stream, download_folder, "video.mp4", cancel),
+            ]
+            done, _ = concurrent.futures.wait(downloads, return_when=concurrent.futures.FIRST_EXCEPTION)
+            errors = [download.exception() for download in done if download.exception() is not None]
+            if errors:
+                # Stop the other stream at its next chunk rather than letting the pool wait for a possibly huge download.
+                cancel.set()
+                raise errors[0]
 
         # Title of video (used as part of filename later in converter)
         mp4.title = video.title.replace("|","").replace("\"","").replace(":", "").replace("/", "")
@@ -480,45 +2051,212 @@ class Downloader:
         # Return video.
         return mp4
 
-    def get_playlist(self, playlistURL, startingindex: int = None, endingindex: int = None):
-        """Returns a list of video URLs from a YouTube playlist."""
-        # Variables
-        playlist_urls = [] # Corrected variable name
-        playlist_videos = pytubefix.Playlist(playlistURL) # Corrected variable name
-
+    def playlist_url_iterator(self, playlistURL, startingindex: int = None, endingindex: int = None):
+        """Returns an iterator over a playlist's video URLs between the indexes, fetching playlist pages only as they are reached."""
         # Error checking for indexes.
-        if endingindex is None:
-            endingindex = len(playlist_videos)
-        if endingindex > len(playlist_videos): # Ensure endingindex is not out of bounds
-            endingindex = len(playlist_videos)
-        if startingindex is None:
-            startingindex = 0
-        if startingindex < 0: # Ensure startingindex is not negative
+        if startingindex is None or startingindex < 0: # Ensure startingindex is not negative
             startingindex = 0
-        if startingindex > endingindex: # Ensure start is not after end
-            startingindex = endingindex # or perhaps raise an error / handle differently
+        if endingindex is not None and endingindex < startingindex: # Ensure start is not after end
+            endingindex = startingindex
 
-        # Creates a list of YouTube URLS from the playlist.
-        # Slicing handles empty list if start >= end
-        for url in playlist_videos.video_urls[startingindex:endingindex]:
-            playlist_urls.append(url)
+        key = "playlist:" + pytubefix.extract.playlist_id(playlistURL)
+        listing = self.metadata_cache.get(key)
+        if listing is not None and (listing.complete or (endingindex is not None and endingindex <= len(listing.urls))):
+            # Every requested url has been listed before, so no playlist page is fetched.
+            return iter(listing.urls[startingindex:endingindex])
+
+        playlist_videos = pytubefix.Playlist(playlistURL) # Corrected variable name
+        # url_generator pages through the playlist lazily, so nothing past endingindex is ever requested
+        # and no len() call forces the whole playlist to load up front.
+        return itertools.islice(self.record_playlist(key, playlist_videos.url_generator()), startingindex, endingindex)
+
+    def record_playlist(self, key, urls):
+        """Passes urls through while caching them, so a later run over the same part of the playlist skips the page requests."""
+        listing = PlaylistListing()
+        self.metadata_cache.put(key, listing)
+        for url in urls:
+            listing.urls.append(url)
+            yield url
+        listing.complete = True
 
-        return playlist_urls
+    def get_playlist(self, playlistURL, startingindex: int = None, endingindex: int = None):
+        """Returns a list of video URLs from a YouTube playlist."""
+        return list(self.playlist_url_iterator(playlistURL, startingindex, endingindex))
+
+    async def iter_playlist(self, playlistURL, startingindex: int = None, endingindex: int = None):
+        """Async generator yielding a playlist's video URLs page by page, so the first items can start downloading immediately."""
+        urls = await asyncio.to_thread(self.playlist_url_iterator, playlistURL, startingindex, endingindex)
+        finished = object()
+        while True:
+            # Page requests happen inside next(), so they run in a worker thread instead of the event loop.
+            url = await asyncio.to_thread(next, urls, finished)
+            if url is finished:
+                return
+            yield url
     
     def download_spotify(self, url, output_folder): # Removed relative
         """Downloads a song from a Spotify URL. output_folder is an absolute path."""
         # output_folder is now an absolute path
         # No longer need: output_folder = os.path.join(os.getcwd(), output_folder)
 
-        current_path = os.getcwd() # Store current working directory
-        os.chdir(output_folder) # Change to target directory for spotdl
+        # spotdl writes into its working directory. cwd= sets it for the child only; os.chdir would move every thread of the bot.
         try:
-            subprocess.run(["spotdl", url], check=True) # Added check=True for error handling
+            subprocess.run(["spotdl", url], check=True, cwd=output_folder) # Added check=True for error handling
         except subprocess.CalledProcessError as e:
             print(f"Spotdl error: {e}") # Or handle more gracefully
             # Potentially re-raise or return an error status
-        finally:
-            os.chdir(current_path) # Always change back to original directory
+
+
+class ProgressReporter:
+    def __init__(self, title: str, description: str, send: Callable, interval: float = progress_update_interval):
+        """
+        Keeps a single embed with a job's done/failed/in-progress counts, throughput and ETA up to date.
+        send(embed) posts the embed and returns the message; later updates edit it at most once every interval seconds.
+        """
+        self.title = title
+        self.description = description
+        self.send = send
+        self.interval = interval
+        self.message = None
+        self.listed = 0
+        self.listing_complete = False
+        self.done = 0
+        self.failed = 0
+        self.finished = False
+        self.started = time.monotonic()
+        self.last_update = 0.0
+        self.dirty = False
+        self.pending = None # Task applying the next throttled update
+
+    async def track(self, urls):
+        """Passes urls through, counting them as they are listed; the total (and so the ETA) is known once listing ends."""
+        if hasattr(urls, "__aiter__"):
+            async for url in urls:
+                self.listed += 1
+                yield url
+        else:
+            for url in urls:
+                self.listed += 1
+                yield url
+        self.listing_complete = True
+        self.changed()
+
+    def item_finished(self, item: PlaylistItem):
+        """Counts a finished item."""
+        if item.error is not None:
+            self.failed += 1
+        else:
+            self.done += 1
+        self.changed()
+
+    def changed(self):
+        """Schedules an update of the embed unless one is already waiting."""
+        self.dirty = True
+        if self.pending is None or self.pending.done():
+            self.pending = asyncio.create_task(self.update_later())
+
+    async def update_later(self):
+        # Changes made while an edit is in flight are picked up by the next pass.
+        while self.dirty:
+            await asyncio.sleep(max(0.0, self.last_update + self.interval - time.monotonic()))
+            self.dirty = False
+            await self.update()
+
+    async def start(self):
+        """Posts the embed."""
+        await self.update()
+
+    async def finish(self):
+        """Stops throttled updates and shows the final counts."""
+        self.finished = True
+        if self.pending is not None:
+            self.pending.cancel()
+        await self.update()
+
+    async def update(self):
+        self.last_update = time.monotonic()
+        embed = self.embed()
+        try:
+            if self.message is None:
+                self.message = await self.send(embed)
+            else:
+                await self.message.edit(embed=embed)
+        except discord.DiscordException as e:
+            logging.error(f"Could not update progress for '{self.title}': {e}")
+
+    def embed(self):
+        """Builds the progress embed from the current counts."""
+        finished = self.done + self.failed
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        total = str(self.listed) if self.listing_complete else f"{self.listed}+"
+        embed = discord.Embed(title=self.title, description=self.description,
+                              color=discord.Color.green() if self.finished else discord.Color.blue())
+        embed.add_field(name="Done", value=f"{self.done}/{total}")
+        embed.add_field(name="Failed", value=str(self.failed))
+        embed.add_field(name="In progress", value=str(self.listed - finished))
+        embed.add_field(name="Throughput", value=f"{finished / elapsed * 60:.1f} items/min")
+        if not self.finished:
+            if self.listing_complete and finished:
+                eta = (self.listed - finished) * elapsed / finished
+                embed.add_field(name="ETA", value=f"{int(eta // 60)}m {int(eta % 60)}s")
+            else:
+                embed.add_field(name="ETA", value="Unknown")
+        return embed
+
+
+class AttachmentBatcher:
+    def __init__(self, send: Callable, max_files: int = 10, max_bytes: int = discord_upload_limit, delay: float = attachment_batch_delay):
+        """
+        Packs files into as few Discord messages as possible: at most max_files attachments and max_bytes in total per message.
+        send(paths) posts one message and returns something falsy if it could not. A partly filled batch is sent
+        once its first file has waited delay seconds.
+        """
+        self.send = send
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.delay = delay
+        self.paths = []
+        self.callbacks = [] # Awaited once the batch they were added with has been sent
+        self.size = 0
+        self.timer = None # Task waiting to send a partly filled batch; cleared once it starts sending
+        self.send_lock = asyncio.Lock()
+
+    async def add(self, path: str, on_sent: Callable = None):
+        """
+        Adds a file, sending the current batch first if the file would not fit in it.
+        on_sent() is awaited once the message holding the file has been sent.
+        """
+        size = os.path.getsize(path)
+        if self.paths and (len(self.paths) >= self.max_files or self.size + size > self.max_bytes):
+            await self.flush()
+        self.paths.append(path)
+        if on_sent is not None:
+            self.callbacks.append(on_sent)
+        self.size += size
+        if len(self.paths) >= self.max_files:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        # From here on the timer is sending and must not be cancelled; files added meanwhile start a new timer.
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Sends whatever is batched, after any batch that is already being sent."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # Swapped out before sending so files added meanwhile start the next batch.
+        paths, callbacks = self.paths, self.callbacks
+        self.paths, self.callbacks, self.size = [], [], 0
+        # Sends take turns, so batches arrive in order and the final flush waits for a send still in progress.
+        async with self.send_lock:
+            if paths and await self.send(paths):
+                for on_sent in callbacks:
+                    await on_sent()
 
 
 class Download(commands.Cog):
@@ -527,7 +2265,24 @@ class Download(commands.Cog):
         self.downloader = Downloader()
         self.converter = Converter()
         self.path_check = LocalPathCheck()
-        self.uploader = Uploader()
+        self.playlist_executor = PlaylistExecutor()
+        self.media_index = MediaIndex()
+        # Commands only queue jobs; background workers run them, and unfinished ones resume when the cog loads.
+        self.job_queue = JobQueue()
+        self.jobs_available = asyncio.Event()
+        self.job_tasks = []
+        self.job_handlers = {
+            "download": self.download_job,
+            "playlist": self.download_playlist_job,
+            "download_plex": self.download_plex_job,
+            "download_playlist_plex": self.download_playlist_plex_job,
+            "download_video_plex": self.download_video_plex_job,
+            "download_video_playlist_plex": self.download_video_playlist_plex_job,
+        }
+        # UPLOAD_BACKEND picks where files too large for Discord go; only Google Drive needs a login.
+        self.uploader = create_uploader()
+        # Drive uploads run on their own worker threads; jobs await them without blocking the bot.
+        self.uploads = UploadService(self.uploader)
         self.mix_publisher = RedisPublisher(channel='mix_processing')
         self.mix_finished_subscriber = RedisSubscriber(channel='mix_processing_finished')
         self.uploader.setup()
@@ -555,176 +2310,453 @@ class Download(commands.Cog):
             except Exception as e:
                 logging.error(f"Failed to send error message for Download cog: {e}")
 
+    async def cleanup_playlist_item(self, item: PlaylistItem):
+        """Removes a playlist item's scratch folder once it has left the pipeline."""
+        self.path_check.remove_job_folder(item.context.get("folder"))
+
+    def summarise_items(self, items: list):
+        """Returns a short 'N done, M failed' summary of a finished playlist run."""
+        failed = sum(1 for item in items if item.error is not None)
+        return f"{len(items) - failed} done, {failed} failed"
+
+    def find_existing_media(self, url, kind: str, folder: str = None):
+        """Returns the media index record for url if it has already been downloaded, else None."""
+        return self.media_index.lookup(self.media_index.media_key(url), kind, folder)
+
+    def fits_discord(self, record: dict, upload_limit: int):
+        """Returns True if an indexed song can be sent to Discord as it is: an mp3 within the upload limit."""
+        return record["path"].endswith(".mp3") and not self.path_check.check_size_for_discord(record["path"], upload_limit)
+
+    async def reuse_existing_media(self, record: dict, target_folder: str):
+        """Returns the path of an indexed file inside target_folder, copying it there if it currently lives elsewhere."""
+        if os.path.dirname(record["path"]) == os.path.abspath(target_folder):
+            return record["path"]
+        target_path = os.path.join(target_folder, os.path.basename(record["path"]))
+        await asyncio.to_thread(shutil.copy2, record["path"], target_path)
+        await asyncio.to_thread(self.media_index.add, record["media_key"], record["kind"], target_path, record["title"])
+        return target_path
+
+    async def record_media(self, url, kind: str, path: str):
+        """Adds a freshly produced file to the media index. Hashing runs in a thread so large files don't block the bot."""
+        try:
+            await asyncio.to_thread(self.media_index.add, self.media_index.media_key(url), kind, path)
+        except Exception as e:
+            logging.error(f"Could not add {path} to the media index: {e}")
+
+    async def cog_load(self):
+        # Jobs that were running when the bot stopped are queued again; their finished playlist items are skipped.
+        resumed = await asyncio.to_thread(self.job_queue.requeue_unfinished)
+        if resumed:
+            logging.info(f"Resuming {resumed} unfinished download job(s).")
+        self.jobs_available.set()
+        self.job_tasks = [asyncio.create_task(self.job_worker()) for _ in range(job_workers)]
+
+    async def cog_unload(self):
+        # Cancelled jobs stay marked as running, so they resume the next time the cog loads.
+        for task in self.job_tasks:
+            task.cancel()
+        await asyncio.gather(*self.job_tasks, return_exceptions=True)
+        self.job_queue.close()
+        self.uploads.close()
+
+    async def job_worker(self):
+        """Runs queued jobs one at a time until the cog is unloaded."""
+        await self.bot.wait_until_ready()
+        while True:
+            # Cleared before claiming, so a job enqueued while we look is never missed.
+            self.jobs_available.clear()
+            job = await asyncio.to_thread(self.job_queue.claim)
+            if job is None:
+                # Partial files of downloads that failed for good are cleared out whenever the queue runs dry.
+                await asyncio.to_thread(self.downloader.resumable.prune)
+                await self.jobs_available.wait()
+                continue
+            try:
+                await self.job_handlers[job["kind"]](job)
+            except Exception as e:
+                logging.error(f"Download job #{job['id']} ({job['kind']}) failed: {e}", exc_info=e)
+                await asyncio.to_thread(self.job_queue.finish, job["id"], str(e) or type(e).__name__)
+                await self.notify(job, f"Job #{job['id']} failed: {str(e) or type(e).__name__}")
+            else:
+                await asyncio.to_thread(self.job_queue.finish, job["id"])
+
+    async def enqueue_job(self, interaction: discord.Interaction, kind: str, description: str, priority: int = JobQueue.INTERACTIVE, **params):
+        """
+        Stores a job for the background workers and tells the user it is queued. Returns the job ID.
+        Playlist imports pass JobQueue.BULK so they don't hold up single downloads.
+        """
+        job_id = await asyncio.to_thread(self.job_queue.enqueue, kind, params, interaction.channel_id, priority)
+        self.jobs_available.set()
+        await interaction.followup.send(f"Queued job #{job_id}: {description}. Progress will be posted in this channel.")
+        return job_id
+
+    async def notify(self, job: dict, content: str = None, file_path: str = None, embed: discord.Embed = None, file_paths: list = None):
+        """
+        Posts a job update to the channel the command was used in. Unlike the interaction, this still works after a restart.
+        file_paths attaches several files to the one message. Returns the message, or None if it could not be sent.
+        """
+        try:
+            channel = self.bot.get_channel(job["channel_id"]) or await self.bot.fetch_channel(job["channel_id"])
+            if file_paths:
+                return await channel.send(content=content, files=[discord.File(path) for path in file_paths], embed=embed)
+            return await channel.send(content=content, file=discord.File(file_path) if file_path else None, embed=embed)
+        except (discord.DiscordException, OSError) as e:
+            logging.error(f"Could not post update for download job #{job['id']}: {e}")
+            return None
+
+    async def upload_limit(self, job: dict):
+        """Returns the largest file the job's channel accepts: its guild's filesize_limit, or the default outside guilds."""
+        try:
+            channel = self.bot.get_channel(job["channel_id"]) or await self.bot.fetch_channel(job["channel_id"])
+        except discord.DiscordException:
+            return discord_upload_limit
+        guild = getattr(channel, "guild", None)
+        return guild.filesize_limit if guild is not None else discord_upload_limit
+
+    async def upload_with_progress(self, job: dict, path: str, upload: Callable):
+        """
+        Uploads path with upload (an UploadService method) while one message shows the percentage sent,
+        edited at most once every progress_update_interval seconds. The message ends with the link to the stored file.
+        """
+        name = os.path.basename(path)
+        destination = self.uploader.name
+        message = await self.notify(job, f"Uploading {name} to {destination} as it is too large for Discord...")
+        progress = 0.0
+
+        def on_progress(fraction):
+            nonlocal progress
+            progress = fraction
+
+        async def show_progress():
+            while True:
+                await asyncio.sleep(progress_update_interval)
+                try:
+                    await message.edit(content=f"Uploading {name} to {destination} as it is too large for Discord... {progress:.0%}")
+                except discord.DiscordException as e:
+                    logging.error(f"Could not update upload progress for {name}: {e}")
+
+        ticker = asyncio.create_task(show_progress()) if message is not None else None
+        try:
+            record = await upload(path, on_progress=on_progress)
+        finally:
+            if ticker is not None:
+                ticker.cancel()
+        # The link may point to an earlier upload of the same file under another name.
+        content = f"Uploaded {name} to {destination} as it was too large for Discord: {self.uploader.link(record)}"
+        if message is None:
+            await self.notify(job, content)
+            return
+        try:
+            await message.edit(content=content)
+        except discord.DiscordException as e:
+            logging.error(f"Could not update upload progress for {name}: {e}")
+
+    async def run_playlist_job(self, job: dict, playlist_urls, stages: list, report_item: Callable, description: str):
+        """
+        Runs a playlist job through the executor, recording each item's outcome in the job queue and keeping a progress embed up to date.
+        Items a previous run of the same job already finished are skipped without being reported again.
+        """
+        finished = await asyncio.to_thread(self.job_queue.finished_items, job["id"])
+        progress = ProgressReporter(f"Job #{job['id']}", description, lambda embed: self.notify(job, embed=embed))
+        await progress.start()
+        first_stage = stages[0]
+
+        async def resume_or_run(item: PlaylistItem):
+            url, result = finished.get(item.index, (None, None))
+            if url == item.url and result and os.path.isfile(result):
+                # Later stages already short-circuit on "existing"; "resumed" also keeps the item from being delivered twice.
+                item.context["existing"] = result
+                item.context["resumed"] = True
+                return result
+            return await first_stage.handler(item)
+
+        async def record_item(item: PlaylistItem):
+            progress.item_finished(item)
+            if item.context.get("resumed"):
+                return
+            await report_item(item)
+            # report_item sets "deferred" when it delivers the item later and records it itself (see record_playlist_item).
+            if not item.context.get("deferred"):
+                await self.record_playlist_item(job, item)
+
+        stages = [PipelineStage(first_stage.name, resume_or_run, first_stage.workers), *stages[1:]]
+        try:
+            return await self.playlist_executor.run(progress.track(playlist_urls), stages, record_item, self.cleanup_playlist_item)
+        finally:
+            await progress.finish()
+
+    async def record_playlist_item(self, job: dict, item: PlaylistItem):
+        """Records a playlist item's outcome in the job queue; a resumed job skips the items recorded as done."""
+        if item.error is not None:
+            await asyncio.to_thread(self.job_queue.record_item, job["id"], item.index, item.url, "failed", error=str(item.error))
+        else:
+            await asyncio.to_thread(self.job_queue.record_item, job["id"], item.index, item.url, "done", result=item.result)
+
+    def item_messages(self, job: dict):
+        """Returns whether a playlist job posts a message for every item, on top of the progress embed."""
+        item_messages = job["params"].get("item_messages")
+        return playlist_item_messages if item_messages is None else item_messages
+
     @app_commands.command(name="download", description="Downloads a song from YouTube.")
     @app_commands.describe(song_url="The YouTube URL of the song to download.")
     async def download_command(self, interaction: discord.Interaction, song_url: str):
         await interaction.response.defer()
+        await self.enqueue_job(interaction, "download", f"downloading {song_url}", url=song_url)
+
+    async def download_job(self, job: dict):
+        song_url = job["params"]["url"]
 
         # Determine download and conversion paths
         current_download_folder = download_music_folder
         current_conversion_folder = music_conversion_folder
 
         self.path_check.path_exists(current_download_folder)
-        
-        # Clear the temporary download folder
-        self.path_check.clear_local_cache(current_download_folder)
-        
+
         if current_download_folder != current_conversion_folder: # Only create if different to avoid error
             self.path_check.path_exists(current_conversion_folder)
 
-        downloaded_song_obj = await asyncio.to_thread(self.downloader.download_audio, song_url, current_download_folder)
-        # Pass the determined conversion folder to convert_to_mp3
-        converted_song_path = await asyncio.to_thread(self.converter.convert_to_mp3, downloaded_song_obj, current_conversion_folder)
+        upload_limit = await self.upload_limit(job)
 
-        if not self.path_check.check_size_for_discord(converted_song_path):
-            await interaction.followup.send(file=discord.File(converted_song_path), content=os.path.basename(converted_song_path))
-        else:
-            # Ensure upload_music gets the correct path if conversion path differs from download
-            await self.uploader.upload_music(converted_song_path) # This is blocking, consider to_thread
-            await interaction.followup.send(f"Uploaded {os.path.basename(converted_song_path)} to Google Drive as it was too large for Discord.")
-
-        # Clear the specific download folder used for this operation
-        self.path_check.clear_local_cache(current_download_folder)
-        # If conversion folder is different and also temporary, clear it too.
-        # For now, assuming if location is provided, it's persistent or managed by user outside this clear.
-        # If current_download_folder and current_conversion_folder are derived from the default temporary folders
-        # and are different, then clear current_conversion_folder as well if it's temporary.
-        # This part needs careful consideration of what "location" implies for cleanup.
-        # If 'location' is a custom user path, we probably shouldn't clear it automatically.
-        # If 'location' is just a subfolder of the default temp, then it should be cleared.
-        # The current logic clears current_download_folder. If current_conversion_folder is different AND temporary, it should also be cleared.
-        # For simplicity, if location is provided, we are assuming it's a more permanent user-defined path, so we only clear the specific download_folder.
-        # If no location is provided, default download_music_folder is cleared.
-        # If location IS provided, current_download_folder (which might be an absolute custom path or a subpath of default) is cleared.
-        # This seems fine: we always clear where the initial download happened. The converted file is either sent or uploaded.
+        # Each job gets its own scratch folder so concurrent downloads never touch each other's files.
+        job_folder = self.path_check.create_job_folder(current_download_folder)
+        try:
+            # Songs we already have are sent straight from the media index instead of being downloaded again,
+            # unless they are too large for the guild (e.g. long 320k imports), in which case a smaller copy is encoded.
+            existing = self.find_existing_media(song_url, "audio")
+            if existing and self.fits_discord(existing, upload_limit):
+                converted_song_path = existing["path"]
+            else:
+                downloaded_song_obj = await asyncio.to_thread(self.downloader.download_audio, song_url, job_folder)
+                # Long songs are encoded once at a bitrate that fits the guild's upload limit, so they still go straight to Discord.
+                converted_song_path = await self.converter.convert_to_mp3(downloaded_song_obj, current_conversion_folder, max_bytes=upload_limit)
+                # Reduced-bitrate copies are only for Discord; indexing them would let Plex reuse the lower quality file.
+                if downloaded_song_obj.bitrate == 320:
+                    await self.record_media(song_url, "audio", converted_song_path)
+
+            if not self.path_check.check_size_for_discord(converted_song_path, upload_limit):
+                await self.notify(job, os.path.basename(converted_song_path), converted_song_path)
+            else:
+                # Ensure upload_music gets the correct path if conversion path differs from download
+                await self.upload_with_progress(job, converted_song_path, self.uploads.upload_music)
+        finally:
+            # Only this job's scratch folder is removed; other jobs running in parallel are left alone.
+            self.path_check.remove_job_folder(job_folder)
 
     @app_commands.command(name="playlist", description="Downloads a playlist of songs from YouTube.")
     @app_commands.describe(playlist_url="The YouTube URL of the playlist to download.")
-    async def download_playlist_command(self, interaction: discord.Interaction, playlist_url: str):
+    @app_commands.describe(item_messages="Post a message for every error and Google Drive upload, not just the progress embed.")
+    async def download_playlist_command(self, interaction: discord.Interaction, playlist_url: str, item_messages: bool = None):
         await interaction.response.defer()
+        await self.enqueue_job(interaction, "playlist", f"downloading playlist {playlist_url}", priority=JobQueue.BULK,
+                               url=playlist_url, item_messages=item_messages)
+
+    async def download_playlist_job(self, job: dict):
+        playlist_url = job["params"]["url"]
 
         current_download_folder = download_music_folder
         current_conversion_folder = music_conversion_folder
 
         self.path_check.path_exists(current_download_folder)
-        
-        # Clear the temporary download folder
-        self.path_check.clear_local_cache(current_download_folder)
-        
+
         if current_download_folder != current_conversion_folder:
             self.path_check.path_exists(current_conversion_folder)
 
-        playlist_urls = self.downloader.get_playlist(playlist_url)
-        if not playlist_urls:
-            await interaction.followup.send("Could not retrieve playlist or playlist is empty.")
+        # Playlist pages are fetched lazily while the first songs are already downloading.
+        playlist_urls = self.downloader.iter_playlist(playlist_url)
+        item_messages = self.item_messages(job)
+        upload_limit = await self.upload_limit(job)
+        # Finished songs are sent up to 10 per message, which cuts API calls (and rate limit waits) for large playlists.
+        batcher = AttachmentBatcher(lambda paths: self.notify(job, "\n".join(os.path.basename(path) for path in paths), file_paths=paths),
+                                    max_bytes=upload_limit)
+
+        async def download_item(item: PlaylistItem):
+            # Already downloaded songs only cost an index lookup and skip the download and convert work,
+            # as long as they can be sent to the guild as they are.
+            existing = self.find_existing_media(item.url, "audio")
+            if existing and self.fits_discord(existing, upload_limit):
+                item.context["existing"] = existing["path"]
+                return existing["path"]
+            # Every item gets its own scratch folder, removed once the item leaves the pipeline.
+            job_folder = item.context.get("folder") or self.path_check.create_job_folder(current_download_folder)
+            item.context["folder"] = job_folder
+            # Download to the item's scratch folder
+            return await asyncio.to_thread(self.downloader.download_audio, item.url, job_folder)
+
+        async def convert_item(item: PlaylistItem):
+            if "existing" in item.context:
+                return item.context["existing"]
+            # Convert in the determined conversion folder, at a bitrate that fits the guild's upload limit
+            converted_song_path = await self.converter.convert_to_mp3(item.result, current_conversion_folder, priority=TranscodeScheduler.BULK,
+                                                                      max_bytes=upload_limit)
+            # Reduced-bitrate copies are only for Discord; indexing them would let Plex reuse the lower quality file.
+            if item.result.bitrate == 320:
+                await self.record_media(item.url, "audio", converted_song_path)
+            return converted_song_path
+
+        async def deliver_item(item: PlaylistItem):
+            # Songs delivered before a restart are not uploaded again.
+            if item.context.get("resumed"):
+                return item.result
+            # Files too large for Discord go to Google Drive here; small files are batched in playlist order by report_item.
+            converted_song_path = item.result
+            if self.path_check.check_size_for_discord(converted_song_path, upload_limit):
+                record = await self.uploads.upload_music(converted_song_path)
+                item.context["uploaded"] = self.uploader.link(record)
+            return converted_song_path
+
+        async def report_item(item: PlaylistItem):
+            # The songs themselves are always sent; errors and uploads are only counted in the progress embed unless asked for.
+            if item.error is not None:
+                if item_messages:
+                    await self.notify(job, f"Error downloading song {item.url}: {item.error}")
+            elif item.context.get("uploaded"):
+                if item_messages:
+                    await self.notify(job, f"Uploaded {os.path.basename(item.result)} to {self.uploader.name} (too large): {item.context['uploaded']}")
+            else:
+                # Only recorded as done once its batch is sent, so a restart before then sends the song again instead of losing it.
+                item.context["deferred"] = True
+                await batcher.add(item.result, on_sent=lambda: self.record_playlist_item(job, item))
+
+        stages = [
+            PipelineStage("download", download_item, playlist_workers),
+            PipelineStage("convert", convert_item, convert_workers),
+            PipelineStage("deliver", deliver_item, deliver_workers),
+        ]
+        try:
+            items = await self.run_playlist_job(job, playlist_urls, stages, report_item, f"Downloading songs from {playlist_url}")
+        finally:
+            # Send the last, partly filled batch (also if the job stopped early, so finished songs aren't lost).
+            await batcher.flush()
+        if not items:
+            await self.notify(job, "Could not retrieve playlist or playlist is empty.")
             return
-
-        await interaction.followup.send(f"Found {len(playlist_urls)} songs in playlist.")
-        for item_url in playlist_urls:
-            try:
-                # Download to the determined download folder
-                downloaded_song_obj = await asyncio.to_thread(self.downloader.download_audio, item_url, current_download_folder)
-                # Convert in the determined conversion folder
-                converted_song_path = await asyncio.to_thread(self.converter.convert_to_mp3, downloaded_song_obj, current_conversion_folder)
-
-                if not self.path_check.check_size_for_discord(converted_song_path):
-                    await interaction.followup.send(file=discord.File(converted_song_path), content=os.path.basename(converted_song_path))
-                else:
-                    await self.uploader.upload_music(converted_song_path) # Blocking
-                    await interaction.followup.send(f"Uploaded {os.path.basename(converted_song_path)} to Google Drive (too large).")
-
-                # Clear the specific download folder used for this item
-                # If using a custom location, this will clear that custom location after each song.
-                # This might not be desired if the custom location is meant to be persistent.
-                # Consider clearing only if it's a subfolder of the default temp, or not clearing at all if location is set.
-                # For now, maintaining consistency with single download: clear the folder where download happened.
-                self.path_check.clear_local_cache(current_download_folder)
-                # If current_conversion_folder is different and temporary, it should also be cleared.
-                # As with single download, if 'location' is custom, we assume user manages it.
-                # If no location, default download_music_folder is cleared (which is current_download_folder).
-            except Exception as e:
-                await interaction.followup.send(f"Error downloading song {item_url}: {e}")
-            await asyncio.sleep(1)
-        await interaction.followup.send("Finished downloading playlist.")
+        await self.notify(job, f"Finished downloading playlist ({self.summarise_items(items)}).")
+
+    def plex_folder(self, library_folder: str, location: str = None):
+        """Returns the Plex folder for an optional location: absolute locations are used as is, relative ones are joined to the library."""
+        if not location:
+            return library_folder
+        if os.path.isabs(location):
+            # If absolute, use it directly. This might be useful for mounting different Plex libraries or specific drives.
+            return location
+        # If relative, join with the default Plex folder.
+        return os.path.join(library_folder, location)
 
     @app_commands.command(name="download_plex", description="Downloads a song from YouTube to Plex.")
     @app_commands.describe(song_url="The YouTube URL of the song for Plex.")
     @app_commands.describe(location="Optional subfolder within Plex music library.")
-    async def download_plex_command(self, interaction: discord.Interaction, song_url: str, location: str = None):
+    @app_commands.describe(passthrough="Keep YouTube's original Opus/AAC audio instead of re-encoding to MP3.")
+    async def download_plex_command(self, interaction: discord.Interaction, song_url: str, location: str = None, passthrough: bool = None):
         await interaction.response.defer()
-        
-        # Clear the temporary download folder
-        self.path_check.clear_local_cache(download_music_folder)
 
-        plex_target_folder = plex_music_folder
-        if location:
-            if os.path.isabs(location):
-                # If absolute, use it directly. This might be useful for mounting different Plex libraries or specific drives.
-                plex_target_folder = location
-            else:
-                # If relative, join with the default Plex music folder.
-                plex_target_folder = os.path.join(plex_music_folder, location)
+        if passthrough is None:
+            passthrough = plex_audio_passthrough
+        plex_target_folder = self.plex_folder(plex_music_folder, location)
+        await self.enqueue_job(interaction, "download_plex", f"downloading {song_url} to Plex server at '{plex_target_folder}'",
+                               url=song_url, folder=plex_target_folder, passthrough=passthrough)
 
-        await interaction.followup.send(f"Starting download of {song_url} to Plex server at '{plex_target_folder}'.")
+    async def download_plex_job(self, job: dict):
+        song_url = job["params"]["url"]
+        plex_target_folder = job["params"]["folder"]
+        # Passthrough remuxes with stream copy, which avoids the MP3 transcode entirely.
+        convert = self.converter.remux_audio if job["params"]["passthrough"] else self.converter.convert_to_mp3
+
+        await self.notify(job, f"Starting download of {song_url} to Plex server at '{plex_target_folder}'.")
 
         # Ensure the temporary download folder exists
         self.path_check.path_exists(download_music_folder)
         # Ensure the final Plex target folder exists
         self.path_check.path_exists(plex_target_folder)
 
-        # Initial download always goes to the temporary download_music_folder
-        downloaded_song_obj = await asyncio.to_thread(self.downloader.download_audio, song_url, download_music_folder)
-        # Conversion output goes to the determined plex_target_folder
-        converted_song_path = await asyncio.to_thread(self.converter.convert_to_mp3, downloaded_song_obj, plex_target_folder)
+        # Skip the download entirely if the song is already in the media index.
+        existing = self.find_existing_media(song_url, "audio", plex_target_folder)
+        if existing:
+            converted_song_path = await self.reuse_existing_media(existing, plex_target_folder)
+            await self.notify(job, f"{os.path.basename(converted_song_path)} is already downloaded; it is in Plex at {plex_target_folder}.")
+            return
 
-        # Clear the temporary download folder
-        self.path_check.clear_local_cache(download_music_folder)
-        await interaction.followup.send(f"Downloaded {os.path.basename(converted_song_path)} to Plex server at {plex_target_folder}.")
+        # Initial download always goes to a scratch folder of its own under download_music_folder
+        job_folder = self.path_check.create_job_folder(download_music_folder)
+        try:
+            downloaded_song_obj = await asyncio.to_thread(self.downloader.download_audio, song_url, job_folder)
+            # Conversion output goes to the determined plex_target_folder
+            converted_song_path = await convert(downloaded_song_obj, plex_target_folder)
+        finally:
+            self.path_check.remove_job_folder(job_folder)
+        await self.record_media(song_url, "audio", converted_song_path)
+        await self.notify(job, f"Downloaded {os.path.basename(converted_song_path)} to Plex server at {plex_target_folder}.")
 
     @app_commands.command(name="download_playlist_plex", description="Downloads a YouTube playlist to Plex.")
     @app_commands.describe(playlist_url="The YouTube URL of the playlist for Plex.")
     @app_commands.describe(location="Optional subfolder within Plex music library for the playlist.")
     @app_commands.describe(start="Optional starting index for the playlist.")
     @app_commands.describe(end="Optional ending index for the playlist.")
-    async def download_playlist_plex_command(self, interaction: discord.Interaction, playlist_url: str, location: str = None, start: int = None, end: int = None):
+    @app_commands.describe(passthrough="Keep YouTube's original Opus/AAC audio instead of re-encoding to MP3.")
+    @app_commands.describe(item_messages="Post a message for every song, not just the progress embed.")
+    async def download_playlist_plex_command(self, interaction: discord.Interaction, playlist_url: str, location: str = None, start: int = None, end: int = None,
+                                             passthrough: bool = None, item_messages: bool = None):
         await interaction.response.defer()
-        
-        # Clear the temporary download folder
-        self.path_check.clear_local_cache(download_music_folder)
 
-        plex_target_folder = plex_music_folder
-        if location:
-            if os.path.isabs(location):
-                plex_target_folder = location
-            else:
-                plex_target_folder = os.path.join(plex_music_folder, location)
+        if passthrough is None:
+            passthrough = plex_audio_passthrough
+        plex_target_folder = self.plex_folder(plex_music_folder, location)
+        await self.enqueue_job(interaction, "download_playlist_plex", f"downloading playlist {playlist_url} to Plex server at '{plex_target_folder}'",
+                               priority=JobQueue.BULK, url=playlist_url, folder=plex_target_folder, start=start, end=end, passthrough=passthrough,
+                               item_messages=item_messages)
 
-        await interaction.followup.send(f"Starting download of playlist {playlist_url} to Plex server at '{plex_target_folder}'.")
+    async def download_playlist_plex_job(self, job: dict):
+        playlist_url = job["params"]["url"]
+        plex_target_folder = job["params"]["folder"]
+        # Passthrough remuxes with stream copy, which avoids the MP3 transcode entirely.
+        convert = self.converter.remux_audio if job["params"]["passthrough"] else self.converter.convert_to_mp3
 
         # Ensure the temporary download folder exists
         self.path_check.path_exists(download_music_folder)
         # Ensure the final Plex target folder for the playlist exists
         self.path_check.path_exists(plex_target_folder)
 
-        playlist_urls = self.downloader.get_playlist(playlist_url, start, end)
-        if not playlist_urls:
-            await interaction.followup.send("Could not retrieve playlist or playlist is empty.")
+        # Playlist pages are fetched lazily while the first songs are already downloading.
+        playlist_urls = self.downloader.iter_playlist(playlist_url, job["params"]["start"], job["params"]["end"])
+        item_messages = self.item_messages(job)
+
+        async def download_item(item: PlaylistItem):
+            # Re-running a playlist only costs an index lookup for songs that are already downloaded.
+            existing = self.find_existing_media(item.url, "audio", plex_target_folder)
+            if existing:
+                item.context["existing"] = await self.reuse_existing_media(existing, plex_target_folder)
+                return item.context["existing"]
+            job_folder = item.context.get("folder") or self.path_check.create_job_folder(download_music_folder)
+            item.context["folder"] = job_folder
+            # Initial download always goes to the item's scratch folder
+            return await asyncio.to_thread(self.downloader.download_audio, item.url, job_folder)
+
+        async def convert_item(item: PlaylistItem):
+            if "existing" in item.context:
+                return item.context["existing"]
+            # Conversion output goes to the determined plex_target_folder for the playlist
+            converted_song_path = await convert(item.result, plex_target_folder, priority=TranscodeScheduler.BULK)
+            await self.record_media(item.url, "audio", converted_song_path)
+            return converted_song_path
+
+        async def report_item(item: PlaylistItem):
+            if not item_messages:
+                return
+            if item.error is not None:
+                await self.notify(job, f"Error downloading song {item.url} to Plex: {item.error}")
+            elif "existing" in item.context:
+                await self.notify(job, f"{os.path.basename(item.result)} is already downloaded; it is in Plex at {plex_target_folder}.")
+            else:
+                await self.notify(job, f"Downloaded {os.path.basename(item.result)} to Plex at {plex_target_folder}.")
+
+        stages = [
+            PipelineStage("download", download_item, playlist_workers),
+            PipelineStage("convert", convert_item, convert_workers),
+        ]
+        items = await self.run_playlist_job(job, playlist_urls, stages, report_item, f"Downloading songs from {playlist_url} to Plex at '{plex_target_folder}'")
+        if not items:
+            await self.notify(job, "Could not retrieve playlist or playlist is empty.")
             return
-
-        await interaction.followup.send(f"Found {len(playlist_urls)} songs. Downloading to Plex at '{plex_target_folder}'...")
-        for item_url in playlist_urls:
-            try:
-                # Initial download always goes to the temporary download_music_folder
-                downloaded_song_obj = await asyncio.to_thread(self.downloader.download_audio, item_url, download_music_folder)
-                # Conversion output goes to the determined plex_target_folder for the playlist
-                converted_song_path = await asyncio.to_thread(self.converter.convert_to_mp3, downloaded_song_obj, plex_target_folder)
-                await interaction.followup.send(f"Downloaded {os.path.basename(converted_song_path)} to Plex at {plex_target_folder}.")
-                # Clear the temporary download folder after each song
-                self.path_check.clear_local_cache(download_music_folder)
-            except Exception as e:
-                await interaction.followup.send(f"Error downloading song {item_url} to Plex: {e}")
-            await asyncio.sleep(1)
-        await interaction.followup.send(f"Finished downloading playlist to Plex server at {plex_target_folder}.")
+        await self.notify(job, f"Finished downloading playlist to Plex server at {plex_target_folder} ({self.summarise_items(items)}).")
 
     @app_commands.command(name="download_video_plex", description="Downloads a YouTube video to Plex.")
     @app_commands.describe(video_url="The YouTube URL of the video for Plex.")
@@ -732,97 +2764,131 @@ class Download(commands.Cog):
     async def download_video_plex_command(self, interaction: discord.Interaction, video_url: str, location: str = None):
         await interaction.response.defer()
 
-        plex_target_folder = plex_video_folder
-        if location:
-            if os.path.isabs(location):
-                plex_target_folder = location
-            else:
-                plex_target_folder = os.path.join(plex_video_folder, location)
+        plex_target_folder = self.plex_folder(plex_video_folder, location)
+        await self.enqueue_job(interaction, "download_video_plex", f"downloading video {video_url} to Plex server at '{plex_target_folder}'",
+                               url=video_url, folder=plex_target_folder)
+
+    async def download_video_plex_job(self, job: dict):
+        video_url = job["params"]["url"]
+        plex_target_folder = job["params"]["folder"]
 
-        await interaction.followup.send(f"Starting video download of {video_url} to Plex server at '{plex_target_folder}'.")
+        await self.notify(job, f"Starting video download of {video_url} to Plex server at '{plex_target_folder}'.")
 
         # Ensure the temporary download folder for video components exists
         self.path_check.path_exists(download_video_folder)
         # Ensure the final Plex target folder exists
         self.path_check.path_exists(plex_target_folder)
 
-        # Initial download of video components always goes to the temporary download_video_folder
-        downloaded_video_obj = await asyncio.to_thread(self.downloader.download_video, video_url, download_video_folder)
-        # Combination and output of the final video goes to the determined plex_target_folder
-        converted_video_path = await asyncio.to_thread(self.converter.combine_video_and_audio, downloaded_video_obj, plex_target_folder)
+        # Skip the download entirely if the video is already in the media index.
+        existing = self.find_existing_media(video_url, "video", plex_target_folder)
+        if existing:
+            converted_video_path = await self.reuse_existing_media(existing, plex_target_folder)
+            await self.notify(job, f"{os.path.basename(converted_video_path)} is already downloaded; it is in Plex at {plex_target_folder}.")
+            return
 
-        # Clear the temporary download folder for video components
-        self.path_check.clear_local_cache(download_video_folder)
-        await interaction.followup.send(f"Finished downloading {os.path.basename(converted_video_path)} to Plex server at {plex_target_folder}.")
+        # Video components are downloaded into a scratch folder of their own under download_video_folder
+        job_folder = self.path_check.create_job_folder(download_video_folder)
+        try:
+            downloaded_video_obj = await asyncio.to_thread(self.downloader.download_video, video_url, job_folder)
+            # Combination and output of the final video goes to the determined plex_target_folder
+            converted_video_path = await self.converter.combine_video_and_audio(downloaded_video_obj, plex_target_folder)
+        finally:
+            self.path_check.remove_job_folder(job_folder)
+        await self.record_media(video_url, "video", converted_video_path)
+        await self.notify(job, f"Finished downloading {os.path.basename(converted_video_path)} to Plex server at {plex_target_folder}.")
 
     @app_commands.command(name="download_video_playlist_plex", description="Downloads a YouTube video playlist to Plex.")
     @app_commands.describe(playlist_url="The YouTube URL of the video playlist for Plex.")
     @app_commands.describe(location="Optional subfolder within Plex video library for the playlist.")
     @app_commands.describe(start="Optional starting index for the playlist.")
     @app_commands.describe(end="Optional ending index for the playlist.")
-    async def download_video_playlist_plex_command(self, interaction: discord.Interaction, playlist_url: str, location: str = None, start: int = None, end: int = None):
+    @app_commands.describe(item_messages="Post a message for every video, not just the progress embed.")
+    async def download_video_playlist_plex_command(self, interaction: discord.Interaction, playlist_url: str, location: str = None, start: int = None, end: int = None,
+                                                   item_messages: bool = None):
         await interaction.response.defer()
-        
-        # Clear the temporary download folder for leftover video components
-        self.path_check.clear_local_cache(download_video_folder)
 
-        plex_target_folder = plex_video_folder
-        if location:
-            if os.path.isabs(location):
-                plex_target_folder = location
-            else:
-                plex_target_folder = os.path.join(plex_video_folder, location)
+        plex_target_folder = self.plex_folder(plex_video_folder, location)
+        await self.enqueue_job(interaction, "download_video_playlist_plex", f"downloading video playlist {playlist_url} to Plex server at '{plex_target_folder}'",
+                               priority=JobQueue.BULK, url=playlist_url, folder=plex_target_folder, start=start, end=end, item_messages=item_messages)
 
-        await interaction.followup.send(f"Starting video playlist download of {playlist_url} to Plex server at '{plex_target_folder}'.")
+    async def download_video_playlist_plex_job(self, job: dict):
+        playlist_url = job["params"]["url"]
+        plex_target_folder = job["params"]["folder"]
 
         # Ensure the temporary download folder for video components exists
         self.path_check.path_exists(download_video_folder)
         # Ensure the final Plex target folder for the playlist exists
         self.path_check.path_exists(plex_target_folder)
 
-        playlist_urls = self.downloader.get_playlist(playlist_url, start, end)
-        if not playlist_urls:
-            await interaction.followup.send("Could not retrieve playlist or playlist is empty.")
+        # Playlist pages are fetched lazily while the first videos are already downloading.
+        playlist_urls = self.downloader.iter_playlist(playlist_url, job["params"]["start"], job["params"]["end"])
+        item_messages = self.item_messages(job)
+
+        async def download_item(item: PlaylistItem):
+            # Re-running a playlist only costs an index lookup for videos that are already downloaded.
+            existing = self.find_existing_media(item.url, "video", plex_target_folder)
+            if existing:
+                item.context["existing"] = await self.reuse_existing_media(existing, plex_target_folder)
+                return item.context["existing"]
+            job_folder = item.context.get("folder") or self.path_check.create_job_folder(download_video_folder)
+            item.context["folder"] = job_folder
+            # Video components always go to the item's scratch folder
+            return await asyncio.to_thread(self.downloader.download_video, item.url, job_folder)
+
+        async def combine_item(item: PlaylistItem):
+            if "existing" in item.context:
+                return item.context["existing"]
+            # Combination and output of the final video goes to the determined plex_target_folder
+            converted_video_path = await self.converter.combine_video_and_audio(item.result, plex_target_folder, priority=TranscodeScheduler.BULK)
+            await self.record_media(item.url, "video", converted_video_path)
+            return converted_video_path
+
+        async def report_item(item: PlaylistItem):
+            if not item_messages:
+                return
+            if item.error is not None:
+                await self.notify(job, f"Error downloading video {item.url} to Plex: {item.error}")
+            elif "existing" in item.context:
+                await self.notify(job, f"{os.path.basename(item.result)} is already downloaded; it is in Plex at {plex_target_folder}.")
+            else:
+                await self.notify(job, f"Downloaded {os.path.basename(item.result)} to Plex at {plex_target_folder}.")
+
+        stages = [
+            PipelineStage("download", download_item, playlist_workers),
+            PipelineStage("combine", combine_item, convert_workers),
+        ]
+        items = await self.run_playlist_job(job, playlist_urls, stages, report_item, f"Downloading videos from {playlist_url} to Plex at '{plex_target_folder}'")
+        if not items:
+            await self.notify(job, "Could not retrieve playlist or playlist is empty.")
             return
-
-        await interaction.followup.send(f"Found {len(playlist_urls)} videos. Downloading to Plex at '{plex_target_folder}'...")
-        for item_url in playlist_urls:
-            try:
-                # Initial download of video components always goes to the temporary download_video_folder
-                downloaded_video_obj = await asyncio.to_thread(self.downloader.download_video, item_url, download_video_folder)
-                # Combination and output of the final video goes to the determined plex_target_folder
-                converted_video_path = await asyncio.to_thread(self.converter.combine_video_and_audio, downloaded_video_obj, plex_target_folder)
-                await interaction.followup.send(f"Downloaded {os.path.basename(converted_video_path)} to Plex at {plex_target_folder}.")
-                # Clear the temporary download folder for video components after each video
-                self.path_check.clear_local_cache(download_video_folder)
-            except Exception as e:
-                await interaction.followup.send(f"Error downloading video {item_url} to Plex: {e}")
-            await asyncio.sleep(1)
-        await interaction.followup.send(f"Finished downloading video playlist to Plex server at {plex_target_folder}.")
+        await self.notify(job, f"Finished downloading video playlist to Plex server at {plex_target_folder} ({self.summarise_items(items)}).")
 
     @app_commands.command(name="download_spotify", description="Downloads a song from a Spotify URL.")
     @app_commands.describe(url="The Spotify URL of the song.")
     async def download_spotify_command(self, interaction: discord.Interaction, url: str):
         await interaction.response.defer()
 
-        target_folder = temp_spotify_folder
+        # Tracks already in the media index (e.g. downloaded to Plex before) are sent without calling spotdl,
+        # unless they are too big for this channel or not an mp3 (a 320k Plex import or a passthrough .opus).
+        upload_limit = interaction.guild.filesize_limit if interaction.guild is not None else discord_upload_limit
+        existing = self.find_existing_media(url, "audio")
+        if existing and self.fits_discord(existing, upload_limit):
+            await interaction.followup.send(file=discord.File(existing["path"]), content=os.path.basename(existing["path"]))
+            return
 
-        self.path_check.path_exists(target_folder)
+        # Each call gets its own folder under TEMP_SPOTIFY_FOLDER, so concurrent calls never send or delete each other's files.
+        target_folder = await asyncio.to_thread(self.path_check.create_job_folder, temp_spotify_folder)
         await interaction.followup.send(f"Downloading {url} to '{target_folder}'...")
+        try:
+            await asyncio.to_thread(self.downloader.download_spotify, url, target_folder)
+            spotify_file_path = await asyncio.to_thread(self.path_check.get_temp_spotify_file, target_folder)
 
-        # Pass the determined target_folder to download_spotify
-        await asyncio.to_thread(self.downloader.download_spotify, url, target_folder)
-
-        # Pass the target_folder to get_temp_spotify_file
-        spotify_file_path = await asyncio.to_thread(self.path_check.get_temp_spotify_file, target_folder)
-
-        if spotify_file_path and os.path.exists(spotify_file_path):
-            await interaction.followup.send(file=discord.File(spotify_file_path), content=os.path.basename(spotify_file_path))
-        else:
-            await interaction.followup.send(f"Could not find downloaded Spotify song in '{target_folder}'.")
-
-        # Pass the target_folder to clear_temp_spotify
-        await asyncio.to_thread(self.path_check.clear_temp_spotify, target_folder)
+            if spotify_file_path and os.path.exists(spotify_file_path):
+                await interaction.followup.send(file=discord.File(spotify_file_path), content=os.path.basename(spotify_file_path))
+            else:
+                await interaction.followup.send(f"Could not find downloaded Spotify song in '{target_folder}'.")
+        finally:
+            await asyncio.to_thread(self.path_check.remove_job_folder, target_folder)
 
     @app_commands.command(name="download_spotify_plex", description="Downloads a Spotify song to Plex.")
     @app_commands.describe(url="The Spotify URL for Plex download.")
@@ -839,8 +2905,26 @@ class Download(commands.Cog):
 
         self.path_check.path_exists(plex_target_folder)
 
+        existing = self.find_existing_media(url, "audio", plex_target_folder)
+        if existing:
+            existing_path = await self.reuse_existing_media(existing, plex_target_folder)
+            await interaction.followup.send(f"{os.path.basename(existing_path)} is already downloaded; it is in Plex at '{plex_target_folder}'.")
+            return
+
         await interaction.followup.send(f"Downloading {url} to Plex at '{plex_target_folder}'...")
-        await asyncio.to_thread(self.downloader.download_spotify, url, plex_target_folder)
+        # spotdl picks its own file name, so it runs in a folder of its own; queued jobs write into the Plex folder meanwhile.
+        job_folder = await asyncio.to_thread(self.path_check.create_job_folder, temp_spotify_folder)
+        try:
+            await asyncio.to_thread(self.downloader.download_spotify, url, job_folder)
+            spotify_file_path = await asyncio.to_thread(self.path_check.get_temp_spotify_file, job_folder)
+            if spotify_file_path is None:
+                await interaction.followup.send(f"Could not download {url} with spotdl.")
+                return
+            plex_path = os.path.join(plex_target_folder, os.path.basename(spotify_file_path))
+            await asyncio.to_thread(shutil.move, spotify_file_path, plex_path)
+        finally:
+            await asyncio.to_thread(self.path_check.remove_job_folder, job_folder)
+        await self.record_media(url, "audio", plex_path)
         await interaction.followup.send(f"Downloaded {url} to Plex server at '{plex_target_folder}'.")
 
     @app_commands.command(name="download_mix_plex", description="Downloads a YouTube mix to Plex using a mix splitter.")
@@ -897,7 +2981,7 @@ def e2e_music_test_without_bot_commands():
     #convert
     converter = Converter()
     # convert_to_mp3 now expects absolute path for music_conversion_folder
-    converted_path = converter.convert_to_mp3(webm_song_obj, music_conversion_folder)
+    converted_path = asyncio.run(converter.convert_to_mp3(webm_song_obj, music_conversion_folder))
     logging.info(f"E2E Test: Converted music to {converted_path}")
     #upload
     # uploader = Uploader()
@@ -924,7 +3008,7 @@ def e2e_music_playlist_test():
 
         #convert
         converter = Converter()
-        converted_path = converter.convert_to_mp3(webm_song_obj, music_conversion_folder) # absolute path
+        converted_path = asyncio.run(converter.convert_to_mp3(webm_song_obj, music_conversion_folder)) # absolute path
         logging.info(f"E2E Playlist Test: Converted {song_url} to {converted_path}")
 
         # uploader instantiated outside of for loop so it only needs to be setup once
@@ -948,7 +3032,7 @@ def e2e_video_test():
 
     converter = Converter()
     # combine_video_and_audio expects absolute path for video_conversion_folder
-    converted_video_path = converter.combine_video_and_audio(video_obj, video_conversion_folder)
+    converted_video_path = asyncio.run(converter.combine_video_and_audio(video_obj, video_conversion_folder))
     logging.info(f"E2E Video Test: Converted video to {converted_video_path}")
 
     # uploader = Uploader()
@@ -965,7 +3049,7 @@ def download_video(): # This seems like a test function, not part of cog
     converter = Converter()
     video_obj = downloader.download_video("https://www.youtube.com/watch?v=x7M8ahInYjA", download_video_folder) # absolute
     # combine_video_and_audio expects absolute path
-    converted_path = converter.combine_video_and_audio(video_obj, video_conversion_folder)
+    converted_path = asyncio.run(converter.combine_video_and_audio(video_obj, video_conversion_folder))
     logging.info(f"Test download_video: Converted to {converted_path}")
     
 def download_music(): # This seems like a test function
@@ -973,7 +3057,7 @@ def download_music(): # This seems like a test function
     converter = Converter()
     song_obj = downloader.download_audio("https://www.youtube.com/watch?v=UaZFDa45u3Q", download_music_folder) # absolute
     # convert_to_mp3 expects absolute path
-    converted_path = converter.convert_to_mp3(song_obj, music_conversion_folder)
+    converted_path = asyncio.run(converter.convert_to_mp3(song_obj, music_conversion_folder))
     logging.info(f"Test download_music: Converted to {converted_path}")
     
 def download_playlist(): # This seems like a test function for Spotify
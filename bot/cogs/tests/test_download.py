@@ -1,1244 +1,1682 @@
 import os
+import sys
+import tempfile
 import unittest
-from unittest.mock import MagicMock, AsyncMock, patch, call
+from unittest.mock import ANY, MagicMock, AsyncMock, patch, call
 import asyncio
+import hashlib
+import io
+import threading
+import time
+
+from PIL import Image
+import requests
+from googleapiclient.errors import HttpError
 
 # Make sure bot.cogs.download is importable.
 # This might require adjusting PYTHONPATH or how tests are run.
 # For now, assuming it's directly importable.
-from bot.cogs.download import Download, Song
-from bot.cogs.download import download_music_folder, music_conversion_folder, plex_music_folder, temp_spotify_folder, download_video_folder, plex_video_folder
+from bot.cogs.download import Download, Song, LocalPathCheck, PlaylistExecutor, PipelineStage, MediaIndex, Converter
+from bot.cogs.download import FFmpegRunner, FFmpegError, InvalidURL, CoverCache, Downloader, MetadataCache, ResumableDownloader, StreamSelector
+from bot.cogs.download import TranscodeScheduler, JobQueue, ProgressReporter, PlaylistItem, AttachmentBatcher, DriveIndex
+from bot.cogs.download import Uploader, UploadService, DriveQuota, google_drive_music_upload
+from bot.cogs.download import LocalUploader, MemoryUploader, UploadBackend, InvalidSetting, create_uploader, DownloadCancelled
+
 
-# Dummy Song object for mocking
-dummy_song_obj = Song()
-dummy_song_obj.path = "dummy/path/to/song.mp3"
-dummy_song_obj.title = "Dummy Title"
-dummy_song_obj.artist = "Dummy Artist"
-dummy_song_obj.thumbnail = "dummy/path/to/thumb.jpg"
-dummy_song_obj.youtube_name = "Dummy YouTube Name"
+def make_song(path, bitrate=320):
+    """Returns a downloaded Song as Downloader.download_audio would."""
+    song = Song()
+    song.path = path
+    song.title = "Title"
+    song.artist = "Artist"
+    song.youtube_name = "Artist - Title"
+    song.bitrate = bitrate
+    return song
 
 
 class TestDownloadCog(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        # Mock the bot instance
+        self.temp_dir = tempfile.mkdtemp()
+        self.download_folder = os.path.join(self.temp_dir, "downloads")
+        self.conversion_folder = os.path.join(self.temp_dir, "converted")
+        self.plex_folder = os.path.join(self.temp_dir, "plex")
+        self.spotify_folder = os.path.join(self.temp_dir, "spotify")
+        for folder in (self.download_folder, self.conversion_folder, self.plex_folder, self.spotify_folder):
+            os.makedirs(folder)
+
+        temp_dir = self.temp_dir
+
+        class TempJobQueue(JobQueue):
+            # A subclass rather than a factory, so the cog can still use the priority constants.
+            def __init__(self):
+                super().__init__(os.path.join(temp_dir, "jobs.sqlite3"))
+
+        # Everything the cog writes goes to the temporary folder, and uploads stay in memory.
+        patches = [
+            patch('bot.cogs.download.JobQueue', TempJobQueue),
+            patch('bot.cogs.download.MediaIndex', lambda: MediaIndex(os.path.join(self.temp_dir, "media_index.sqlite3"))),
+            patch('bot.cogs.download.create_uploader', MemoryUploader),
+            patch('bot.cogs.download.download_music_folder', self.download_folder),
+            patch('bot.cogs.download.music_conversion_folder', self.conversion_folder),
+            patch('bot.cogs.download.download_video_folder', self.download_folder),
+            patch('bot.cogs.download.temp_spotify_folder', self.spotify_folder),
+            patch('bot.cogs.download.discord_upload_limit', 1000),
+            patch('bot.cogs.download.progress_update_interval', 0.01),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
         self.mock_bot = MagicMock()
+        self.mock_bot.wait_until_ready = AsyncMock()
+        self.channel = MagicMock()
+        self.channel.guild = None # Outside a guild the default upload limit (patched to 1000 bytes) applies
+        self.message = MagicMock()
+        self.message.edit = AsyncMock()
+        self.channel.send = AsyncMock(return_value=self.message)
+        self.mock_bot.get_channel.return_value = self.channel
 
-        # Instantiate the Cog with the mocked bot
         self.cog = Download(self.mock_bot)
+        self.cog.downloader = MagicMock()
+        self.cog.converter = MagicMock()
 
-        # Mock interaction object
         self.mock_interaction = MagicMock()
+        self.mock_interaction.channel_id = 123
+        self.mock_interaction.guild = None
         self.mock_interaction.response = AsyncMock()
         self.mock_interaction.followup = AsyncMock()
 
-        # Mock helper classes attached to the cog instance
-        self.cog.downloader = MagicMock()
-        self.cog.converter = MagicMock()
-        self.cog.path_check = MagicMock()
-        self.cog.uploader = MagicMock()
-        self.cog.mix_publisher = MagicMock() # Added as it's in __init__
-        self.cog.mix_finished_subscriber = MagicMock() # Added as it's in __init__
-
-        # Set default return values for methods that are called
-        # and whose return values are used by the command logic
-        self.cog.downloader.download_audio.return_value = dummy_song_obj
-        self.cog.converter.convert_to_mp3.return_value = "/dummy/converted/song.mp3"
-        self.cog.path_check.check_size_for_discord.return_value = False # Assume file is not too large for Discord
-        self.cog.path_check.get_temp_spotify_file.return_value = "/dummy/spotify/song.mp3"
-
-
-    async def test_download_command_location_none(self):
-        """Test download_command with location=None."""
-        song_url = "test_url"
-
-        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=None)
-
-        # Check interaction responses
-        self.mock_interaction.response.defer.assert_called_once()
-
-        # Check path_exists calls
-        expected_path_exists_calls = [
-            call(download_music_folder),
-            call(music_conversion_folder)
-        ]
-        self.cog.path_check.path_exists.assert_has_calls(expected_path_exists_calls, any_order=True)
-
-        # Check downloader call
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-
-        # Check converter call
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, music_conversion_folder)
-
-        # Check discord file sending (or upload)
-        self.cog.path_check.check_size_for_discord.assert_called_once_with("/dummy/converted/song.mp3")
-        # Assuming file is small enough for direct send
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-
-        # Check cache clearing
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
-
-    async def test_download_command_location_absolute(self):
-        """Test download_command with an absolute path for location."""
-        song_url = "test_url_abs"
-        abs_location = "/custom/abs/path"
-
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_location, "song.mp3")
-
-        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=abs_location)
-
-        self.mock_interaction.response.defer.assert_called_once()
-
-        # Path_exists should be called for the absolute path.
-        # Since current_download_folder and current_conversion_folder are the same, it's called once.
-        self.cog.path_check.path_exists.assert_called_once_with(abs_location)
-
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, abs_location)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, abs_location)
-
-        self.cog.path_check.check_size_for_discord.assert_called_once_with(os.path.join(abs_location, "song.mp3"))
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-        self.cog.path_check.clear_local_cache.assert_called_once_with(abs_location)
-
-    async def test_download_command_location_relative(self):
-        """Test download_command with a relative path for location."""
-        song_url = "test_url_rel"
-        rel_location = "my_songs"
-
-        expected_download_path = os.path.join(download_music_folder, rel_location)
-        expected_conversion_path = os.path.join(music_conversion_folder, rel_location)
-
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_conversion_path, "song.mp3")
-
-        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=rel_location)
-
+    async def asyncTearDown(self):
+        self.cog.uploads.close()
+        self.cog.job_queue.close()
+        self.cog.media_index.close()
+        LocalPathCheck().remove_job_folder(self.temp_dir)
+
+    def make_file(self, folder, name, size):
+        path = os.path.join(folder, name)
+        with open(path, "wb") as handler:
+            handler.write(b"x" * size)
+        return path
+
+    def sent_files(self):
+        """Returns the names of the files posted to the channel, one list per message."""
+        messages = []
+        for sent in self.channel.send.call_args_list:
+            files = sent.kwargs.get("files") or ([sent.kwargs["file"]] if sent.kwargs.get("file") else [])
+            if files:
+                messages.append([file.filename for file in files])
+        return messages
+
+    def sent_texts(self):
+        return [sent.kwargs.get("content") for sent in self.channel.send.call_args_list]
+
+    async def claim(self, command, **kwargs):
+        """Runs a command and returns the job it queued."""
+        await command.callback(self.cog, self.mock_interaction, **kwargs)
         self.mock_interaction.response.defer.assert_called_once()
-
-        expected_path_calls = [
-            call(expected_download_path),
-            call(expected_conversion_path)
-        ]
-        self.cog.path_check.path_exists.assert_has_calls(expected_path_calls, any_order=True)
-
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, expected_download_path)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, expected_conversion_path)
-
-        self.cog.path_check.check_size_for_discord.assert_called_once_with(os.path.join(expected_conversion_path, "song.mp3"))
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-        self.cog.path_check.clear_local_cache.assert_called_once_with(expected_download_path)
-
-    # Tests for download_playlist_command
-    async def test_download_playlist_command_location_none(self):
-        """Test download_playlist_command with location=None."""
-        playlist_url = "test_playlist_url"
-        dummy_urls = ["url1", "url2"]
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-
-        # Reset mocks that are called multiple times in a loop or sequence
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock() # Reset to check followup calls accurately per test
-
-        await self.cog.download_playlist_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=None)
-
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
-
-        # Initial path_exists calls
-        initial_path_exists_calls = [call(download_music_folder), call(music_conversion_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
-
-        # Check calls within the loop
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
-        self.assertEqual(self.cog.downloader.download_audio.call_count, len(dummy_urls))
-
-        convert_to_mp3_calls = [call(dummy_song_obj, music_conversion_folder) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
-        self.assertEqual(self.cog.converter.convert_to_mp3.call_count, len(dummy_urls))
-
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-        self.assertEqual(self.cog.path_check.clear_local_cache.call_count, len(dummy_urls))
-
-        # Check one of the followup sends for file (others are status messages)
-        # This assumes the converted_song_path is "/dummy/converted/song.mp3" for each
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-
-    async def test_download_playlist_command_location_absolute(self):
-        """Test download_playlist_command with an absolute path for location."""
-        playlist_url = "test_playlist_url_abs"
-        abs_location = "/custom/abs/playlist/path"
-        dummy_urls = ["url1", "url2"]
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_location, "song.mp3") # Make path consistent
-
-        # Reset mocks
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.cog.path_check.path_exists.reset_mock() # Reset this too for specific check
-        self.mock_interaction.followup.send.reset_mock()
-
-
-        await self.cog.download_playlist_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=abs_location)
-
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
-
-        # path_exists called once for the abs_location (as download and convert paths are the same)
-        self.cog.path_check.path_exists.assert_called_once_with(abs_location)
-
-        download_audio_calls = [call(url, abs_location) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
-
-        convert_to_mp3_calls = [call(dummy_song_obj, abs_location) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
-
-        clear_local_cache_calls = [call(abs_location) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-
-    async def test_download_playlist_command_location_relative(self):
-        """Test download_playlist_command with a relative path for location."""
-        playlist_url = "test_playlist_url_rel"
-        rel_location = "my_playlist_downloads"
-        dummy_urls = ["url1", "url2"]
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-
-        expected_download_path = os.path.join(download_music_folder, rel_location)
-        expected_conversion_path = os.path.join(music_conversion_folder, rel_location)
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_conversion_path, "song.mp3")
-
-
-        # Reset mocks
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.cog.path_check.path_exists.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-
-        await self.cog.download_playlist_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=rel_location)
-
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
-
-        initial_path_exists_calls = [call(expected_download_path), call(expected_conversion_path)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
-
-        download_audio_calls = [call(url, expected_download_path) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
-
-        convert_to_mp3_calls = [call(dummy_song_obj, expected_conversion_path) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
-
-        clear_local_cache_calls = [call(expected_download_path) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-    # Tests for download_plex_command
-    async def test_download_plex_command_location_none(self):
-        """Test download_plex_command with location=None."""
-        song_url = "test_plex_url_none"
-        # Reset relevant mocks to ensure clean state for this test
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-
-        # Expected path for the converted song for followup message content
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(plex_music_folder, "song.mp3")
-
-        await self.cog.download_plex_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=None)
-
-        self.mock_interaction.response.defer.assert_called_once()
-
-        path_exists_calls = [call(download_music_folder), call(plex_music_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
-
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, plex_music_folder)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
-
-        # Check that the followup message contains the correct path
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex server at {plex_music_folder}."
+        job = self.cog.job_queue.claim()
+        self.assertIsNotNone(job)
+        return job
+
+    async def test_commands_only_queue_jobs(self):
+        """A command stores a job and answers straight away; nothing is downloaded until a worker runs it."""
+        job = await self.claim(self.cog.download_command, song_url="https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+
+        self.assertEqual(job["kind"], "download")
+        self.assertEqual(job["params"], {"url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ"})
+        self.assertEqual(job["channel_id"], 123)
+        self.mock_interaction.followup.send.assert_called_once()
+        self.assertIn(f"#{job['id']}", self.mock_interaction.followup.send.call_args.args[0])
+        self.cog.downloader.download_audio.assert_not_called()
+
+    async def test_job_worker_runs_queued_jobs(self):
+        """A worker claims the queued job, runs its handler and marks it done."""
+        handled = asyncio.Event()
+        handler = AsyncMock(side_effect=lambda job: handled.set())
+        self.cog.job_handlers["download"] = handler
+        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url="https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+
+        worker = asyncio.create_task(self.cog.job_worker())
+        try:
+            await asyncio.wait_for(handled.wait(), 5)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+        self.assertEqual(handler.call_args.args[0]["params"]["url"], "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+        self.assertIsNone(self.cog.job_queue.claim())
+
+    async def test_download_job_sends_the_song(self):
+        """The song is downloaded into a job folder, converted, indexed and posted to the job's channel."""
+        url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+        converted = self.make_file(self.conversion_folder, "Artist - Title.mp3", 100)
+        self.cog.downloader.download_audio.side_effect = lambda url, folder: make_song(os.path.join(folder, "audio.mp3"))
+        self.cog.converter.convert_to_mp3 = AsyncMock(return_value=converted)
+        job = await self.claim(self.cog.download_command, song_url=url)
+
+        await self.cog.download_job(job)
+
+        job_folder = self.cog.downloader.download_audio.call_args.args[1]
+        self.assertEqual(os.path.dirname(job_folder), self.download_folder)
+        self.assertFalse(os.path.exists(job_folder))
+        self.cog.converter.convert_to_mp3.assert_called_once_with(ANY, self.conversion_folder, max_bytes=1000)
+        self.assertEqual(self.sent_files(), [["Artist - Title.mp3"]])
+        self.assertEqual(self.cog.find_existing_media(url, "audio")["path"], converted)
+
+    async def test_download_job_reuses_indexed_songs_that_fit(self):
+        """An indexed mp3 within the upload limit is sent without downloading it again."""
+        url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+        existing = self.make_file(self.conversion_folder, "Artist - Title.mp3", 100)
+        self.cog.media_index.add(self.cog.media_index.media_key(url), "audio", existing)
+        job = await self.claim(self.cog.download_command, song_url=url)
+
+        await self.cog.download_job(job)
+
+        self.cog.downloader.download_audio.assert_not_called()
+        self.assertEqual(self.sent_files(), [["Artist - Title.mp3"]])
+
+    async def test_large_songs_go_to_the_upload_backend(self):
+        """Indexed songs too large for the guild are encoded again; if that is still too large they are uploaded."""
+        url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+        existing = self.make_file(self.plex_folder, "Artist - Title.mp3", 5000)
+        self.cog.media_index.add(self.cog.media_index.media_key(url), "audio", existing)
+        converted = self.make_file(self.conversion_folder, "Artist - Title (64k).mp3", 2000)
+        self.cog.downloader.download_audio.side_effect = lambda url, folder: make_song(os.path.join(folder, "audio.mp3"), bitrate=64)
+        self.cog.converter.convert_to_mp3 = AsyncMock(return_value=converted)
+        job = await self.claim(self.cog.download_command, song_url=url)
+
+        await self.cog.download_job(job)
+
+        self.cog.converter.convert_to_mp3.assert_called_once_with(ANY, self.conversion_folder, max_bytes=1000)
+        self.assertEqual(self.sent_files(), [])
+        self.assertIn(("music", "Artist - Title (64k).mp3"), self.cog.uploader.files)
+        self.assertIn("memory://music/Artist - Title (64k).mp3", self.message.edit.call_args.kwargs["content"])
+        # The reduced copy is not indexed, so Plex keeps getting the full quality file.
+        self.assertEqual(self.cog.find_existing_media(url, "audio")["path"], existing)
+
+    async def test_playlist_job_batches_songs_and_records_them(self):
+        """Playlist songs are sent together and only recorded as done once their message went out."""
+        urls = [f"https://www.youtube.com/watch?v=video0000{index:02d}" for index in range(3)]
+        self.cog.downloader.iter_playlist.return_value = urls
+        self.cog.downloader.download_audio.side_effect = lambda url, folder: make_song(os.path.join(folder, url[-2:] + ".webm"))
+        self.cog.converter.convert_to_mp3 = AsyncMock(
+            side_effect=lambda song, folder, **kwargs: self.make_file(folder, os.path.basename(song.path)[:-5] + ".mp3", 100))
+        job = await self.claim(self.cog.download_playlist_command, playlist_url="https://www.youtube.com/playlist?list=PL1")
+
+        await self.cog.download_playlist_job(job)
+
+        self.assertEqual(self.sent_files(), [["00.mp3", "01.mp3", "02.mp3"]])
+        self.assertEqual(sorted(self.cog.job_queue.finished_items(job["id"])), [0, 1, 2])
+        self.assertIn("Finished downloading playlist (3 done, 0 failed).", self.sent_texts())
+        self.assertEqual([name for name in os.listdir(self.download_folder)], [])
+
+    async def test_playlist_songs_are_not_recorded_if_their_batch_was_not_sent(self):
+        """A song whose message could not be posted is left for a resumed job to send again."""
+        self.cog.downloader.iter_playlist.return_value = ["https://www.youtube.com/watch?v=video000000"]
+        self.cog.downloader.download_audio.side_effect = lambda url, folder: make_song(os.path.join(folder, "audio.webm"))
+        self.cog.converter.convert_to_mp3 = AsyncMock(side_effect=lambda song, folder, **kwargs: self.make_file(folder, "song.mp3", 100))
+        self.cog.notify = AsyncMock(side_effect=lambda job, content=None, file_path=None, embed=None, file_paths=None: None if file_paths else self.message)
+        job = await self.claim(self.cog.download_playlist_command, playlist_url="https://www.youtube.com/playlist?list=PL1")
+
+        await self.cog.download_playlist_job(job)
+
+        self.assertEqual(self.cog.job_queue.finished_items(job["id"]), {})
+
+    async def test_plex_job_converts_into_the_plex_folder(self):
+        """Plex downloads resolve the location when queued and land in that folder, indexed for next time."""
+        url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+        self.cog.downloader.download_audio.side_effect = lambda url, folder: make_song(os.path.join(folder, "audio.webm"))
+        self.cog.converter.convert_to_mp3 = AsyncMock(side_effect=lambda song, folder: self.make_file(folder, "Artist - Title.mp3", 100))
+        self.cog.converter.remux_audio = AsyncMock()
+        with patch('bot.cogs.download.plex_music_folder', self.plex_folder):
+            job = await self.claim(self.cog.download_plex_command, song_url=url, location="Albums", passthrough=False)
+
+        await self.cog.download_plex_job(job)
+
+        target = os.path.join(self.plex_folder, "Albums")
+        self.assertEqual(job["params"]["folder"], target)
+        self.cog.converter.convert_to_mp3.assert_called_once_with(ANY, target)
+        self.cog.converter.remux_audio.assert_not_called()
+        self.assertEqual(self.cog.find_existing_media(url, "audio", target)["path"], os.path.join(target, "Artist - Title.mp3"))
+        self.assertIn(f"Downloaded Artist - Title.mp3 to Plex server at {target}.", self.sent_texts())
+
+    async def test_plex_playlist_job_skips_indexed_songs(self):
+        """Songs already in the Plex folder are reused; the others are remuxed when passthrough is on."""
+        urls = ["https://www.youtube.com/watch?v=video000000", "https://www.youtube.com/watch?v=video000001"]
+        existing = self.make_file(self.plex_folder, "00.opus", 100)
+        self.cog.media_index.add(self.cog.media_index.media_key(urls[0]), "audio", existing)
+        self.cog.downloader.iter_playlist.return_value = urls
+        self.cog.downloader.download_audio.side_effect = lambda url, folder: make_song(os.path.join(folder, "audio.webm"))
+        self.cog.converter.remux_audio = AsyncMock(side_effect=lambda song, folder, **kwargs: self.make_file(folder, "01.opus", 100))
+        with patch('bot.cogs.download.plex_music_folder', self.plex_folder):
+            job = await self.claim(self.cog.download_playlist_plex_command, playlist_url="https://www.youtube.com/playlist?list=PL1",
+                                   location=self.plex_folder, passthrough=True)
+
+        await self.cog.download_playlist_plex_job(job)
+
+        self.cog.downloader.download_audio.assert_called_once()
+        self.cog.converter.remux_audio.assert_called_once_with(ANY, self.plex_folder, priority=TranscodeScheduler.BULK)
+        self.assertEqual(sorted(self.cog.job_queue.finished_items(job["id"])), [0, 1])
+
+    async def test_video_plex_jobs_combine_into_the_plex_folder(self):
+        """Single videos and video playlists are combined into the Plex folder and indexed."""
+        self.cog.downloader.download_video.side_effect = lambda url, folder: MagicMock()
+        self.cog.converter.combine_video_and_audio = AsyncMock(
+            side_effect=lambda video, folder, **kwargs: self.make_file(folder, f"video{len(os.listdir(folder))}.mp4", 100))
+        self.cog.downloader.iter_playlist.return_value = ["https://www.youtube.com/watch?v=video000001"]
+        with patch('bot.cogs.download.plex_video_folder', self.plex_folder):
+            video_job = await self.claim(self.cog.download_video_plex_command, video_url="https://www.youtube.com/watch?v=video000000")
+            self.mock_interaction.response.defer.reset_mock()
+            playlist_job = await self.claim(self.cog.download_video_playlist_plex_command, playlist_url="https://www.youtube.com/playlist?list=PL1")
+
+        await self.cog.download_video_plex_job(video_job)
+        await self.cog.download_video_playlist_plex_job(playlist_job)
+
+        self.assertEqual(sorted(os.listdir(self.plex_folder)), ["video0.mp4", "video1.mp4"])
+        self.assertIsNotNone(self.cog.find_existing_media("https://www.youtube.com/watch?v=video000000", "video", self.plex_folder))
+        self.assertIsNotNone(self.cog.find_existing_media("https://www.youtube.com/watch?v=video000001", "video", self.plex_folder))
+        self.assertIn(f"Finished downloading video0.mp4 to Plex server at {self.plex_folder}.", self.sent_texts())
+
+    async def test_spotify_command_sends_indexed_tracks_without_spotdl(self):
+        """Spotify downloads still run inline; tracks already in the index are sent straight away."""
+        url = "https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC"
+        existing = self.make_file(self.conversion_folder, "track.mp3", 100)
+        self.cog.media_index.add(self.cog.media_index.media_key(url), "audio", existing)
+
+        await self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url=url)
+
+        self.cog.downloader.download_spotify.assert_not_called()
+        self.mock_interaction.followup.send.assert_called_once_with(file=ANY, content="track.mp3")
+
+    async def test_spotify_command_downloads_again_if_the_indexed_track_does_not_fit(self):
+        """An indexed track Discord won't take (too big, or not an mp3) is fetched with spotdl instead."""
+        url = "https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC"
+        existing = self.make_file(self.plex_folder, "track.mp3", 2000)
+        self.cog.media_index.add(self.cog.media_index.media_key(url), "audio", existing)
+
+        await self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url=url)
+
+        self.cog.downloader.download_spotify.assert_called_once()
+
+    async def test_concurrent_spotify_commands_keep_their_own_files(self):
+        """Two /download_spotify calls at once each send the track they downloaded and leave nothing behind."""
+        both_downloading = threading.Barrier(2, timeout=1)
+
+        def download_spotify(url, output_folder):
+            self.make_file(output_folder, url.rsplit("/", 1)[1] + ".mp3", 100)
+            both_downloading.wait()
+
+        self.cog.downloader.download_spotify.side_effect = download_spotify
+        await asyncio.gather(
+            self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url="https://open.spotify.com/track/one"),
+            self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url="https://open.spotify.com/track/two"),
         )
 
-    async def test_download_plex_command_location_absolute(self):
-        """Test download_plex_command with an absolute path for location."""
-        song_url = "test_plex_url_abs"
-        abs_plex_location = "/custom/plex/abs/path"
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
+        sent = [sent.kwargs["content"] for sent in self.mock_interaction.followup.send.call_args_list if "file" in sent.kwargs]
+        self.assertEqual(sorted(sent), ["one.mp3", "two.mp3"])
+        self.assertEqual(os.listdir(self.spotify_folder), [])
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_plex_location, "song.mp3")
+    def test_spotdl_runs_in_the_output_folder_without_chdir(self):
+        """spotdl gets the output folder as its working directory; the bot's own stays put."""
+        cwd = os.getcwd()
+        with patch("bot.cogs.download.subprocess.run") as run:
+            Downloader(metadata_cache=MetadataCache(ttl=0)).download_spotify("https://open.spotify.com/track/one", self.spotify_folder)
 
-        await self.cog.download_plex_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=abs_plex_location)
+        run.assert_called_once_with(["spotdl", "https://open.spotify.com/track/one"], check=True, cwd=self.spotify_folder)
+        self.assertEqual(os.getcwd(), cwd)
 
-        self.mock_interaction.response.defer.assert_called_once()
+    async def test_spotify_plex_command_indexes_only_the_spotdl_result(self):
+        """A file another job writes to the Plex folder meanwhile is not mistaken for the Spotify track."""
+        url = "https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC"
 
-        path_exists_calls = [call(download_music_folder), call(abs_plex_location)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
+        def download_spotify(url, output_folder):
+            self.make_file(self.plex_folder, "youtube.mp3", 100)
+            self.make_file(output_folder, "track.mp3", 100)
 
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, abs_plex_location)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
+        self.cog.downloader.download_spotify.side_effect = download_spotify
+        await self.cog.download_spotify_plex_command.callback(self.cog, self.mock_interaction, url=url, location=self.plex_folder)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex server at {abs_plex_location}."
-        )
+        self.assertEqual(sorted(os.listdir(self.plex_folder)), ["track.mp3", "youtube.mp3"])
+        self.assertEqual(self.cog.find_existing_media(url, "audio", self.plex_folder)["path"], os.path.join(self.plex_folder, "track.mp3"))
+        self.assertEqual(os.listdir(self.spotify_folder), [])
 
-    async def test_download_plex_command_location_relative(self):
-        """Test download_plex_command with a relative path for location."""
-        song_url = "test_plex_url_rel"
-        rel_plex_location = "my_plex_songs"
-        expected_plex_path = os.path.join(plex_music_folder, rel_plex_location)
+    async def test_failed_spotify_plex_download_indexes_nothing(self):
+        """When spotdl produces no file, nothing in the Plex folder is recorded under the track."""
+        url = "https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC"
+        self.cog.downloader.download_spotify.side_effect = lambda url, output_folder: self.make_file(self.plex_folder, "youtube.mp3", 100)
 
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
+        await self.cog.download_spotify_plex_command.callback(self.cog, self.mock_interaction, url=url, location=self.plex_folder)
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_plex_path, "song.mp3")
+        self.assertIsNone(self.cog.find_existing_media(url, "audio", self.plex_folder))
+        self.mock_interaction.followup.send.assert_called_with(f"Could not download {url} with spotdl.")
 
-        await self.cog.download_plex_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=rel_plex_location)
 
-        self.mock_interaction.response.defer.assert_called_once()
+class TestLocalPathCheck(unittest.TestCase):
 
-        path_exists_calls = [call(download_music_folder), call(expected_plex_path)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
+    def setUp(self):
+        self.base_folder = tempfile.mkdtemp()
+        self.path_check = LocalPathCheck()
 
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, expected_plex_path)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
+    def tearDown(self):
+        self.path_check.remove_job_folder(self.base_folder)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex server at {expected_plex_path}."
-        )
+    def test_create_job_folder_is_unique(self):
+        """Two jobs under the same base folder get different scratch folders."""
+        first = self.path_check.create_job_folder(self.base_folder)
+        second = self.path_check.create_job_folder(self.base_folder)
 
-    # Tests for download_playlist_plex_command
-    async def test_download_playlist_plex_command_location_none(self):
-        """Test download_playlist_plex_command with location=None."""
-        playlist_url = "test_plex_playlist_url_none"
-        dummy_urls = ["url1", "url2"]
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.path.dirname(first), self.base_folder)
+        self.assertTrue(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(plex_music_folder, "song.mp3")
+    def test_remove_job_folder_only_removes_its_own_files(self):
+        """Removing one job folder leaves a parallel job's files untouched."""
+        first = self.path_check.create_job_folder(self.base_folder)
+        second = self.path_check.create_job_folder(self.base_folder)
+        for folder in (first, second):
+            with open(os.path.join(folder, "audio.mp3"), "wb") as handler:
+                handler.write(b"data")
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
+        self.path_check.remove_job_folder(first)
 
-        await self.cog.download_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=None)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.isfile(os.path.join(second, "audio.mp3")))
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
 
-        initial_path_exists_calls = [call(download_music_folder), call(plex_music_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+class TestPlaylistExecutor(unittest.IsolatedAsyncioTestCase):
 
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
-        self.assertEqual(self.cog.downloader.download_audio.call_count, len(dummy_urls))
+    async def test_results_are_reported_in_playlist_order(self):
+        """Items finishing out of order are still reported in playlist order."""
+        executor = PlaylistExecutor(workers=3, retries=0)
+        delays = {"url1": 0.03, "url2": 0.01, "url3": 0.0}
+        reported = []
 
-        convert_to_mp3_calls = [call(dummy_song_obj, plex_music_folder) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
-        self.assertEqual(self.cog.converter.convert_to_mp3.call_count, len(dummy_urls))
+        async def handler(item):
+            await asyncio.sleep(delays[item.url])
+            return item.url.upper()
 
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-        self.assertEqual(self.cog.path_check.clear_local_cache.call_count, len(dummy_urls))
+        async def on_result(item):
+            reported.append(item.result)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex at {plex_music_folder}."
-        )
+        items = await executor.run(list(delays), handler, on_result)
 
-    async def test_download_playlist_plex_command_location_absolute(self):
-        """Test download_playlist_plex_command with an absolute path for location."""
-        playlist_url = "test_plex_playlist_url_abs"
-        abs_plex_location = "/custom/plex/abs/playlist/path"
-        dummy_urls = ["url1", "url2"]
+        self.assertEqual(reported, ["URL1", "URL2", "URL3"])
+        self.assertEqual([item.index for item in items], [0, 1, 2])
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_plex_location, "song.mp3")
+    async def test_worker_count_bounds_concurrency(self):
+        """No more than `workers` items run at the same time."""
+        executor = PlaylistExecutor(workers=2, retries=0)
+        running = 0
+        peak = 0
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
+        async def handler(item):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
 
-        await self.cog.download_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=abs_plex_location)
+        await executor.run([f"url{i}" for i in range(6)], handler)
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+        self.assertEqual(peak, 2)
 
-        initial_path_exists_calls = [call(download_music_folder), call(abs_plex_location)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+    async def test_failed_items_are_retried_then_reported(self):
+        """A flaky item succeeds on retry; a broken item keeps its last error."""
+        executor = PlaylistExecutor(workers=2, retries=1, retry_delay=0)
+        calls = {"flaky": 0, "broken": 0}
 
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
+        async def handler(item):
+            calls[item.url] += 1
+            if item.url == "broken" or calls[item.url] == 1:
+                raise ValueError(item.url)
+            return "ok"
 
-        convert_to_mp3_calls = [call(dummy_song_obj, abs_plex_location) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
+        flaky, broken = await executor.run(["flaky", "broken"], handler)
 
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+        self.assertEqual((flaky.result, flaky.error, flaky.attempts), ("ok", None, 2))
+        self.assertIsInstance(broken.error, ValueError)
+        self.assertEqual(broken.attempts, 2)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex at {abs_plex_location}."
-        )
+    async def test_permanent_errors_are_not_retried(self):
+        """An invalid URL fails on the first attempt however many retries are allowed."""
+        executor = PlaylistExecutor(retries=3, retry_delay=0)
 
-    async def test_download_playlist_plex_command_location_relative(self):
-        """Test download_playlist_plex_command with a relative path for location."""
-        playlist_url = "test_plex_playlist_url_rel"
-        rel_plex_location = "my_plex_playlist"
-        expected_plex_path = os.path.join(plex_music_folder, rel_plex_location)
-        dummy_urls = ["url1", "url2"]
+        async def handler(item):
+            raise InvalidURL
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_plex_path, "song.mp3")
+        item, = await executor.run(["not a video"], handler)
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
+        self.assertIsInstance(item.error, InvalidURL)
+        self.assertEqual(item.attempts, 1)
 
-        await self.cog.download_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=rel_plex_location)
+    async def test_cancelled_run_cleans_up_unfinished_items(self):
+        """Cancelling a run stops its workers and cleans up the items that were in progress or still queued."""
+        executor = PlaylistExecutor(workers=1, retries=0, queue_size=1)
+        started = asyncio.Event()
+        cleaned = []
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+        async def handler(item):
+            started.set()
+            await asyncio.sleep(10)
 
-        initial_path_exists_calls = [call(download_music_folder), call(expected_plex_path)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+        async def cleanup(item):
+            cleaned.append(item.url)
 
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
+        run = asyncio.create_task(executor.run(["a", "b"], handler, cleanup=cleanup))
+        await started.wait()
+        run.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await run
 
-        convert_to_mp3_calls = [call(dummy_song_obj, expected_plex_path) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
+        self.assertEqual(sorted(cleaned), ["a", "b"])
 
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+    async def test_stages_pass_results_along_and_skip_after_failure(self):
+        """Each stage sees the previous stage's result; a failed item skips later stages but is still cleaned up."""
+        executor = PlaylistExecutor(retries=0, queue_size=1)
+        delivered = []
+        cleaned = []
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex at {expected_plex_path}."
-        )
+        async def download(item):
+            if item.url == "bad":
+                raise ValueError("no stream")
+            return item.url + ".webm"
 
-# Dummy Video object for mocking
-dummy_video_obj = MagicMock() # Using MagicMock to simplify, can be a real Video object too
-dummy_video_obj.audio_path = "dummy/video/audio.mp4"
-dummy_video_obj.video_path = "dummy/video/video.mp4"
-dummy_video_obj.title = "Dummy Video Title"
-dummy_video_obj.youtube_name = "Dummy Video YouTube Name"
-dummy_video_obj.path = "" # Will be set by combine_video_and_audio mock normally
+        async def convert(item):
+            return item.result.replace(".webm", ".mp3")
 
+        async def deliver(item):
+            delivered.append(item.result)
+            return item.result
 
-class TestDownloadCog(unittest.IsolatedAsyncioTestCase):
+        async def cleanup(item):
+            cleaned.append(item.url)
 
-    def setUp(self):
-        # Mock the bot instance
-        self.mock_bot = MagicMock()
+        stages = [PipelineStage("download", download, 2), PipelineStage("convert", convert, 2), PipelineStage("deliver", deliver)]
+        items = await executor.run(["a", "bad", "c"], stages, cleanup=cleanup)
 
-        # Instantiate the Cog with the mocked bot
-        self.cog = Download(self.mock_bot)
+        self.assertEqual(sorted(delivered), ["a.mp3", "c.mp3"])
+        self.assertEqual(sorted(cleaned), ["a", "bad", "c"])
+        self.assertEqual(items[1].stage, "download")
+        self.assertIsInstance(items[1].error, ValueError)
 
-        # Mock interaction object
-        self.mock_interaction = MagicMock()
-        self.mock_interaction.response = AsyncMock()
-        self.mock_interaction.followup = AsyncMock()
+    async def test_async_iterable_urls_start_before_enumeration_finishes(self):
+        """Items from an async generator are processed while later urls are still being produced."""
+        executor = PlaylistExecutor(workers=2, retries=0)
+        started = []
 
-        # Mock helper classes attached to the cog instance
-        self.cog.downloader = MagicMock()
-        self.cog.converter = MagicMock()
-        self.cog.path_check = MagicMock()
-        self.cog.uploader = MagicMock()
-        self.cog.mix_publisher = MagicMock()
-        self.cog.mix_finished_subscriber = MagicMock()
+        async def urls():
+            for i in range(3):
+                yield f"url{i}"
+                # The previous item has been picked up before the next url exists.
+                await asyncio.sleep(0.01)
+                self.assertIn(f"url{i}", started)
 
-        # Set default return values for methods that are called
-        # and whose return values are used by the command logic
-        self.cog.downloader.download_audio.return_value = dummy_song_obj
-        self.cog.converter.convert_to_mp3.return_value = "/dummy/converted/song.mp3"
-        self.cog.path_check.check_size_for_discord.return_value = False
-        self.cog.path_check.get_temp_spotify_file.return_value = "/dummy/spotify/song.mp3"
+        async def handler(item):
+            started.append(item.url)
+            return item.index
 
-        # For video commands
-        self.cog.downloader.download_video.return_value = dummy_video_obj
-        self.cog.converter.combine_video_and_audio.return_value = "/dummy/converted/video.mp4"
+        items = await executor.run(urls(), handler)
 
+        self.assertEqual([item.result for item in items], [0, 1, 2])
 
-    async def test_download_command_location_none(self):
-        """Test download_command with location=None."""
-        song_url = "test_url"
 
-        # Reset mocks for this specific test if needed (especially if run in a suite)
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.path_check.check_size_for_discord.reset_mock()
+class TestPlaylistEnumeration(unittest.IsolatedAsyncioTestCase):
 
-        # Redefine return value for this specific test context if it was changed elsewhere
-        self.cog.converter.convert_to_mp3.return_value = "/dummy/converted/song.mp3"
+    def setUp(self):
+        self.pulled = 0
+        self.playlist_url = "https://www.youtube.com/playlist?list=PLUDyUa7vgsQkzBefmiC0UbbpQIHjaI9hd"
 
+        def url_generator():
+            for i in range(100):
+                self.pulled += 1
+                yield f"url{i}"
 
-        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=None)
+        playlist = MagicMock()
+        playlist.url_generator.side_effect = url_generator
+        patcher = patch("bot.cogs.download.pytubefix.Playlist", return_value=playlist)
+        self.playlist_class = patcher.start()
+        self.addCleanup(patcher.stop)
 
-        # Check interaction responses
-        self.mock_interaction.response.defer.assert_called_once()
+    async def test_iter_playlist_applies_indexes_without_loading_everything(self):
+        """Only the urls up to the ending index are pulled from the playlist."""
+        urls = [url async for url in Downloader().iter_playlist(self.playlist_url, 2, 5)]
 
-        # Check path_exists calls
-        expected_path_exists_calls = [
-            call(download_music_folder),
-            call(music_conversion_folder)
-        ]
-        self.cog.path_check.path_exists.assert_has_calls(expected_path_exists_calls, any_order=True)
+        self.assertEqual(urls, ["url2", "url3", "url4"])
+        self.assertEqual(self.pulled, 5)
 
-        # Check downloader call
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
+    def test_get_playlist_clamps_indexes(self):
+        """A negative start is treated as zero and an end before the start gives no urls."""
+        downloader = Downloader()
 
-        # Check converter call
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, music_conversion_folder)
+        self.assertEqual(downloader.get_playlist(self.playlist_url, -3, 2), ["url0", "url1"])
+        self.assertEqual(downloader.get_playlist(self.playlist_url, 4, 1), [])
 
-        # Check discord file sending (or upload)
-        self.cog.path_check.check_size_for_discord.assert_called_once_with("/dummy/converted/song.mp3")
-        # Assuming file is small enough for direct send
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
+    def test_repeated_listing_is_served_from_cache(self):
+        """A second run over an already listed part of the playlist makes no page requests."""
+        downloader = Downloader()
 
+        self.assertEqual(downloader.get_playlist(self.playlist_url, 0, 10), [f"url{i}" for i in range(10)])
+        self.assertEqual(downloader.get_playlist(self.playlist_url, 3, 6), ["url3", "url4", "url5"])
 
-        # Check cache clearing
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
+        self.assertEqual(self.playlist_class.call_count, 1)
+        self.assertEqual(self.pulled, 10)
 
-    async def test_download_command_location_absolute(self):
-        """Test download_command with an absolute path for location."""
-        song_url = "test_url_abs"
-        abs_location = "/custom/abs/path"
+        # Asking past what has been listed so far goes back to YouTube.
+        self.assertEqual(len(downloader.get_playlist(self.playlist_url)), 100)
+        self.assertEqual(self.playlist_class.call_count, 2)
 
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.path_check.check_size_for_discord.reset_mock()
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_location, "song.mp3")
+class TestDownloadVideo(unittest.TestCase):
 
-        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=abs_location)
+    def test_audio_and_video_streams_download_concurrently(self):
+        """Both streams are in flight at the same time and both files are reported."""
+        downloader = Downloader(metadata_cache=MetadataCache(ttl=0))
+        video = MagicMock(title="Artist - Title", length=60, video_id="abc")
+        both_started = threading.Barrier(2, timeout=1)
 
-        self.mock_interaction.response.defer.assert_called_once()
+        def download_stream(video, stream, download_folder, filename, cancel):
+            # Fails with BrokenBarrierError unless the other stream is downloading too.
+            both_started.wait()
 
-        self.cog.path_check.path_exists.assert_called_once_with(abs_location)
+        with patch.object(downloader, "get_video", return_value=video), \
+                patch.object(downloader.stream_selector, "select", return_value=(MagicMock(), MagicMock())), \
+                patch.object(downloader, "download_stream", side_effect=download_stream) as download:
+            mp4 = downloader.download_video("https://youtu.be/abc", "/tmp/job")
 
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, abs_location)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, abs_location)
+        self.assertEqual(download.call_count, 2)
+        self.assertEqual((mp4.audio_path, mp4.video_path), ("/tmp/job/audio.webm", "/tmp/job/video.mp4"))
 
-        self.cog.path_check.check_size_for_discord.assert_called_once_with(os.path.join(abs_location, "song.mp3"))
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
+    def test_a_failed_stream_cancels_the_other(self):
+        """The error of one stream is raised as soon as the other has stopped, not once it has finished."""
+        downloader = Downloader(metadata_cache=MetadataCache(ttl=0))
+        video = MagicMock(title="Artist - Title", length=60, video_id="abc")
+        cancelled = []
 
-        self.cog.path_check.clear_local_cache.assert_called_once_with(abs_location)
+        def download_stream(video, stream, download_folder, filename, cancel):
+            if filename == "audio.webm":
+                raise requests.ConnectionError("audio failed")
+            # Stands in for a long video download that only stops when cancelled.
+            cancelled.append(cancel.wait(timeout=5))
 
-    async def test_download_command_location_relative(self):
-        """Test download_command with a relative path for location."""
-        song_url = "test_url_rel"
-        rel_location = "my_songs"
+        with patch.object(downloader, "get_video", return_value=video), \
+                patch.object(downloader.stream_selector, "select", return_value=(MagicMock(), MagicMock())), \
+                patch.object(downloader, "download_stream", side_effect=download_stream):
+            with self.assertRaisesRegex(requests.ConnectionError, "audio failed"):
+                downloader.download_video("https://youtu.be/abc", "/tmp/job")
 
-        expected_download_path = os.path.join(download_music_folder, rel_location)
-        expected_conversion_path = os.path.join(music_conversion_folder, rel_location)
+        self.assertEqual(cancelled, [True])
 
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.path_check.check_size_for_discord.reset_mock()
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_conversion_path, "song.mp3")
+def fake_stream(itag, height=None, fps=30, subtype="mp4", bitrate=0, filesize=0, audio=False):
+    """Builds a stand-in for a pytubefix Stream."""
+    return MagicMock(itag=itag, height=height, resolution=f"{height}p" if height else None, fps=fps, subtype=subtype, bitrate=bitrate,
+                     filesize=filesize, includes_video_track=height is not None, includes_audio_track=audio or height is None)
 
-        await self.cog.download_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=rel_location)
 
-        self.mock_interaction.response.defer.assert_called_once()
+class TestStreamSelector(unittest.TestCase):
 
-        expected_path_calls = [
-            call(expected_download_path),
-            call(expected_conversion_path)
+    def setUp(self):
+        self.audio = fake_stream(140, bitrate=128000, filesize=5)
+        self.streams = [
+            fake_stream(139, bitrate=48000, filesize=2),
+            self.audio,
+            fake_stream(18, height=360, audio=True, filesize=20),
+            fake_stream(137, height=1080, filesize=400),
+            fake_stream(248, height=1080, subtype="webm", filesize=300),
+            fake_stream(136, height=720, filesize=150),
+            fake_stream(313, height=2160, subtype="webm", filesize=2000),
         ]
-        self.cog.path_check.path_exists.assert_has_calls(expected_path_calls, any_order=True)
-
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, expected_download_path)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, expected_conversion_path)
-
-        self.cog.path_check.check_size_for_discord.assert_called_once_with(os.path.join(expected_conversion_path, "song.mp3"))
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-        self.cog.path_check.clear_local_cache.assert_called_once_with(expected_download_path)
-
-    # Tests for download_playlist_command
-    async def test_download_playlist_command_location_none(self):
-        """Test download_playlist_command with location=None."""
-        playlist_url = "test_playlist_url"
-        dummy_urls = ["url1", "url2"]
-
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
 
+    def test_preferences_come_first(self):
+        """A preferred itag or quality beats higher-resolution streams, and the best audio is paired with it."""
+        self.assertEqual(StreamSelector([137], max_resolution=0).select(self.streams), (self.streams[3], self.audio))
+        self.assertEqual(StreamSelector(["720p"], max_resolution=0).select(self.streams)[0].itag, 136)
+
+    def test_max_resolution_and_size_limit_the_choice(self):
+        """Streams above the resolution cap, or pairs above the size cap, are skipped."""
+        self.assertEqual(StreamSelector([], max_resolution=0).select(self.streams)[0].itag, 313)
+        # Equal resolution prefers mp4.
+        self.assertEqual(StreamSelector([], max_resolution=1080).select(self.streams)[0].itag, 137)
+        self.assertEqual(StreamSelector([137], max_resolution=1080, max_size=310).select(self.streams)[0].itag, 248)
+        self.assertIsNone(StreamSelector([], max_size=10).select(self.streams)[0])
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def test_entries_expire_after_ttl(self):
+        """Values are dropped once their TTL has passed."""
+        cache = MetadataCache(ttl=60, max_entries=10)
+        with patch("bot.cogs.download.time.monotonic", return_value=1000.0):
+            cache.put("video:a", "A")
+        with patch("bot.cogs.download.time.monotonic", return_value=1059.0):
+            self.assertEqual(cache.get("video:a"), "A")
+        with patch("bot.cogs.download.time.monotonic", return_value=1061.0):
+            self.assertIsNone(cache.get("video:a"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """Past max_entries the entry used longest ago goes first."""
+        cache = MetadataCache(ttl=60, max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+    def test_videos_are_reused_until_invalidated(self):
+        """Downloader reuses the YouTube object for the same video ID across URL forms."""
+        downloader = Downloader(metadata_cache=MetadataCache(ttl=60, max_entries=10))
+        with patch("bot.cogs.download.pytubefix.YouTube") as youtube:
+            first = downloader.get_video("https://www.youtube.com/watch?v=iLo6uCGhlmU")
+            second = downloader.get_video("https://youtu.be/iLo6uCGhlmU")
+            downloader.metadata_cache.invalidate("video:iLo6uCGhlmU")
+            downloader.get_video("https://youtu.be/iLo6uCGhlmU")
+
+        self.assertIs(first, second)
+        self.assertEqual(youtube.call_count, 2)
+
+
+class TestMediaIndex(unittest.TestCase):
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = "/dummy/converted/song.mp3" # Generic path for song.mp3
-
-        await self.cog.download_playlist_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=None)
-
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
-
-        initial_path_exists_calls = [call(download_music_folder), call(music_conversion_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
-
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
-        self.assertEqual(self.cog.downloader.download_audio.call_count, len(dummy_urls))
-
-        convert_to_mp3_calls = [call(dummy_song_obj, music_conversion_folder) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
-        self.assertEqual(self.cog.converter.convert_to_mp3.call_count, len(dummy_urls))
-
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-        self.assertEqual(self.cog.path_check.clear_local_cache.call_count, len(dummy_urls))
-
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-
-
-    async def test_download_playlist_command_location_absolute(self):
-        """Test download_playlist_command with an absolute path for location."""
-        playlist_url = "test_playlist_url_abs"
-        abs_location = "/custom/abs/playlist/path"
-        dummy_urls = ["url1", "url2"]
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.index = MediaIndex(os.path.join(self.folder, "index.sqlite3"))
+        self.song_path = os.path.join(self.folder, "song.mp3")
+        with open(self.song_path, "wb") as handler:
+            handler.write(b"song bytes")
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+    def tearDown(self):
+        self.index.close()
+        LocalPathCheck().remove_job_folder(self.folder)
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_location, "song.mp3")
+    def test_media_key_recognises_youtube_and_spotify(self):
+        """Keys are derived from the URL alone and are the same for every URL form of a video."""
+        self.assertEqual(MediaIndex.media_key("https://www.youtube.com/watch?v=iLo6uCGhlmU&list=abc"), "youtube:iLo6uCGhlmU")
+        self.assertEqual(MediaIndex.media_key("https://youtu.be/iLo6uCGhlmU"), "youtube:iLo6uCGhlmU")
+        self.assertEqual(MediaIndex.media_key("https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC?si=x"), "spotify:4uLU6hMCjMI75M1A2tKUQC")
+        self.assertIsNone(MediaIndex.media_key("not a url"))
 
-        await self.cog.download_playlist_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=abs_location)
+    def test_add_then_lookup(self):
+        """A recorded file is found again with its size and hash."""
+        self.index.add("youtube:abc", "audio", self.song_path)
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+        record = self.index.lookup("youtube:abc", "audio")
 
-        self.cog.path_check.path_exists.assert_called_once_with(abs_location)
+        self.assertEqual(record["path"], self.song_path)
+        self.assertEqual(record["size"], len(b"song bytes"))
+        self.assertEqual(len(record["md5"]), 32)
+        self.assertIsNone(self.index.lookup("youtube:abc", "video"))
 
-        download_audio_calls = [call(url, abs_location) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
+    def test_lookup_drops_records_for_deleted_files(self):
+        """A file removed from disk is no longer reported as downloaded."""
+        self.index.add("youtube:abc", "audio", self.song_path)
+        os.remove(self.song_path)
 
-        convert_to_mp3_calls = [call(dummy_song_obj, abs_location) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
+        self.assertIsNone(self.index.lookup("youtube:abc", "audio"))
 
-        clear_local_cache_calls = [call(abs_location) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
 
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
+class TestJobQueue(unittest.IsolatedAsyncioTestCase):
 
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.queue = JobQueue(os.path.join(self.folder, "jobs.sqlite3"))
+
+    def tearDown(self):
+        self.queue.close()
+        LocalPathCheck().remove_job_folder(self.folder)
+
+    def test_jobs_are_claimed_in_order_and_requeued_after_a_restart(self):
+        """A job left running is queued again, and a finished one is not."""
+        first = self.queue.enqueue("download", {"url": "a"}, 123)
+        second = self.queue.enqueue("playlist", {"url": "b"}, 123)
+
+        self.assertEqual(self.queue.claim(), {"id": first, "kind": "download", "params": {"url": "a"}, "channel_id": 123})
+        self.queue.finish(first)
+        self.assertEqual(self.queue.claim()["id"], second)
+        self.assertIsNone(self.queue.claim())
+
+        # A new queue on the same database is what the bot sees after a restart.
+        restarted = JobQueue(self.queue.db_path)
+        self.assertEqual(restarted.requeue_unfinished(), 1)
+        self.assertEqual(restarted.claim()["id"], second)
+        restarted.close()
+
+    def test_interactive_jobs_are_claimed_before_bulk_ones(self):
+        """A single download queued behind playlist imports runs next."""
+        self.queue.enqueue("playlist", {"url": "a"}, priority=JobQueue.BULK)
+        self.queue.enqueue("playlist", {"url": "b"}, priority=JobQueue.BULK)
+        single = self.queue.enqueue("download", {"url": "c"})
+
+        self.assertEqual(self.queue.claim()["id"], single)
+        self.assertEqual(self.queue.claim()["params"], {"url": "a"})
+
+    def test_jobs_interrupted_too_often_are_not_requeued(self):
+        """A job that was running at each of max_attempts restarts is failed instead of queued again."""
+        queue = JobQueue(self.queue.db_path, max_attempts=2)
+        job_id = queue.enqueue("download", {"url": "a"})
+        self.assertEqual(queue.claim()["id"], job_id)
+        self.assertEqual(queue.requeue_unfinished(), 1)
+        self.assertEqual(queue.claim()["id"], job_id)
+        self.assertEqual(queue.requeue_unfinished(), 0)
+
+        self.assertIsNone(queue.claim())
+        status, error = queue.connection.execute("SELECT status, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        self.assertEqual((status, error), ("failed", "Gave up after 2 attempts"))
+        queue.close()
+
+    async def test_resumed_playlist_job_skips_finished_items(self):
+        """Items a previous run finished are neither run nor reported again; failed ones are retried."""
+        finished_path = os.path.join(self.folder, "song0.mp3")
+        with open(finished_path, "wb") as handler:
+            handler.write(b"song")
+        job = {"id": self.queue.enqueue("playlist", {"url": "list"}), "channel_id": None}
+        self.queue.record_item(job["id"], 0, "url0", "done", result=finished_path)
+        self.queue.record_item(job["id"], 1, "url1", "failed", error="no stream")
+
+        cog = Download.__new__(Download)
+        cog.job_queue = self.queue
+        cog.playlist_executor = PlaylistExecutor(retries=0)
+        cog.path_check = LocalPathCheck()
+        progress_message = MagicMock(edit=AsyncMock())
+        cog.notify = AsyncMock(return_value=progress_message)
+        ran = []
+        reported = []
+
+        async def download(item):
+            ran.append(item.url)
+            return item.url + ".mp3"
+
+        async def report(item):
+            reported.append(item.url)
+
+        items = await cog.run_playlist_job(job, ["url0", "url1", "url2"], [PipelineStage("download", download)], report, "list")
+
+        self.assertEqual(ran, ["url1", "url2"])
+        self.assertEqual(reported, ["url1", "url2"])
+        self.assertEqual(items[0].result, finished_path)
+        self.assertEqual(set(self.queue.finished_items(job["id"])), {0, 1, 2})
+        # The progress embed counts resumed items as done.
+        final_embed = progress_message.edit.call_args.kwargs["embed"]
+        self.assertEqual(final_embed.fields[0].value, "3/3")
+
+
+class TestAttachmentBatcher(unittest.IsolatedAsyncioTestCase):
 
-    async def test_download_playlist_command_location_relative(self):
-        """Test download_playlist_command with a relative path for location."""
-        playlist_url = "test_playlist_url_rel"
-        rel_location = "my_playlist_downloads"
-        dummy_urls = ["url1", "url2"]
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sent = []
 
-        expected_download_path = os.path.join(download_music_folder, rel_location)
-        expected_conversion_path = os.path.join(music_conversion_folder, rel_location)
+    def tearDown(self):
+        LocalPathCheck().remove_job_folder(self.folder)
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+    def make_file(self, name, size):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as handler:
+            handler.write(b"x" * size)
+        return path
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_conversion_path, "song.mp3")
+    async def send(self, paths):
+        self.sent.append([os.path.basename(path) for path in paths])
 
-        await self.cog.download_playlist_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=rel_location)
+    async def test_files_are_packed_by_count_and_size(self):
+        """A batch is sent when it reaches max_files or the next file would exceed max_bytes."""
+        batcher = AttachmentBatcher(self.send, max_files=3, max_bytes=100, delay=60)
+        for index in range(4):
+            await batcher.add(self.make_file(f"small{index}.mp3", 10))
+        await batcher.add(self.make_file("big.mp3", 95))
+        await batcher.flush()
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+        self.assertEqual(self.sent, [["small0.mp3", "small1.mp3", "small2.mp3"], ["small3.mp3"], ["big.mp3"]])
 
-        initial_path_exists_calls = [call(expected_download_path), call(expected_conversion_path)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+    async def test_partly_filled_batch_is_sent_after_the_delay(self):
+        """Files don't wait for a full batch forever."""
+        batcher = AttachmentBatcher(self.send, max_files=10, max_bytes=100, delay=0.01)
+        await batcher.add(self.make_file("song.mp3", 10))
+        await asyncio.sleep(0.05)
 
-        download_audio_calls = [call(url, expected_download_path) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
+        self.assertEqual(self.sent, [["song.mp3"]])
 
-        convert_to_mp3_calls = [call(dummy_song_obj, expected_conversion_path) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
+    async def test_flush_during_a_timed_send_loses_nothing(self):
+        """A flush while the timer is sending waits for that send, and files added meanwhile get a timer of their own."""
+        sending = asyncio.Event()
+        release = asyncio.Event()
 
-        clear_local_cache_calls = [call(expected_download_path) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+        async def slow_send(paths):
+            sending.set()
+            await release.wait()
+            await self.send(paths)
 
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
+        batcher = AttachmentBatcher(slow_send, max_files=10, max_bytes=100, delay=0.01)
+        await batcher.add(self.make_file("a.mp3", 10))
+        await sending.wait()
+        await batcher.add(self.make_file("b.mp3", 10))
+        self.assertIsNotNone(batcher.timer)
 
-    # Tests for download_plex_command
-    async def test_download_plex_command_location_none(self):
-        """Test download_plex_command with location=None."""
-        song_url = "test_plex_url_none"
+        flush = asyncio.create_task(batcher.flush())
+        await asyncio.sleep(0.02)
+        release.set()
+        await flush
 
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        self.assertEqual(self.sent, [["a.mp3"], ["b.mp3"]])
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(plex_music_folder, "song.mp3")
+    async def test_on_sent_runs_only_after_a_successful_send(self):
+        """Callbacks wait for their batch's message and are dropped if it could not be sent."""
+        results = [None, True]
+        delivered = []
 
-        await self.cog.download_plex_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=None)
+        async def send(paths):
+            return results.pop(0)
 
-        self.mock_interaction.response.defer.assert_called_once()
+        batcher = AttachmentBatcher(send, max_files=1, max_bytes=100, delay=60)
+        for name in ("lost.mp3", "sent.mp3"):
+            await batcher.add(self.make_file(name, 10), on_sent=AsyncMock(side_effect=lambda name=name: delivered.append(name)))
 
-        path_exists_calls = [call(download_music_folder), call(plex_music_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
+        self.assertEqual(delivered, ["sent.mp3"])
 
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, plex_music_folder)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex server at {plex_music_folder}."
-        )
+class TestProgressReporter(unittest.IsolatedAsyncioTestCase):
 
-    async def test_download_plex_command_location_absolute(self):
-        """Test download_plex_command with an absolute path for location."""
-        song_url = "test_plex_url_abs"
-        abs_plex_location = "/custom/plex/abs/path"
+    async def test_updates_are_throttled_to_one_edit_per_interval(self):
+        """Many items finishing at once cause a single edit, which shows all of them."""
+        message = MagicMock(edit=AsyncMock())
+        send = AsyncMock(return_value=message)
+        progress = ProgressReporter("Job #1", "playlist", send, interval=0.05)
+        await progress.start()
 
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        urls = [url async for url in progress.track(["a", "b", "c"])]
+        for index, url in enumerate(urls):
+            item = PlaylistItem(index, url)
+            item.error = ValueError() if url == "b" else None
+            progress.item_finished(item)
+        await asyncio.sleep(0.1)
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_plex_location, "song.mp3")
+        send.assert_awaited_once()
+        message.edit.assert_awaited_once()
+        fields = {field.name: field.value for field in message.edit.call_args.kwargs["embed"].fields}
+        self.assertEqual((fields["Done"], fields["Failed"], fields["In progress"]), ("2/3", "1", "0"))
+
+        await progress.finish()
+        self.assertEqual(message.edit.await_count, 2)
+        self.assertNotIn("ETA", [field.name for field in message.edit.call_args.kwargs["embed"].fields])
+
+
+class TestConverter(unittest.TestCase):
+
+    def test_audio_input_args_prefers_local_file(self):
+        """A staged download is read from disk."""
+        song = Song()
+        song.path = "/tmp/job/audio.mp3"
+
+        self.assertEqual(Converter().audio_input_args(song), ["-i", "/tmp/job/audio.mp3"])
 
-        await self.cog.download_plex_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=abs_plex_location)
+    def test_audio_input_args_streams_url_without_staging_file(self):
+        """In streaming mode ffmpeg reads the stream URL directly, with reconnects enabled."""
+        song = Song()
+        song.stream_url = "https://example.com/videoplayback"
 
-        self.mock_interaction.response.defer.assert_called_once()
+        args = Converter().audio_input_args(song)
 
-        path_exists_calls = [call(download_music_folder), call(abs_plex_location)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
+        self.assertEqual(args[-2:], ["-i", "https://example.com/videoplayback"])
+        self.assertIn("-reconnect_streamed", args)
 
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, abs_plex_location)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex server at {abs_plex_location}."
-        )
+class TestTranscodeScheduler(unittest.IsolatedAsyncioTestCase):
 
-    async def test_download_plex_command_location_relative(self):
-        """Test download_plex_command with a relative path for location."""
-        song_url = "test_plex_url_rel"
-        rel_plex_location = "my_plex_songs"
-        expected_plex_path = os.path.join(plex_music_folder, rel_plex_location)
+    async def test_slots_cap_concurrency_and_interactive_jobs_go_first(self):
+        """Waiting interactive jobs get the next free slot ahead of bulk jobs that queued earlier."""
+        scheduler = TranscodeScheduler(slots=1, threads=2)
+        order = []
 
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        async def job(name, priority):
+            async with scheduler.slot(priority):
+                order.append(name)
+                await asyncio.sleep(0)
 
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_plex_path, "song.mp3")
+        await scheduler.acquire()
+        tasks = [asyncio.create_task(job("bulk1", TranscodeScheduler.BULK)), asyncio.create_task(job("bulk2", TranscodeScheduler.BULK))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job("interactive", TranscodeScheduler.INTERACTIVE)))
+        await asyncio.sleep(0)
+        self.assertEqual(order, [])
 
-        await self.cog.download_plex_command.callback(self.cog, self.mock_interaction, song_url=song_url, location=rel_plex_location)
+        scheduler.release()
+        await asyncio.gather(*tasks)
 
-        self.mock_interaction.response.defer.assert_called_once()
+        self.assertEqual(order, ["interactive", "bulk1", "bulk2"])
+        self.assertEqual(scheduler.active, 0)
 
-        path_exists_calls = [call(download_music_folder), call(expected_plex_path)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
+    async def test_cancelled_waiter_does_not_leak_its_slot(self):
+        """A job cancelled while queued is skipped and the slot goes to the next one."""
+        scheduler = TranscodeScheduler(slots=1, threads=1)
+        await scheduler.acquire()
+        cancelled = asyncio.create_task(scheduler.acquire())
+        waiting = asyncio.create_task(scheduler.acquire(TranscodeScheduler.BULK))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
 
-        self.cog.downloader.download_audio.assert_called_once_with(song_url, download_music_folder)
-        self.cog.converter.convert_to_mp3.assert_called_once_with(dummy_song_obj, expected_plex_path)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_music_folder)
+        scheduler.release()
+        await waiting
+        scheduler.release()
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex server at {expected_plex_path}."
-        )
+        self.assertEqual(scheduler.active, 0)
 
-    # Tests for download_playlist_plex_command
-    async def test_download_playlist_plex_command_location_none(self):
-        """Test download_playlist_plex_command with location=None."""
-        playlist_url = "test_plex_playlist_url_none"
-        dummy_urls = ["url1", "url2"]
+    async def test_converter_passes_threads_before_the_output_path(self):
+        """ffmpeg gets -threads sized by the scheduler, as an output option."""
+        converter = Converter(scheduler=TranscodeScheduler(slots=1, threads=3))
+        converter.ffmpeg = AsyncMock()
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+        await converter.run_ffmpeg(["-y", "-i", "in.webm", "out.mp3"])
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(plex_music_folder, "song.mp3")
+        self.assertEqual(converter.ffmpeg.run.call_args.args[0], ["-y", "-i", "in.webm", "-threads", "3", "out.mp3"])
 
 
-        await self.cog.download_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=None)
+class TestTargetBitrate(unittest.TestCase):
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+    def test_bitrate_fits_the_upload_limit(self):
+        """The highest LAME bitrate whose output (plus the cover) stays under the limit is chosen."""
+        converter = Converter()
+        # 10 minutes into 25MB leaves roughly 330kbps, so full quality fits.
+        self.assertEqual(converter.bitrate_for_size(600, 25 * 1024 * 1024), 320)
+        # 20 minutes into 25MB leaves roughly 171kbps.
+        self.assertEqual(converter.bitrate_for_size(1200, 25 * 1024 * 1024), 160)
+        # A large cover eats into the budget.
+        self.assertEqual(converter.bitrate_for_size(1200, 25 * 1024 * 1024, 4 * 1024 * 1024), 128)
 
-        initial_path_exists_calls = [call(download_music_folder), call(plex_music_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+    def test_no_limit_or_too_low_a_bitrate_keeps_full_quality(self):
+        """Without a limit, or when fitting would need less than the minimum bitrate, songs are encoded at 320k."""
+        converter = Converter()
+        self.assertEqual(converter.bitrate_for_size(1200, None), 320)
+        self.assertEqual(converter.bitrate_for_size(0, 8000000), 320)
+        self.assertEqual(converter.bitrate_for_size(3 * 3600, 8000000), 320)
 
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
-        self.assertEqual(self.cog.downloader.download_audio.call_count, len(dummy_urls))
+    def test_reduced_encodes_get_their_own_name(self):
+        """A copy encoded to fit Discord never overwrites the full quality mp3 of the same song."""
+        converter = Converter()
+        converter.ffmpeg = AsyncMock()
+        song = Song()
+        song.path = "/tmp/job/audio.mp3"
+        song.youtube_name = "Artist - Title"
+        song.title = "Title"
+        song.artist = "Artist"
+        song.duration = 1200
 
-        convert_to_mp3_calls = [call(dummy_song_obj, plex_music_folder) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
-        self.assertEqual(self.cog.converter.convert_to_mp3.call_count, len(dummy_urls))
+        full = asyncio.run(converter.convert_to_mp3(song, "/music"))
+        reduced = asyncio.run(converter.convert_to_mp3(song, "/music", max_bytes=25 * 1024 * 1024))
 
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-        self.assertEqual(self.cog.path_check.clear_local_cache.call_count, len(dummy_urls))
+        self.assertEqual(full, os.path.join("/music", "Artist - Title.mp3"))
+        self.assertEqual(reduced, os.path.join("/music", "Artist - Title (160k).mp3"))
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex at {plex_music_folder}."
-        )
 
-    async def test_download_playlist_plex_command_location_absolute(self):
-        """Test download_playlist_plex_command with an absolute path for location."""
-        playlist_url = "test_plex_playlist_url_abs"
-        abs_plex_location = "/custom/plex/abs/playlist/path"
-        dummy_urls = ["url1", "url2"]
+class TestCropThumbnail(unittest.TestCase):
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
-
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(abs_plex_location, "song.mp3")
-
-
-        await self.cog.download_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=abs_plex_location)
-
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.thumbnail_path = os.path.join(self.folder, "cover.jpeg")
+        # YouTube's hqdefault thumbnails are 4:3 with black bars around a 16:9 picture.
+        Image.new("RGB", (480, 360)).save(self.thumbnail_path)
 
-        initial_path_exists_calls = [call(download_music_folder), call(abs_plex_location)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+    def tearDown(self):
+        LocalPathCheck().remove_job_folder(self.folder)
 
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
+    def test_crop_to_16_9_in_memory(self):
+        """Without an output folder the cropped JPEG comes back as bytes and nothing is written."""
+        cover = Converter().crop_thumbnail(self.thumbnail_path)
 
-        convert_to_mp3_calls = [call(dummy_song_obj, abs_plex_location) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
+        self.assertEqual(Image.open(io.BytesIO(cover)).size, (480, 270))
+        self.assertEqual(os.listdir(self.folder), ["cover.jpeg"])
 
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+    def test_square_crop_is_written_to_output_folder(self):
+        """Square covers are centred and written as new_cover.jpeg when an output folder is given."""
+        path = Converter().crop_thumbnail(self.thumbnail_path, self.folder, square=True)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex at {abs_plex_location}."
-        )
+        self.assertEqual(path, os.path.join(self.folder, "new_cover.jpeg"))
+        self.assertEqual(Image.open(path).size, (360, 360))
 
-    async def test_download_playlist_plex_command_location_relative(self):
-        """Test download_playlist_plex_command with a relative path for location."""
-        playlist_url = "test_plex_playlist_url_rel"
-        rel_plex_location = "my_plex_playlist"
-        expected_plex_path = os.path.join(plex_music_folder, rel_plex_location)
-        dummy_urls = ["url1", "url2"]
+    def test_large_covers_are_scaled_down(self):
+        """Covers are resized to max_size on their longest side."""
+        Image.new("RGB", (1920, 1080)).save(self.thumbnail_path)
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_audio.reset_mock()
-        self.cog.converter.convert_to_mp3.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+        cover = Converter().crop_thumbnail(self.thumbnail_path, max_size=640)
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.convert_to_mp3.return_value = os.path.join(expected_plex_path, "song.mp3")
+        self.assertEqual(Image.open(io.BytesIO(cover)).size, (640, 360))
 
-        await self.cog.download_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=rel_plex_location)
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+class TestConverterPassthrough(unittest.IsolatedAsyncioTestCase):
 
-        initial_path_exists_calls = [call(download_music_folder), call(expected_plex_path)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+    def setUp(self):
+        self.converter = Converter()
+        self.converter.ffmpeg = AsyncMock()
+        self.converter.tag_audio_file = MagicMock()
+        self.song = Song()
+        self.song.path = "/tmp/job/audio.mp3"
+        self.song.youtube_name = "Artist - Title"
+        self.song.title = "Title"
+        self.song.artist = "Artist"
 
-        download_audio_calls = [call(url, download_music_folder) for url in dummy_urls]
-        self.cog.downloader.download_audio.assert_has_calls(download_audio_calls)
+    async def test_opus_is_remuxed_with_stream_copy(self):
+        """Opus audio is copied into an .opus file and tagged, without transcoding."""
+        self.song.audio_codec = "opus"
 
-        convert_to_mp3_calls = [call(dummy_song_obj, expected_plex_path) for _ in dummy_urls]
-        self.cog.converter.convert_to_mp3.assert_has_calls(convert_to_mp3_calls)
+        path = await self.converter.remux_audio(self.song, "/plex")
 
-        clear_local_cache_calls = [call(download_music_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+        self.assertEqual(path, os.path.join("/plex", "Artist - Title.opus"))
+        args = self.converter.ffmpeg.run.call_args.args[0]
+        self.assertEqual(args[args.index("-c:a") + 1], "copy")
+        self.assertNotIn("-b:a", args)
+        self.converter.tag_audio_file.assert_called_once_with(path, self.song, None)
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded song.mp3 to Plex at {expected_plex_path}."
-        )
+    async def test_aac_is_remuxed_into_m4a(self):
+        """AAC audio goes into an .m4a container."""
+        self.song.audio_codec = "mp4a.40.2"
 
-    # Tests for download_video_plex_command
-    async def test_download_video_plex_command_location_none(self):
-        """Test download_video_plex_command with location=None."""
-        video_url = "test_video_plex_url_none"
+        path = await self.converter.remux_audio(self.song, "/plex")
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_video.reset_mock()
-        self.cog.converter.combine_video_and_audio.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        self.assertTrue(path.endswith(".m4a"))
 
-        self.cog.converter.combine_video_and_audio.return_value = os.path.join(plex_video_folder, "video.mp4")
+    async def test_unknown_codec_falls_back_to_mp3(self):
+        """Codecs without a passthrough container are still converted to mp3."""
+        self.song.audio_codec = "vorbis"
+        self.converter.convert_to_mp3 = AsyncMock(return_value="/plex/Artist - Title.mp3")
 
-        await self.cog.download_video_plex_command.callback(self.cog, self.mock_interaction, video_url=video_url, location=None)
+        path = await self.converter.remux_audio(self.song, "/plex")
 
-        self.mock_interaction.response.defer.assert_called_once()
+        self.assertEqual(path, "/plex/Artist - Title.mp3")
+        self.converter.tag_audio_file.assert_not_called()
 
-        path_exists_calls = [call(download_video_folder), call(plex_video_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
 
-        self.cog.downloader.download_video.assert_called_once_with(video_url, download_video_folder)
-        self.cog.converter.combine_video_and_audio.assert_called_once_with(dummy_video_obj, plex_video_folder)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_video_folder)
+class TestFFmpegRunner(unittest.IsolatedAsyncioTestCase):
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Finished downloading video.mp4 to Plex server at {plex_video_folder}."
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        LocalPathCheck().remove_job_folder(self.folder)
+
+    def fake_ffmpeg(self, body):
+        """Writes a stand-in ffmpeg executable that runs the given python body."""
+        path = os.path.join(self.folder, "ffmpeg")
+        with open(path, "w") as handler:
+            handler.write(f"#!{sys.executable}\nimport sys\n{body}\n")
+        os.chmod(path, 0o755)
+        return path
+
+    async def test_progress_is_parsed_and_reported(self):
+        """Progress blocks from -progress pipe:1 are turned into percent done and speed."""
+        binary = self.fake_ffmpeg(
+            "print('out_time_us=N/A\\nspeed=N/A\\nprogress=continue')\n"
+            "print('out_time_us=5000000\\nspeed=2.5x\\nprogress=continue')\n"
+            "print('out_time_us=10000000\\nspeed=3x\\nprogress=end')"
         )
+        updates = []
 
-    async def test_download_video_plex_command_location_absolute(self):
-        """Test download_video_plex_command with an absolute path for location."""
-        video_url = "test_video_plex_url_abs"
-        abs_plex_video_location = "/custom/plex/videos/abs/path"
+        progress = await FFmpegRunner(binary).run(["-i", "in", "out"], duration=10, on_progress=lambda p: updates.append((p.percent, p.speed, p.done)))
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_video.reset_mock()
-        self.cog.converter.combine_video_and_audio.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        self.assertEqual(updates, [(None, 0.0, False), (50.0, 2.5, False), (100.0, 3.0, True)])
+        self.assertTrue(progress.done)
 
-        self.cog.converter.combine_video_and_audio.return_value = os.path.join(abs_plex_video_location, "video.mp4")
+    async def test_non_zero_exit_raises(self):
+        """A failed encode raises instead of being silently ignored."""
+        binary = self.fake_ffmpeg("sys.stderr.write('Invalid data found when processing input\\n')\nsys.exit(1)")
 
-        await self.cog.download_video_plex_command.callback(self.cog, self.mock_interaction, video_url=video_url, location=abs_plex_video_location)
+        with self.assertRaises(FFmpegError) as context:
+            await FFmpegRunner(binary).run(["-i", "broken", "out"])
 
-        self.mock_interaction.response.defer.assert_called_once()
-
-        path_exists_calls = [call(download_video_folder), call(abs_plex_video_location)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
-
-        self.cog.downloader.download_video.assert_called_once_with(video_url, download_video_folder)
-        self.cog.converter.combine_video_and_audio.assert_called_once_with(dummy_video_obj, abs_plex_video_location)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_video_folder)
-
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Finished downloading video.mp4 to Plex server at {abs_plex_video_location}."
-        )
-
-    async def test_download_video_plex_command_location_relative(self):
-        """Test download_video_plex_command with a relative path for location."""
-        video_url = "test_video_plex_url_rel"
-        rel_plex_video_location = "my_plex_videos"
-        expected_plex_video_path = os.path.join(plex_video_folder, rel_plex_video_location)
+        self.assertIn("Invalid data found", str(context.exception))
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_video.reset_mock()
-        self.cog.converter.combine_video_and_audio.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+    async def test_input_bytes_are_fed_to_stdin(self):
+        """Bytes passed to run() reach ffmpeg's stdin so it can read them from pipe:0."""
+        output_path = os.path.join(self.folder, "stdin.bin")
+        binary = self.fake_ffmpeg(f"open({output_path!r}, 'wb').write(sys.stdin.buffer.read())")
 
-        self.cog.converter.combine_video_and_audio.return_value = os.path.join(expected_plex_video_path, "video.mp4")
+        await FFmpegRunner(binary).run(["-i", "pipe:0", "out"], input_bytes=b"jpeg bytes")
 
-        await self.cog.download_video_plex_command.callback(self.cog, self.mock_interaction, video_url=video_url, location=rel_plex_video_location)
+        with open(output_path, "rb") as handler:
+            self.assertEqual(handler.read(), b"jpeg bytes")
 
-        self.mock_interaction.response.defer.assert_called_once()
-
-        path_exists_calls = [call(download_video_folder), call(expected_plex_video_path)]
-        self.cog.path_check.path_exists.assert_has_calls(path_exists_calls, any_order=True)
-
-        self.cog.downloader.download_video.assert_called_once_with(video_url, download_video_folder)
-        self.cog.converter.combine_video_and_audio.assert_called_once_with(dummy_video_obj, expected_plex_video_path)
-        self.cog.path_check.clear_local_cache.assert_called_once_with(download_video_folder)
-
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Finished downloading video.mp4 to Plex server at {expected_plex_video_path}."
+    async def test_progress_callback_error_kills_ffmpeg(self):
+        """An exception from on_progress stops ffmpeg and the helper tasks instead of leaving them running."""
+        pid_path = os.path.join(self.folder, "pid")
+        binary = self.fake_ffmpeg(
+            f"import os, time\nopen({pid_path!r}, 'w').write(str(os.getpid()))\n"
+            "print('out_time_us=0\\nprogress=continue', flush=True)\ntime.sleep(30)"
         )
 
-    # Tests for download_video_playlist_plex_command
-    async def test_download_video_playlist_plex_command_location_none(self):
-        """Test download_video_playlist_plex_command with location=None."""
-        playlist_url = "test_video_plex_playlist_url_none"
-        dummy_urls = ["url1", "url2"]
+        def on_progress(progress):
+            raise RuntimeError("progress message could not be edited")
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_video.reset_mock() # Changed from download_audio
-        self.cog.converter.combine_video_and_audio.reset_mock() # Changed from convert_to_mp3
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+        tasks_before = asyncio.all_tasks()
+        with self.assertRaises(RuntimeError):
+            await FFmpegRunner(binary).run(["-i", "pipe:0", "out"], on_progress=on_progress, input_bytes=b"cover")
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        # Use the general video path for combined video
-        self.cog.converter.combine_video_and_audio.return_value = os.path.join(plex_video_folder, "video.mp4")
+        with open(pid_path) as handler:
+            pid = int(handler.read())
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+        self.assertEqual(asyncio.all_tasks(), tasks_before)
 
-        await self.cog.download_video_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=None)
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+class TestCoverCache(unittest.TestCase):
 
-        initial_path_exists_calls = [call(download_video_folder), call(plex_video_folder)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.session = MagicMock()
+        self.session.get.return_value.content = b"x" * 10
 
-        download_video_calls = [call(url, download_video_folder) for url in dummy_urls]
-        self.cog.downloader.download_video.assert_has_calls(download_video_calls)
-        self.assertEqual(self.cog.downloader.download_video.call_count, len(dummy_urls))
+    def tearDown(self):
+        LocalPathCheck().remove_job_folder(self.folder)
 
-        combine_video_calls = [call(dummy_video_obj, plex_video_folder) for _ in dummy_urls]
-        self.cog.converter.combine_video_and_audio.assert_has_calls(combine_video_calls)
-        self.assertEqual(self.cog.converter.combine_video_and_audio.call_count, len(dummy_urls))
+    def test_repeated_cover_is_served_from_disk(self):
+        """The second request for the same video reuses the cached file."""
+        cache = CoverCache(self.folder, max_bytes=1000, session=self.session)
 
-        clear_local_cache_calls = [call(download_video_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
-        self.assertEqual(self.cog.path_check.clear_local_cache.call_count, len(dummy_urls))
+        first = cache.get("https://i.ytimg.com/vi/abc/hqdefault.jpg", "abc")
+        second = cache.get("https://i.ytimg.com/vi/abc/hqdefault.jpg?changed=1", "abc")
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded video.mp4 to plex." # Message from the loop
-        )
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Finished downloading video playlist to Plex server at {plex_video_folder}." # Final message
-        )
+        self.assertEqual(first, second)
+        self.session.get.assert_called_once()
 
+    def test_least_recently_used_covers_are_evicted(self):
+        """Going over max_bytes removes the covers that were used longest ago."""
+        cache = CoverCache(self.folder, max_bytes=25, session=self.session)
+        oldest = cache.get("https://example.com/1.jpg", "one")
+        os.utime(oldest, (0, 0))
+        recent = cache.get("https://example.com/2.jpg", "two")
 
-    async def test_download_video_playlist_plex_command_location_absolute(self):
-        """Test download_video_playlist_plex_command with an absolute path for location."""
-        playlist_url = "test_video_plex_playlist_url_abs"
-        abs_plex_video_location = "/custom/plex/videos/abs/playlist/path"
-        dummy_urls = ["url1", "url2"]
+        newest = cache.get("https://example.com/3.jpg", "three")
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_video.reset_mock()
-        self.cog.converter.combine_video_and_audio.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(newest))
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.combine_video_and_audio.return_value = os.path.join(abs_plex_video_location, "video.mp4")
+    def test_job_copies_survive_eviction(self):
+        """A cover copied into a job folder stays usable after the cached file is evicted."""
+        cache = CoverCache(os.path.join(self.folder, "cache"), max_bytes=15, session=self.session)
+        job_folder = os.path.join(self.folder, "job")
+        os.makedirs(job_folder)
 
-        await self.cog.download_video_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=abs_plex_video_location)
+        cover = cache.get("https://example.com/1.jpg", "one", copy_to=os.path.join(job_folder, "cover.jpeg"))
+        os.utime(cache.cache_path("https://example.com/1.jpg", "one"), (0, 0))
+        cache.get("https://example.com/2.jpg", "two")
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
+        self.assertEqual(cover, os.path.join(job_folder, "cover.jpeg"))
+        self.assertFalse(os.path.exists(cache.cache_path("https://example.com/1.jpg", "one")))
+        with open(cover, "rb") as handler:
+            self.assertEqual(handler.read(), b"x" * 10)
 
-        initial_path_exists_calls = [call(download_video_folder), call(abs_plex_video_location)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
 
-        download_video_calls = [call(url, download_video_folder) for url in dummy_urls]
-        self.cog.downloader.download_video.assert_has_calls(download_video_calls)
 
-        combine_video_calls = [call(dummy_video_obj, abs_plex_video_location) for _ in dummy_urls]
-        self.cog.converter.combine_video_and_audio.assert_has_calls(combine_video_calls)
+class FakeRangeResponse:
+    """Stands in for a streamed requests.Response to a Range request."""
 
-        clear_local_cache_calls = [call(download_video_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+    def __init__(self, data, status_code=206, fail_after=None):
+        self.data = data
+        self.status_code = status_code
+        self.fail_after = fail_after
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded video.mp4 to plex."
-        )
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Finished downloading video playlist to Plex server at {abs_plex_video_location}."
-        )
+    def __enter__(self):
+        return self
 
-    async def test_download_video_playlist_plex_command_location_relative(self):
-        """Test download_video_playlist_plex_command with a relative path for location."""
-        playlist_url = "test_video_plex_playlist_url_rel"
-        rel_plex_video_location = "my_plex_video_playlist"
-        expected_plex_video_path = os.path.join(plex_video_folder, rel_plex_video_location)
-        dummy_urls = ["url1", "url2"]
+    def __exit__(self, *exc):
+        return False
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_video.reset_mock()
-        self.cog.converter.combine_video_and_audio.reset_mock()
-        self.cog.path_check.clear_local_cache.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
-        self.cog.downloader.get_playlist.reset_mock()
+    def raise_for_status(self):
+        pass
 
-        self.cog.downloader.get_playlist.return_value = dummy_urls
-        self.cog.converter.combine_video_and_audio.return_value = os.path.join(expected_plex_video_path, "video.mp4")
+    def iter_content(self, chunk_size):
+        sent = 0
+        for start in range(0, len(self.data), 4):
+            if self.fail_after is not None and sent >= self.fail_after:
+                raise requests.ConnectionError("connection dropped")
+            chunk = self.data[start:start + 4]
+            sent += len(chunk)
+            yield chunk
 
-        await self.cog.download_video_playlist_plex_command.callback(self.cog, self.mock_interaction, playlist_url=playlist_url, location=rel_plex_video_location)
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.downloader.get_playlist.assert_called_once_with(playlist_url)
-
-        initial_path_exists_calls = [call(download_video_folder), call(expected_plex_video_path)]
-        self.cog.path_check.path_exists.assert_has_calls(initial_path_exists_calls, any_order=True)
-
-        download_video_calls = [call(url, download_video_folder) for url in dummy_urls]
-        self.cog.downloader.download_video.assert_has_calls(download_video_calls)
+class TestResumableDownloader(unittest.TestCase):
 
-        combine_video_calls = [call(dummy_video_obj, expected_plex_video_path) for _ in dummy_urls]
-        self.cog.converter.combine_video_and_audio.assert_has_calls(combine_video_calls)
-
-        clear_local_cache_calls = [call(download_video_folder) for _ in dummy_urls]
-        self.cog.path_check.clear_local_cache.assert_has_calls(clear_local_cache_calls)
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.folder, "video.mp4")
+        self.data = bytes(range(40))
+        self.ranges = []
+
+    def tearDown(self):
+        LocalPathCheck().remove_job_folder(self.folder)
+
+    def session(self, fail_after=None):
+        """Returns a fake session serving self.data, dropping the connection once at byte fail_after."""
+        session = MagicMock()
+
+        def get(url, headers, **kwargs):
+            start, end = (int(value) for value in headers["Range"].split("=")[1].split("-"))
+            self.ranges.append((start, end))
+            fail_after = None
+            if session.fail_after is not None and start <= session.fail_after <= end:
+                fail_after = session.fail_after - start
+                session.fail_after = None
+            return FakeRangeResponse(self.data[start:end + 1], fail_after=fail_after)
+
+        session.fail_after = fail_after
+        session.get.side_effect = get
+        return session
+
+    def downloader(self, session, retries=0, connections=1):
+        return ResumableDownloader(os.path.join(self.folder, "parts"), chunk_size=16, retries=retries, connections=connections, session=session)
+
+    def test_downloads_in_range_chunks(self):
+        """The file is fetched in chunk_size ranges and the partial files are cleaned up."""
+        self.downloader(self.session()).download("url", self.output_path, len(self.data), "abc_137")
+
+        with open(self.output_path, "rb") as handler:
+            self.assertEqual(handler.read(), self.data)
+        self.assertEqual(self.ranges, [(0, 15), (16, 31), (32, 39)])
+        self.assertEqual(os.listdir(os.path.join(self.folder, "parts")), [])
+
+    def test_dropped_connection_resumes_within_the_same_call(self):
+        """A connection drop is retried from the last byte written, not from the start."""
+        with patch("bot.cogs.download.time.sleep"):
+            self.downloader(self.session(fail_after=20), retries=1).download("url", self.output_path, len(self.data), "abc_137")
+
+        with open(self.output_path, "rb") as handler:
+            self.assertEqual(handler.read(), self.data)
+        self.assertEqual(self.ranges, [(0, 15), (16, 31), (20, 31), (32, 39)])
+
+    def test_partial_download_resumes_after_restart(self):
+        """A new downloader (e.g. after a restart) picks up the checkpointed partial file."""
+        with self.assertRaises(requests.ConnectionError):
+            self.downloader(self.session(fail_after=20)).download("url", self.output_path, len(self.data), "abc_137")
+        self.assertFalse(os.path.exists(self.output_path))
+
+        self.ranges.clear()
+        self.downloader(self.session()).download("url", self.output_path, len(self.data), "abc_137")
+
+        with open(self.output_path, "rb") as handler:
+            self.assertEqual(handler.read(), self.data)
+        self.assertEqual(self.ranges, [(20, 31), (32, 39)])
+
+    def test_segments_are_fetched_over_parallel_connections(self):
+        """Segments downloaded concurrently are reassembled in place."""
+        self.data = bytes(range(200))
+        in_flight = 0
+        peak = 0
+        lock = threading.Lock()
+        serve = self.session().get.side_effect
+
+        def get(url, headers, **kwargs):
+            nonlocal in_flight, peak
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            time.sleep(0.01)
+            with lock:
+                in_flight -= 1
+            return serve(url, headers, **kwargs)
+
+        session = MagicMock()
+        session.get.side_effect = get
+        self.downloader(session, connections=4).download("url", self.output_path, len(self.data), "abc_137")
+
+        with open(self.output_path, "rb") as handler:
+            self.assertEqual(handler.read(), self.data)
+        self.assertEqual(sorted(self.ranges), [(start, min(start + 15, 199)) for start in range(0, 200, 16)])
+        self.assertGreater(peak, 1)
+        self.assertLessEqual(peak, 4)
+
+    def test_concurrent_downloads_of_one_stream_take_turns(self):
+        """Two jobs fetching the same stream don't share the partial file; the second copies the first's result."""
+        outputs = [os.path.join(self.folder, f"job{index}.mp4") for index in range(2)]
+        errors = []
+        downloader = self.downloader(self.session())
+
+        def fetch(output_path):
+            try:
+                downloader.download("url", output_path, len(self.data), "abc_137")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=(output_path,)) for output_path in outputs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for output_path in outputs:
+            with open(output_path, "rb") as handler:
+                self.assertEqual(handler.read(), self.data)
+        self.assertEqual(self.ranges, [(0, 15), (16, 31), (32, 39)])
+        self.assertEqual(ResumableDownloader.claims, {})
+
+    def test_stale_partial_files_are_pruned(self):
+        """Partial files untouched for max_age are deleted; recent ones are kept for resuming."""
+        parts = os.path.join(self.folder, "parts")
+        os.makedirs(parts)
+        for name in ("old_18.part", "old_18.part.json", "new_18.part"):
+            open(os.path.join(parts, name), "wb").close()
+        stale = time.time() - 120
+        os.utime(os.path.join(parts, "old_18.part"), (stale, stale))
+        os.utime(os.path.join(parts, "old_18.part.json"), (stale, stale))
+
+        downloader = ResumableDownloader(parts, max_age=60)
+
+        self.assertEqual(downloader.prune(), 2)
+        self.assertEqual(os.listdir(parts), ["new_18.part"])
+
+    def test_cancelled_download_keeps_its_partial_file(self):
+        """Setting cancel stops the download with DownloadCancelled and leaves the partial file to resume."""
+        cancel = threading.Event()
+        serve = self.session().get.side_effect
+
+        def get(url, headers, **kwargs):
+            response = serve(url, headers, **kwargs)
+            cancel.set()
+            return response
+
+        session = MagicMock()
+        session.get.side_effect = get
+        with self.assertRaises(DownloadCancelled):
+            self.downloader(session).download("url", self.output_path, len(self.data), "abc_137", cancel=cancel)
+
+        self.assertFalse(os.path.exists(self.output_path))
+        self.assertEqual(self.ranges, [(0, 15)])
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "parts", "abc_137.part")))
+
+    def test_rejected_range_requests_fall_back_to_pytubefix(self):
+        """A stream that refuses range requests is not retried but downloaded with stream.download."""
+        session = MagicMock()
+        session.get.return_value = FakeRangeResponse(b"", status_code=416)
+        downloader = Downloader(metadata_cache=MetadataCache(ttl=0))
+        downloader.resumable = self.downloader(session, retries=3)
+        stream = MagicMock(itag=18, url="url", filesize=len(self.data), is_otf=False, is_sabr=False)
+
+        with patch("bot.cogs.download.time.sleep") as sleep:
+            downloader.download_stream(MagicMock(video_id="abc"), stream, self.folder, "audio.mp3")
+
+        self.assertEqual(session.get.call_count, 1)
+        sleep.assert_not_called()
+        stream.download.assert_called_once_with(output_path=self.folder, filename="audio.mp3")
+
+    def test_otf_streams_skip_range_requests(self):
+        """OTF streams go straight to stream.download."""
+        session = MagicMock()
+        downloader = Downloader(metadata_cache=MetadataCache(ttl=0))
+        downloader.resumable = self.downloader(session)
+        stream = MagicMock(itag=18, url="url", filesize=len(self.data), is_otf=True)
+
+        downloader.download_stream(MagicMock(video_id="abc"), stream, self.folder, "audio.mp3")
+
+        session.get.assert_not_called()
+        stream.download.assert_called_once_with(output_path=self.folder, filename="audio.mp3")
+
+
+
+def drive_file(file_id, title, parent, size=10, md5="abc", trashed=False, modified=None):
+    """Builds a Drive v2 file resource."""
+    file = {"id": file_id, "title": title, "fileSize": str(size), "md5Checksum": md5, "parents": [{"id": parent}], "labels": {"trashed": trashed}}
+    if modified:
+        file["modifiedDate"] = modified
+    return file
+
+
+class TestDriveIndex(unittest.TestCase):
 
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Downloaded video.mp4 to plex."
-        )
-        self.mock_interaction.followup.send.assert_any_call(
-            f"Finished downloading video playlist to Plex server at {expected_plex_video_path}."
-        )
+    def setUp(self):
+        self.drive = MagicMock()
+        self.drive.ListFile.return_value.GetList.return_value = [drive_file("1", "song.mp3", "music")]
+        self.service = self.drive.auth.service
+        self.service.changes.return_value.getStartPageToken.return_value.execute.return_value = {"startPageToken": "10"}
+        self.index = DriveIndex(self.drive, ["music"], refresh_interval=0)
+
+    def test_lookups_list_the_folder_only_once(self):
+        """The first lookup lists the folder; later ones are answered from the index."""
+        self.service.changes.return_value.list.return_value.execute.return_value = {"items": [], "newStartPageToken": "10"}
+
+        self.assertEqual(self.index.lookup("music", "song.mp3"), {"title": "song.mp3", "id": "1", "size": 10, "md5": "abc"})
+        self.assertIsNone(self.index.lookup("music", "other.mp3"))
+
+        self.drive.ListFile.assert_called_once()
+
+    def test_changes_feed_updates_the_index(self):
+        """Added, trashed and moved files are applied from the changes feed."""
+        self.index.load()
+        self.service.changes.return_value.list.return_value.execute.side_effect = [
+            {"items": [{"fileId": "2", "file": drive_file("2", "new.mp3", "music")}], "nextPageToken": "11"},
+            {"items": [{"fileId": "1", "file": drive_file("1", "song.mp3", "music", trashed=True)},
+                       {"fileId": "3", "file": drive_file("3", "elsewhere.mp3", "other")}], "newStartPageToken": "12"},
+        ]
 
-    # Tests for download_spotify_command
-    @patch('os.path.exists')
-    async def test_download_spotify_command_location_none(self, mock_os_path_exists):
-        """Test download_spotify_command with location=None."""
-        spotify_url = "test_spotify_url_none"
-        mock_os_path_exists.return_value = True # Assume file exists after download
+        titles = sorted(record["title"] for record in self.index.list("music"))
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_spotify.reset_mock()
-        self.cog.path_check.get_temp_spotify_file.reset_mock()
-        self.cog.path_check.clear_temp_spotify.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        self.assertEqual(titles, ["new.mp3"])
+        self.assertEqual(self.index.page_token, "12")
 
-        # Configure get_temp_spotify_file to return a path consistent with temp_spotify_folder
-        self.cog.path_check.get_temp_spotify_file.return_value = os.path.join(temp_spotify_folder, "song.mp3")
+    def test_find_checksum_ignores_titles(self):
+        """Files are matched on their MD5 checksum only."""
+        self.service.changes.return_value.list.return_value.execute.return_value = {"items": [], "newStartPageToken": "10"}
 
-        await self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url=spotify_url, location=None)
+        self.assertEqual(self.index.find_checksum("music", "abc")["title"], "song.mp3")
+        self.assertIsNone(self.index.find_checksum("music", "def"))
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.path_check.path_exists.assert_called_once_with(temp_spotify_folder)
-        self.cog.downloader.download_spotify.assert_called_once_with(spotify_url, temp_spotify_folder)
-        self.cog.path_check.get_temp_spotify_file.assert_called_once_with(temp_spotify_folder)
+    def test_uploads_are_added_without_a_refresh(self):
+        """A file recorded after upload is found straight away."""
+        self.index.load()
+        self.index.add("music", drive_file("4", "uploaded.mp3", "music", size=99))
 
-        # Check that os.path.exists was called with the path returned by get_temp_spotify_file
-        mock_os_path_exists.assert_called_once_with(os.path.join(temp_spotify_folder, "song.mp3"))
+        self.assertEqual(self.index.files["music"]["uploaded.mp3"]["size"], 99)
 
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-        self.cog.path_check.clear_temp_spotify.assert_called_once_with(temp_spotify_folder)
 
-    @patch('os.path.exists')
-    async def test_download_spotify_command_location_absolute(self, mock_os_path_exists):
-        """Test download_spotify_command with an absolute path for location."""
-        spotify_url = "test_spotify_url_abs"
-        abs_spotify_location = "/custom/spotify/abs/path"
-        mock_os_path_exists.return_value = True
+class TestDriveUpload(unittest.IsolatedAsyncioTestCase):
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_spotify.reset_mock()
-        self.cog.path_check.get_temp_spotify_file.reset_mock()
-        self.cog.path_check.clear_temp_spotify.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "song.mp3")
+        with open(self.path, "wb") as handler:
+            handler.write(b"x" * 1024)
+        with patch('bot.cogs.download.GoogleAuth'):
+            self.uploader = Uploader(chunk_size=256 * 1024, retries=2)
+        self.uploader.drive = MagicMock()
+        self.uploader.index = MagicMock()
+        self.uploader.index.find_checksum.return_value = None
+        self.uploader.quota = MagicMock()
+        self.request = self.uploader.drive.auth.service.files.return_value.insert.return_value
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def chunk_status(self, fraction):
+        status = MagicMock()
+        status.progress.return_value = fraction
+        return status
+
+    @patch('bot.cogs.download.time.sleep')
+    def test_failed_chunk_is_retried(self, mock_sleep):
+        """A chunk that fails with a server error is sent again, and progress is reported per chunk."""
+        error = HttpError(MagicMock(status=503), b"")
+        response = {"id": "1", "title": "song.mp3", "fileSize": "1024", "md5Checksum": "abc"}
+        self.request.next_chunk.side_effect = [(self.chunk_status(0.5), None), error, (None, response)]
+        progress = []
+
+        result = self.uploader.upload_music(self.path, on_progress=progress.append)
+
+        self.assertEqual(result, self.uploader.index.add.return_value)
+        self.assertEqual(progress, [0.5, 1.0])
+        self.assertEqual(self.request.next_chunk.call_count, 3)
+        self.uploader.index.add.assert_called_once_with(google_drive_music_upload, response)
+        self.assertEqual(self.uploader.last_music_upload, "song.mp3")
+
+    @patch('bot.cogs.download.time.sleep')
+    def test_client_errors_are_not_retried(self, mock_sleep):
+        """Errors that retrying can't fix, such as a full Drive, fail straight away."""
+        self.request.next_chunk.side_effect = HttpError(MagicMock(status=403), b"")
+
+        with self.assertRaises(HttpError):
+            self.uploader.upload_music(self.path)
+
+        self.request.next_chunk.assert_called_once()
+        self.uploader.index.add.assert_not_called()
+
+    def test_same_bytes_are_not_uploaded_again(self):
+        """A file whose MD5 is already in the folder returns the existing Drive file, whatever its title."""
+        existing = {"title": "renamed.mp3", "id": "7", "size": 1024, "md5": "ignored"}
+        self.uploader.index.find_checksum.return_value = existing
+
+        result = self.uploader.upload_music(self.path)
+
+        self.assertEqual(result, existing)
+        self.uploader.index.find_checksum.assert_called_once_with(google_drive_music_upload, hashlib.md5(b"x" * 1024).hexdigest())
+        self.request.next_chunk.assert_not_called()
+        self.uploader.quota.reserve.assert_not_called()
+        self.uploader.index.touch.assert_called_once()
+        self.assertEqual(Uploader.link(result), "https://drive.google.com/file/d/7/view")
+
+    async def test_service_runs_uploads_off_the_event_loop(self):
+        """Uploads run on the pool's threads and progress is delivered on the event loop."""
+        loop_thread = threading.get_ident()
+        calls = []
+
+        def upload_music(path, on_progress):
+            calls.append(threading.get_ident())
+            on_progress(0.5)
+            return {"id": "1"}
+
+        self.uploader.upload_music = upload_music
+        service = UploadService(self.uploader, workers=1)
+        progress = []
+        try:
+            result = await service.upload_music(self.path, on_progress=lambda fraction: progress.append((fraction, threading.get_ident())))
+            await asyncio.sleep(0)
+        finally:
+            service.close()
+
+        self.assertEqual(result, {"id": "1"})
+        self.assertNotEqual(calls[0], loop_thread)
+        self.assertEqual(progress, [(0.5, loop_thread)])
+
+
+class TestDriveQuota(unittest.TestCase):
 
-        self.cog.path_check.get_temp_spotify_file.return_value = os.path.join(abs_spotify_location, "song.mp3")
+    def setUp(self):
+        drive = MagicMock()
+        drive.ListFile.return_value.GetList.return_value = [
+            drive_file("new", "new.mp3", "music", size=10, modified="2024-03-01T00:00:00.000Z"),
+            drive_file("old", "old.mp3", "music", size=10, modified="2024-01-01T00:00:00.000Z"),
+            drive_file("mid", "mid.mp3", "music", size=10, modified="2024-02-01T00:00:00.000Z"),
+        ]
+        service = drive.auth.service
+        service.changes.return_value.getStartPageToken.return_value.execute.return_value = {"startPageToken": "10"}
+        service.changes.return_value.list.return_value.execute.return_value = {"items": [], "newStartPageToken": "10"}
+        self.index = DriveIndex(drive, ["music"], refresh_interval=0)
+        self.trash = MagicMock()
+        self.quota = DriveQuota(self.index, self.trash, {"music": 30})
+        self.index.load()
 
-        await self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url=spotify_url, location=abs_spotify_location)
+    def titles(self):
+        return sorted(record["title"] for record in self.index.list("music"))
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.path_check.path_exists.assert_called_once_with(abs_spotify_location)
-        self.cog.downloader.download_spotify.assert_called_once_with(spotify_url, abs_spotify_location)
-        self.cog.path_check.get_temp_spotify_file.assert_called_once_with(abs_spotify_location)
+    def test_least_recently_shared_files_are_trashed(self):
+        """Only as many of the oldest files are trashed as the upload needs."""
+        trashed = self.quota.make_room("music", 15)
 
-        mock_os_path_exists.assert_called_once_with(os.path.join(abs_spotify_location, "song.mp3"))
+        self.assertEqual([record["id"] for record in trashed], ["old", "mid"])
+        self.assertEqual(self.trash.call_args_list, [call("old"), call("mid")])
+        self.assertEqual(self.titles(), ["new.mp3"])
 
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-        self.cog.path_check.clear_temp_spotify.assert_called_once_with(abs_spotify_location)
+    def test_sharing_a_file_keeps_it(self):
+        """A file handed out again moves to the back of the eviction order."""
+        self.index.touch("old")
 
-    @patch('os.path.exists')
-    async def test_download_spotify_command_location_relative(self, mock_os_path_exists):
-        """Test download_spotify_command with a relative path for location."""
-        spotify_url = "test_spotify_url_rel"
-        rel_spotify_location = "my_spotify_downloads"
-        expected_spotify_path = os.path.join(temp_spotify_folder, rel_spotify_location)
-        mock_os_path_exists.return_value = True
+        trashed = self.quota.make_room("music", 5)
 
-        # Reset mocks
-        self.cog.path_check.path_exists.reset_mock()
-        self.cog.downloader.download_spotify.reset_mock()
-        self.cog.path_check.get_temp_spotify_file.reset_mock()
-        self.cog.path_check.clear_temp_spotify.reset_mock()
-        self.mock_interaction.followup.send.reset_mock()
-        self.mock_interaction.response.defer.reset_mock()
+        self.assertEqual([record["id"] for record in trashed], ["mid"])
 
-        self.cog.path_check.get_temp_spotify_file.return_value = os.path.join(expected_spotify_path, "song.mp3")
+    def test_uploads_in_flight_count_against_the_budget(self):
+        """A second upload makes room for both while the first is still running."""
+        with self.quota.reserve("music", 10):
+            self.assertEqual(self.quota.used("music"), 30)
+            self.assertEqual([record["id"] for record in self.quota.make_room("music", 10)], ["mid"])
+        self.assertEqual(self.quota.used("music"), 10)
+        self.assertEqual(self.titles(), ["new.mp3"])
 
-        await self.cog.download_spotify_command.callback(self.cog, self.mock_interaction, url=spotify_url, location=rel_spotify_location)
+    def test_no_budget_or_oversized_uploads_trash_nothing(self):
+        """Folders without a budget, and files that could never fit, leave the folder alone."""
+        self.assertEqual(self.quota.make_room("video", 100), [])
+        self.assertEqual(self.quota.make_room("music", 31), [])
+        self.trash.assert_not_called()
 
-        self.mock_interaction.response.defer.assert_called_once()
-        self.cog.path_check.path_exists.assert_called_once_with(expected_spotify_path)
-        self.cog.downloader.download_spotify.assert_called_once_with(spotify_url, expected_spotify_path)
-        self.cog.path_check.get_temp_spotify_file.assert_called_once_with(expected_spotify_path)
 
-        mock_os_path_exists.assert_called_once_with(os.path.join(expected_spotify_path, "song.mp3"))
+class TestUploadBackends(unittest.IsolatedAsyncioTestCase):
 
-        self.mock_interaction.followup.send.assert_any_call(file=unittest.mock.ANY, content="song.mp3")
-        self.cog.path_check.clear_temp_spotify.assert_called_once_with(expected_spotify_path)
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "my song.mp3")
+        with open(self.path, "wb") as handler:
+            handler.write(b"x" * (3 * 1024 * 1024))
+        self.share = os.path.join(self.temp_dir.name, "share")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_local_backend_copies_into_the_share(self):
+        """Files land in music/ under the folder, with progress per block and an HTTP link when a base URL is set."""
+        uploader = LocalUploader(self.share, "http://nas.local/media/")
+        uploader.setup()
+        progress = []
+
+        record = uploader.upload_music(self.path, on_progress=progress.append)
+
+        self.assertEqual(record["size"], 3 * 1024 * 1024)
+        self.assertEqual(progress[-1], 1.0)
+        self.assertTrue(os.path.isfile(os.path.join(self.share, "music", "my song.mp3")))
+        self.assertFalse(os.path.exists(os.path.join(self.share, "music", "my song.mp3.part")))
+        self.assertTrue(uploader.check_if_file_exists_in_music_drive("my song.mp3"))
+        self.assertFalse(uploader.check_if_file_exists_in_video_drive("my song.mp3"))
+        self.assertEqual(uploader.link(record), "http://nas.local/media/music/my%20song.mp3")
+        self.assertEqual(uploader.last_music_upload, "my song.mp3")
+
+    def test_local_backend_links_to_files_without_a_base_url(self):
+        """Without a base URL the link is a file URI."""
+        uploader = LocalUploader(self.share, "")
+
+        record = uploader.upload_video(self.path)
+
+        self.assertTrue(uploader.link(record).startswith("file://"))
+        self.assertTrue(os.path.isfile(os.path.join(self.share, "video", "my song.mp3")))
+
+    async def test_memory_backend_works_with_the_upload_service(self):
+        """The in-memory backend stores the bytes and runs through UploadService like Drive does."""
+        uploader = MemoryUploader()
+        service = UploadService(uploader, workers=1)
+        try:
+            record = await service.upload_music(self.path)
+        finally:
+            service.close()
+
+        self.assertEqual(uploader.files[("music", "my song.mp3")], b"x" * (3 * 1024 * 1024))
+        self.assertEqual(uploader.lookup("music", "my song.mp3"), record)
+        self.assertEqual(uploader.link(record), "memory://music/my song.mp3")
+
+    def test_unknown_backend_is_a_configuration_error(self):
+        """Backends are picked by name; a misspelt name fails instead of falling back to Google Drive."""
+        self.assertIsInstance(create_uploader("memory"), MemoryUploader)
+        with patch('bot.cogs.download.GoogleAuth') as google_auth:
+            with self.assertRaises(InvalidSetting):
+                create_uploader("loacl")
+        google_auth.assert_not_called()
+
+    def test_incomplete_backends_fail_when_constructed(self):
+        """A backend missing part of the interface can't be created at all."""
+        class NoLinks(UploadBackend):
+            def upload_file(self, file_path, destination, on_progress=None):
+                return {}
+
+            def lookup(self, destination, file_name):
+                return None
+
+        with self.assertRaises(TypeError):
+            NoLinks("music", "video")
 
 
 if __name__ == '__main__':